@@ -1,20 +1,44 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Request, BackgroundTasks, Query
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import PlainTextResponse, Response, JSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo.errors import DuplicateKeyError
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
 import asyncio
 import logging
 import json
+import re
+import gzip
+import hashlib
+import hmac
+import time
+import bisect
+import fnmatch
+import ipaddress
+from collections import OrderedDict, defaultdict
+from contextvars import ContextVar
+from functools import lru_cache
+from urllib.parse import urlparse
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, ConfigDict, ValidationError
+from typing import List, Optional, Dict, Any, NamedTuple, Union, get_args, get_origin
+from annotated_types import MaxLen
 import uuid
 from datetime import datetime, timezone, timedelta
 import httpx
 
+try:
+    import brotli  # optional — tracker is still served gzip/identity without it
+except ImportError:
+    brotli = None
+
+try:
+    import orjson  # optional — tracking bodies and responses fall back to json without it
+except ImportError:
+    orjson = None
+
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -64,6 +88,7 @@ class PageVisit(BaseModel):
     page_title: Optional[str] = None
     attribution: Optional[Attribution] = None
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    sample_rate: Optional[float] = None       # recorded as a sample of anonymous traffic (weight 1/rate)
 
 
 class Contact(BaseModel):
@@ -82,6 +107,7 @@ class Contact(BaseModel):
     tags: Optional[List[str]] = None          # e.g. ["registered", "attended"]
     merged_into: Optional[str] = None
     merged_children: Optional[List[str]] = None
+    root_contact_id: Optional[str] = None     # end of the merged_into chain (set on merged contacts)
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
@@ -93,7 +119,11 @@ class PageViewCreate(BaseModel):
     referrer_url: Optional[str] = None
     page_title: Optional[str] = None
     attribution: Optional[Dict[str, Any]] = None
-    user_agent: Optional[str] = None          # Browser user agent string
+    attribution_hash: Optional[str] = Field(None, max_length=64)   # sent instead of attribution once acknowledged
+    user_agent: Optional[str] = None          # overrides the request's User-Agent header
+    event_id: Optional[str] = None            # client-generated; duplicates are dropped
+    headless: Optional[int] = None            # tracker's headless-browser hint bits (bot filter)
+    _sample_rate: Optional[float] = None      # set by _sampled_out, never by the client
 
 
 class RegistrationCreate(BaseModel):
@@ -108,7 +138,9 @@ class RegistrationCreate(BaseModel):
     referrer_url: Optional[str] = None
     page_title: Optional[str] = None
     attribution: Optional[Dict[str, Any]] = None
-    user_agent: Optional[str] = None          # Browser user agent string
+    attribution_hash: Optional[str] = Field(None, max_length=64)   # sent instead of attribution once acknowledged
+    user_agent: Optional[str] = None          # overrides the request's User-Agent header
+    event_id: Optional[str] = None            # client-generated; duplicates are dropped
 
 
 class LeadCreate(BaseModel):
@@ -123,7 +155,9 @@ class LeadCreate(BaseModel):
     referrer_url: Optional[str] = None
     page_title: Optional[str] = None
     attribution: Optional[Dict[str, Any]] = None
-    user_agent: Optional[str] = None          # Browser user agent string
+    attribution_hash: Optional[str] = Field(None, max_length=64)   # sent instead of attribution once acknowledged
+    user_agent: Optional[str] = None          # overrides the request's User-Agent header
+    event_id: Optional[str] = None            # client-generated; duplicates are dropped
 
 
 class StitchRequest(BaseModel):
@@ -149,6 +183,7 @@ class ContactWithStats(BaseModel):
     tags: Optional[List[str]] = None
     merged_into: Optional[str] = None
     merged_children: Optional[List[str]] = None
+    root_contact_id: Optional[str] = None
     created_at: datetime
     updated_at: datetime
     visit_count: int = 0
@@ -170,6 +205,7 @@ class ContactDetail(BaseModel):
     tags: Optional[List[str]] = None
     merged_into: Optional[str] = None
     merged_children: Optional[List[str]] = None
+    root_contact_id: Optional[str] = None
     created_at: datetime
     updated_at: datetime
     visits: List[PageVisit] = []
@@ -180,6 +216,33 @@ class TagCreate(BaseModel):
     contact_id: str
     tag: str                  # e.g. "registered", "attended", "thank-you"
     session_id: Optional[str] = None
+    event_id: Optional[str] = None            # client-generated; duplicates are dropped
+    headless: Optional[int] = None            # tracker's headless-browser hint bits (bot filter)
+
+
+class TrackBatchEvent(BaseModel):
+    type: str                 # 'pageview' | 'lead' | 'registration' | 'tag'
+    data: Dict[str, Any]
+    # The visitor's own address / browser, for events replayed by a trusted server-side
+    # caller (ignored otherwise); without them a replayed event records neither
+    client_ip: Optional[str] = Field(None, max_length=45)
+    user_agent: Optional[str] = Field(None, max_length=1000)
+
+
+TRACK_BATCH_MAX_EVENTS = 500   # tracker flushes at most 20; server-side replays send more
+
+
+class TrackBatchCreate(BaseModel):
+    """Ordered events — from the tracker's queue or replayed by our own backends — in one request."""
+    events: List[TrackBatchEvent] = Field(default_factory=list, max_length=TRACK_BATCH_MAX_EVENTS)
+
+
+class TrackerRumReport(BaseModel):
+    """Compact timing beacon from a sampled tracker page load (short keys keep it small)."""
+    d: str = Field(..., max_length=253)                  # page hostname
+    v: Optional[str] = Field(None, max_length=16)        # tracker version
+    m: Dict[str, float] = Field(default_factory=dict)    # timings in ms, see RUM_TIMING_METRICS
+    c: Dict[str, int] = Field(default_factory=dict)      # counters, see RUM_COUNTERS
 
 
 # ─────────────────────────── Sale Models ───────────────────────────
@@ -335,29 +398,69 @@ def get_client_ip(request: Request) -> Optional[str]:
     return None
 
 
-def safe_attribution(raw: Optional[dict]) -> Optional[Attribution]:
-    if not raw:
-        return None
+# Reverse proxies in front of uvicorn (nginx on the same host by default).  They must
+# append the address they saw to X-Forwarded-For (proxy_add_x_forwarded_for).
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(net.strip(), strict=False)
+    for net in os.environ.get('TRUSTED_PROXIES', '127.0.0.0/8,::1/128').split(',') if net.strip()
+]
+
+
+def _valid_ip(ip: Optional[str]) -> Optional[str]:
+    """ip in canonical form, or None when it is not an IP address."""
     try:
-        known = {
-            'utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content',
-            'utm_id', 'campaign_id', 'adset_id', 'ad_id',
-            'fbclid', 'fbc', 'fbp',  # fbc/fbp are Facebook cookies for CAPI
-            'gclid', 'ttclid', 'source_link_tag', 'fb_ad_set_id', 'google_campaign_id'
-        }
-        attrs = {k: str(v)[:500] for k, v in raw.items() if k in known and v}
-        # Capture ALL unrecognised params into extra (merge with any existing extra dict)
-        raw_extra = raw.get('extra') or {}
-        extra_from_raw = {k: str(v)[:500] for k, v in raw.items() if k not in known and k != 'extra' and v}
-        if isinstance(raw_extra, dict):
-            extra_from_raw.update({k: str(v)[:500] for k, v in raw_extra.items() if v})
-        if extra_from_raw:
-            attrs['extra'] = extra_from_raw
-        return Attribution(**attrs) if attrs else None
-    except Exception:
+        return str(ipaddress.ip_address((ip or '').strip()))
+    except ValueError:
         return None
 
 
+def _in_networks(ip: Optional[str], networks: list) -> bool:
+    try:
+        addr = ipaddress.ip_address(ip or '')
+    except ValueError:
+        return False
+    return any(addr in net for net in networks)
+
+
+def verified_client_ip(request: Request) -> Optional[str]:
+    """
+    Client IP for security decisions (rate limits, bot ranges, trusted callers).  Unlike
+    get_client_ip — the leftmost X-Forwarded-For value, which the client writes itself —
+    the header is only believed when the peer is one of TRUSTED_PROXIES, and is read from
+    the right: the first address that is not a trusted proxy is the one our own proxy saw.
+    """
+    peer = request.client.host if request.client else None
+    if not _in_networks(peer, TRUSTED_PROXIES):
+        return peer
+    hops = [hop.strip() for hop in (request.headers.get('x-forwarded-for') or '').split(',') if hop.strip()]
+    for hop in reversed(hops):
+        if not _in_networks(hop, TRUSTED_PROXIES):
+            return hop
+    return hops[0] if hops else peer
+
+
+ATTRIBUTION_FIELDS = tuple(f for f in Attribution.model_fields if f != 'extra')   # fbc/fbp are Facebook cookies for CAPI
+
+
+def _clean_attribution(raw: Optional[dict]) -> dict:
+    """
+    Sanitized attribution as a plain dict, in Attribution field order with no empty
+    values: the fields are truncated to 500 characters and every unrecognised param
+    lands in extra, so the dict is what an Attribution model would dump (minus nulls).
+    """
+    if not raw or not isinstance(raw, dict):
+        return {}
+    attrs = {k: str(raw[k])[:500] for k in ATTRIBUTION_FIELDS if raw.get(k)}
+    # Capture ALL unrecognised params into extra (merge with any existing extra dict)
+    extra = {str(k): str(v)[:500] for k, v in raw.items() if k not in Attribution.model_fields and v}
+    raw_extra = raw.get('extra')
+    if isinstance(raw_extra, dict):
+        extra.update({str(k): str(v)[:500] for k, v in raw_extra.items() if v})
+    if extra:
+        attrs['extra'] = extra
+    return attrs
+
+
 def fix_contact_doc(c: dict) -> dict:
     c['created_at'] = str_to_dt(c.get('created_at'))
     c['updated_at'] = str_to_dt(c.get('updated_at'))
@@ -468,12 +571,181 @@ def _tz_day_end(date_str: str, tz_name: Optional[str]) -> str:
         return date_str.split("T")[0] + "T23:59:59.999999+00:00"
 
 
-async def _resolve_contact_id(contact_id: str) -> str:
+# ─── Merge roots ───
+# A merged (child) contact carries root_contact_id: the visible contact at the end of
+# its merged_into chain, maintained by _do_stitch for the whole subtree it moves.
+# Resolution is then one lookup whatever the chain depth, and zero for ids in the
+# per-process LRU below.  A stitch invalidates the affected ids here at once and, via
+# stitch_invalidations, in the other uvicorn worker within RESOLVE_CACHE_SYNC_SECONDS.
+# Contacts merged before root_contact_id existed fall back to walking the chain and
+# are backfilled as they are resolved.
+RESOLVE_CACHE_MAX_ENTRIES = 50_000
+RESOLVE_CACHE_SYNC_SECONDS = 1
+STITCH_INVALIDATION_TTL_SECONDS = 3600
+
+_resolve_cache: "OrderedDict[str, str]" = OrderedDict()      # contact_id → root contact_id
+_resolve_cache_members: Dict[str, set] = defaultdict(set)   # root → cached ids resolving to it
+_resolve_cache_stats = {"hits": 0, "misses": 0, "invalidated": 0}
+
+
+def _resolve_cache_get(contact_id: str) -> Optional[str]:
+    root = _resolve_cache.get(contact_id)
+    if root is None:
+        _resolve_cache_stats["misses"] += 1
+        return None
+    _resolve_cache.move_to_end(contact_id)
+    _resolve_cache_stats["hits"] += 1
+    return root
+
+
+def _resolve_cache_put(contact_id: str, root: str) -> None:
+    _resolve_cache_drop(contact_id)
+    _resolve_cache[contact_id] = root
+    _resolve_cache_members[root].add(contact_id)
+    if len(_resolve_cache) > RESOLVE_CACHE_MAX_ENTRIES:
+        _resolve_cache_drop(next(iter(_resolve_cache)))
+
+
+def _resolve_cache_drop(contact_id: str) -> None:
+    root = _resolve_cache.pop(contact_id, None)
+    if root is not None:
+        members = _resolve_cache_members.get(root)
+        if members is not None:
+            members.discard(contact_id)
+            if not members:
+                del _resolve_cache_members[root]
+
+
+def _resolve_cache_invalidate(contact_ids) -> None:
+    """Forget every cached resolution of, or to, these ids."""
+    for cid in contact_ids:
+        for member in list(_resolve_cache_members.get(cid, ())) + [cid]:
+            if member in _resolve_cache:
+                _resolve_cache_drop(member)
+                _resolve_cache_stats["invalidated"] += 1
+
+
+# ─── Absent contacts ───
+# Most pageviews come from visitors who never get a contact document (_new_contact_doc
+# skips blank anonymous loads), and each of them used to pay for lookups that find
+# nothing: _resolve_contact_id, the no-op update of _upsert_contact, the sampling check.
+# Ids a lookup found missing are remembered per process (bounded, LRU, with a TTL) and
+# those lookups are skipped.  Creating a contact drops its id here at once; the ids
+# are published through stitch_invalidations so the other worker drops them within
+# RESOLVE_CACHE_SYNC_SECONDS.  The TTL bounds staleness for contacts created elsewhere.
+ABSENT_CACHE_MAX_ENTRIES = 100_000
+ABSENT_CACHE_TTL_SECONDS = 300
+
+_absent_cache: "OrderedDict[str, float]" = OrderedDict()     # contact_id → expiry (monotonic)
+_absent_cache_stats = {"hits": 0, "misses": 0, "invalidated": 0}
+_absent_created: set = set()                                 # created ids not yet published
+
+
+def _absent_cache_get(contact_id: str) -> bool:
+    """True when contact_id is known to have no contact document."""
+    expires = _absent_cache.get(contact_id)
+    if expires is None or expires < time.monotonic():
+        if expires is not None:
+            del _absent_cache[contact_id]
+        _absent_cache_stats["misses"] += 1
+        return False
+    _absent_cache.move_to_end(contact_id)
+    _absent_cache_stats["hits"] += 1
+    return True
+
+
+def _absent_cache_put(contact_id: str) -> None:
+    _absent_cache[contact_id] = time.monotonic() + ABSENT_CACHE_TTL_SECONDS
+    _absent_cache.move_to_end(contact_id)
+    if len(_absent_cache) > ABSENT_CACHE_MAX_ENTRIES:
+        _absent_cache.popitem(last=False)
+
+
+def _absent_cache_invalidate(contact_ids) -> None:
+    for cid in contact_ids:
+        if _absent_cache.pop(cid, None) is not None:
+            _absent_cache_stats["invalidated"] += 1
+
+
+def _contact_created(contact_id: str) -> None:
+    """A contact document now exists for contact_id: forget it here, then in the other workers."""
+    _absent_cache_invalidate([contact_id])
+    _absent_created.add(contact_id)
+
+
+def _absent_cache_metrics() -> dict:
+    lookups = _absent_cache_stats["hits"] + _absent_cache_stats["misses"]
+    return {"size": len(_absent_cache), "capacity": ABSENT_CACHE_MAX_ENTRIES, **_absent_cache_stats,
+            "hit_rate": round(_absent_cache_stats["hits"] / lookups, 4) if lookups else None}
+
+
+# ─── Contact unit of work ───
+# One stitch evaluation reads the same contacts again and again: every pass loads the
+# current contact, _do_stitch loads parent and child, _session_auto_stitch re-reads the
+# current contact after each candidate and _run_automations reads it once more.  Inside
+# a _ContactUnitOfWork those reads go through _load_contact, which keeps every document
+# it has seen (loaded, seeded, or returned by a candidate query); stitches apply their
+# own writes to the kept documents, so each contact is read at most once.  Outside a
+# unit of work _load_contact is a plain find_one.  The scope is a ContextVar, so tasks
+# started inside it (automations) share it.
+_contact_uow: ContextVar[Optional[Dict[str, Optional[dict]]]] = ContextVar('_contact_uow', default=None)
+_contact_uow_stats = {"loads": 0, "reused": 0}
+
+
+class _ContactUnitOfWork:
+    """Keeps contact documents for _load_contact; docs seeds it with documents already read (None = missing)."""
+
+    def __init__(self, docs: Optional[Dict[str, Optional[dict]]] = None):
+        self.docs = dict(docs or {})
+        self.token = None
+
+    def __enter__(self):
+        self.token = _contact_uow.set(self.docs)
+        return self.docs
+
+    def __exit__(self, *exc):
+        _contact_uow.reset(self.token)
+
+
+async def _load_contact(contact_id: str) -> Optional[dict]:
+    uow = _contact_uow.get()
+    if uow is not None and contact_id in uow:
+        _contact_uow_stats["reused"] += 1
+        return uow[contact_id]
+    doc = await db.contacts.find_one({"contact_id": contact_id}, {"_id": 0})
+    _contact_uow_stats["loads"] += 1
+    if uow is not None:
+        uow[contact_id] = doc
+    return doc
+
+
+def _keep_contacts(docs: List[dict]) -> None:
+    """Keep full contact documents a query returned in the current unit of work."""
+    uow = _contact_uow.get()
+    if uow is not None:
+        for doc in docs:
+            uow[doc["contact_id"]] = doc
+
+
+def _contact_uow_set(contact_id: str, fields: dict) -> None:
+    """Mirror a $set (dotted paths allowed) on the kept document, if any."""
+    uow = _contact_uow.get()
+    doc = uow.get(contact_id) if uow is not None else None
+    if doc is not None:
+        for path, value in fields.items():
+            _set_path(doc, path, value)
+
+
+def _contact_uow_forget(contact_id: str) -> None:
+    uow = _contact_uow.get()
+    if uow is not None:
+        uow.pop(contact_id, None)
+
+
+async def _walk_merge_chain(contact_id: str) -> str:
     """
-    Follow the merge chain to find the root (visible) contact_id.
-    If a browser holds a stale child ID from a previous session, all operations
-    will transparently target the parent contact instead.
-    Guards against cycles with a visited set.
+    Follow merged_into one hop at a time — for contacts merged before root_contact_id
+    was maintained.  Guards against cycles with a visited set.
     """
     visited: set = set()
     cid = contact_id
@@ -486,140 +758,814 @@ async def _resolve_contact_id(contact_id: str) -> str:
     return contact_id  # fallback (cycle or missing)
 
 
-async def _upsert_contact(data: dict, now: datetime, client_ip: Optional[str] = None) -> None:
+async def _resolve_contact_id(contact_id: str) -> str:
+    """
+    Find the root (visible) contact_id.
+    If a browser holds a stale child ID from a previous session, all operations
+    will transparently target the parent contact instead.
+    """
+    if _absent_cache_get(contact_id):
+        return contact_id
+    root = _resolve_cache_get(contact_id)
+    if root is not None:
+        return root
+    doc = await db.contacts.find_one({"contact_id": contact_id},
+                                     {"_id": 0, "merged_into": 1, "root_contact_id": 1})
+    if doc is None:
+        _absent_cache_put(contact_id)
+        return contact_id
+    if not doc.get("merged_into"):
+        root = contact_id
+    elif doc.get("root_contact_id"):
+        root = doc["root_contact_id"]
+    else:
+        root = await _walk_merge_chain(contact_id)
+        if root != contact_id:
+            await db.contacts.update_one({"contact_id": contact_id}, {"$set": {"root_contact_id": root}})
+    _resolve_cache_put(contact_id, root)
+    return root
+
+
+async def _resolve_contact_ids(contact_ids) -> tuple[Dict[str, str], Dict[str, dict]]:
+    """
+    _resolve_contact_id for many ids at once.  Returns (raw id → effective id, effective
+    id → contact document), so callers need no second read.  Cached ids cost nothing
+    extra; otherwise one $in query for the ids (and their cached roots), and one more
+    for roots that query did not return.
+    """
+    ids = {cid for cid in contact_ids if cid}
+    absent = {cid for cid in ids if _absent_cache_get(cid)}
+    resolved: Dict[str, str] = {cid: cid for cid in absent}
+    for cid in ids - absent:
+        root = _resolve_cache_get(cid)
+        if root is not None:
+            resolved[cid] = root
+    wanted = (ids - resolved.keys()) | (set(resolved.values()) - absent)
+    found = await db.contacts.find({"contact_id": {"$in": list(wanted)}}, {"_id": 0}).to_list(None) if wanted else []
+    by_id = {d["contact_id"]: d for d in found}
+
+    for cid in ids - resolved.keys():
+        doc = by_id.get(cid)
+        if doc is None:
+            _absent_cache_put(cid)
+            resolved[cid] = cid
+            continue
+        if not doc.get("merged_into"):
+            root = cid
+        elif doc.get("root_contact_id"):
+            root = doc["root_contact_id"]
+        else:
+            root = await _resolve_contact_id(cid)
+        resolved[cid] = root
+        _resolve_cache_put(cid, root)
+
+    missing = {root for root in resolved.values() if root not in by_id and root not in wanted and root not in absent}
+    if missing:
+        for d in await db.contacts.find({"contact_id": {"$in": list(missing)}}, {"_id": 0}).to_list(None):
+            by_id[d["contact_id"]] = d
+    docs = {root: by_id[root] for root in set(resolved.values()) if root in by_id}
+    return resolved, docs
+
+
+async def _set_merge_root(child_id: str, root_id: str, now: datetime) -> List[str]:
+    """
+    Point child_id and everything merged (directly or transitively) into it at root_id,
+    and invalidate their cached resolutions here and in the other workers.
+    """
+    subtree, frontier = [child_id], [child_id]
+    while frontier:
+        children = await db.contacts.find(
+            {"merged_into": {"$in": frontier}}, {"_id": 0, "contact_id": 1}
+        ).to_list(None)
+        frontier = [c["contact_id"] for c in children if c["contact_id"] not in subtree]
+        subtree.extend(frontier)
+    await db.contacts.update_many({"contact_id": {"$in": subtree}}, {"$set": {"root_contact_id": root_id}})
+    for cid in subtree:
+        _contact_uow_set(cid, {"root_contact_id": root_id})
+    _resolve_cache_invalidate(subtree)
+    await db.stitch_invalidations.insert_one({
+        "ids": subtree, "pid": os.getpid(), "at": now,
+        "expire_at": now + timedelta(seconds=STITCH_INVALIDATION_TTL_SECONDS),
+    })
+    return subtree
+
+
+async def _sync_resolve_cache() -> None:
+    """
+    Apply stitches made by the other workers to this process's resolve cache, and
+    publish the contacts this process created (see Absent contacts).
+    """
+    since = datetime.now(timezone.utc)
+    while True:
+        await asyncio.sleep(RESOLVE_CACHE_SYNC_SECONDS)
+        checked = datetime.now(timezone.utc)
+        try:
+            # Overlap the window a little: re-invalidating is harmless, missing one is not
+            cursor = db.stitch_invalidations.find(
+                {"at": {"$gte": since - timedelta(seconds=2)}, "pid": {"$ne": os.getpid()}},
+                {"_id": 0, "ids": 1},
+            )
+            for entry in await cursor.to_list(None):
+                _resolve_cache_invalidate(entry["ids"])
+                _absent_cache_invalidate(entry["ids"])
+            since = checked
+            if _absent_created:
+                created = list(_absent_created)
+                _absent_created.clear()
+                await db.stitch_invalidations.insert_one({
+                    "ids": created, "pid": os.getpid(), "at": checked,
+                    "expire_at": checked + timedelta(seconds=STITCH_INVALIDATION_TTL_SECONDS),
+                })
+        except Exception as e:
+            logger.warning(f"Resolve cache sync failed: {e}")
+
+
+def _contact_name_parts(data: dict) -> tuple[Optional[str], Optional[str]]:
+    """first_name/last_name from the payload, auto-parsed from `name` when neither is given."""
+    first_name, last_name = data.get('first_name'), data.get('last_name')
+    if data.get('name') and not first_name and not last_name:
+        first_name, last_name = parse_full_name(data.get('name'))
+    return first_name, last_name
+
+
+def _contact_update_fields(data: dict, existing: dict, now: datetime, client_ip: Optional[str] = None,
+                           attribution_merged: bool = False) -> dict:
+    """$set fields that merge one event into an existing contact document."""
+    parsed_first_name, parsed_last_name = _contact_name_parts(data)
+    update: dict = {"updated_at": dt_to_str(now)}
+    for field in ['name', 'email', 'phone', 'session_id']:
+        if data.get(field):
+            update[field] = data[field]
+    # Handle first_name/last_name separately - only update if they don't already exist
+    if parsed_first_name and not existing.get('first_name'):
+        update['first_name'] = parsed_first_name
+    if parsed_last_name and not existing.get('last_name'):
+        update['last_name'] = parsed_last_name
+    if client_ip and not existing.get('client_ip'):
+        update['client_ip'] = client_ip
+    # Store user_agent if provided and not already set (first-seen wins)
+    if data.get('user_agent') and not existing.get('user_agent'):
+        update['user_agent'] = data['user_agent'][:1000]  # Truncate to prevent bloat
+    if data.get('attribution') and not attribution_merged:
+        existing_attr = existing.get('attribution')
+        if not existing_attr or not isinstance(existing_attr, dict):
+            clean = _clean_attribution(data['attribution'])
+            if clean:
+                update['attribution'] = clean
+        else:
+            for k, v in data['attribution'].items():
+                if k == 'extra' and isinstance(v, dict):
+                    existing_extra = existing_attr.get('extra')
+                    new_extra = {ek: str(ev)[:500] for ek, ev in v.items()
+                                 if ev and (not isinstance(existing_extra, dict) or not existing_extra.get(ek))}
+                    if new_extra:
+                        if not isinstance(existing_extra, dict):
+                            update['attribution.extra'] = new_extra
+                        else:
+                            for ek, ev in new_extra.items():
+                                update[f'attribution.extra.{ek}'] = ev
+                elif v and not existing_attr.get(k):
+                    update[f'attribution.{k}'] = v
+    return update
+
+
+def _has_contact_signal(data: dict) -> bool:
+    """Identity or meaningful attribution: what makes a first-seen contact worth storing."""
+    parsed_first_name, parsed_last_name = _contact_name_parts(data)
+    has_identity = any(data.get(f) for f in ['name', 'email', 'phone', 'first_name', 'last_name']) or parsed_first_name or parsed_last_name
+    raw_attr = data.get('attribution') or {}
+    has_attribution = any(raw_attr.get(k) for k in ATTRIBUTION_FIELDS)
+    # Also allow contacts that carry URL extra params (e.g. ?layout=styled-0 from joinnow.live).
+    # These are legitimate iframe visitors who need a document so IP-based stitching can
+    # later merge them with the attribution-rich landing-page contact.
+    has_extra = isinstance(raw_attr.get('extra'), dict) and bool(raw_attr.get('extra'))
+    return bool(has_identity or has_attribution or has_extra)
+
+
+def _new_contact_doc(data: dict, now: datetime, client_ip: Optional[str] = None) -> Optional[dict]:
+    """
+    Document for a first-seen contact, or None when there is nothing worth storing.
+    Only create a new contact if it has identity OR meaningful attribution.
+    Pure anonymous page loads (no UTMs, no email) are skipped -- their visits
+    are still logged in page_visits and will be attached once identified.
+    """
+    if not _has_contact_signal(data):
+        return None  # skip truly blank page loads (no info whatsoever)
+    parsed_first_name, parsed_last_name = _contact_name_parts(data)
+    # Built field by field in Contact field order (no model, no strip_nulls pass)
+    cdoc = {
+        'id':          str(uuid.uuid4()),
+        'contact_id':  data['contact_id'],
+        'session_id':  data.get('session_id'),
+        'client_ip':   client_ip,
+        'user_agent':  data.get('user_agent')[:1000] if data.get('user_agent') else None,
+        'name':        data.get('name'),
+        'email':       data.get('email'),
+        'phone':       data.get('phone'),
+        'first_name':  parsed_first_name,
+        'last_name':   parsed_last_name,
+        'attribution': _clean_attribution(data.get('attribution')) or None,
+        'created_at':  dt_to_str(now),
+        'updated_at':  dt_to_str(now),
+    }
+    return {k: v for k, v in cdoc.items() if v is not None}
+
+
+def _falsy(path: str) -> dict:
+    """Aggregation counterpart of Python's `not value` for a stored scalar (missing, null, false, 0 or "")."""
+    return {"$in": [{"$ifNull": [path, ""]}, ["", False, 0]]}
+
+
+def _first_writer(path: str, value: Any) -> dict:
+    """Keep the stored value unless it is empty, else take value (first-writer-wins)."""
+    return {"$cond": [_falsy(path), {"$literal": value}, path]}
+
+
+def _is_object(path: str) -> dict:
+    return {"$eq": [{"$type": path}, "object"]}
+
+
+def _contact_upsert_pipeline(data: dict, now: datetime, client_ip: Optional[str] = None,
+                             attribution_merged: bool = False) -> tuple[list, bool]:
+    """
+    (update pipeline, creatable) merging one event into a contact the way
+    _contact_update_fields does for an existing document, and producing the
+    _new_contact_doc document when there is none — the decision is made by the server
+    against the stored document, so no read is needed.  creatable is False for a blank
+    anonymous event: the caller must not upsert it.
+
+    Attribution keys that cannot be field names ('.' inside, '$' in front) are skipped.
+    """
+    cdoc = _new_contact_doc(data, now, client_ip)
+    first_name, last_name = _contact_name_parts(data)
+    is_new = {"$eq": [{"$type": "$created_at"}, "missing"]}
+
+    fields: dict = {"updated_at": dt_to_str(now)}
+    for field in ['name', 'email', 'phone', 'session_id']:
+        if data.get(field):
+            fields[field] = {"$literal": data[field]}
+    for field, value in (('first_name', first_name), ('last_name', last_name), ('client_ip', client_ip),
+                         ('user_agent', data['user_agent'][:1000] if data.get('user_agent') else None)):
+        if value:
+            fields[field] = _first_writer(f"${field}", value)
+    # Everything else in a new document (id, created_at) is only written on insert
+    for field, value in (cdoc or {}).items():
+        if field not in fields and field not in ('contact_id', 'attribution'):
+            fields[field] = {"$ifNull": [f"${field}", {"$literal": value}]}
+
+    raw = data.get('attribution')
+    if raw:
+        clean = _clean_attribution(raw)
+        if attribution_merged:
+            if clean:
+                fields['attribution'] = {"$cond": [is_new, {"$literal": clean}, "$attribution"]}
+        else:
+            merge: dict = {}
+            for k, v in raw.items():
+                if not v or '.' in k or k.startswith('$'):
+                    continue
+                if k == 'extra' and isinstance(v, dict):
+                    new_extra = {ek: str(ev)[:500] for ek, ev in v.items()
+                                 if ev and '.' not in ek and not ek.startswith('$')}
+                    if new_extra:
+                        merge['extra'] = {"$cond": [
+                            _is_object("$attribution.extra"),
+                            {"$mergeObjects": ["$attribution.extra", {
+                                ek: _first_writer(f"$attribution.extra.{ek}", ev) for ek, ev in new_extra.items()
+                            }]},
+                            {"$literal": new_extra},
+                        ]}
+                else:
+                    merge[k] = _first_writer(f"$attribution.{k}", v)
+            fields['attribution'] = {"$cond": [
+                _is_object("$attribution"),
+                {"$mergeObjects": ["$attribution", merge]},
+                {"$literal": clean} if clean else "$attribution",
+            ]}
+    return [{"$set": fields}], cdoc is not None
+
+
+async def _upsert_contact(data: dict, now: datetime, client_ip: Optional[str] = None,
+                          attribution_merged: bool = False) -> None:
     """
-    Create or update a contact record.
+    Create or update a contact record in one round trip (see _contact_upsert_pipeline).
     Caller is responsible for passing the resolved (non-merged) contact_id via _resolve_contact_id.
     Auto-parses full name into first_name/last_name if not already provided.
+    attribution_merged=True means data['attribution'] was resolved from a fingerprint the
+    contact already acknowledged, so an existing contact skips the attribution merge.
     """
     cid = data.get('contact_id')
     if not cid:
         return
 
-    # Auto-parse name into first_name/last_name if name exists but first/last don't
-    # Use local variables to avoid mutating the input dict
-    parsed_first_name = data.get('first_name')
-    parsed_last_name = data.get('last_name')
-    if data.get('name') and not parsed_first_name and not parsed_last_name:
-        parsed_first_name, parsed_last_name = parse_full_name(data.get('name'))
+    pipeline, creatable = _contact_upsert_pipeline(data, now, client_ip, attribution_merged)
+    if not creatable and _absent_cache_get(cid):
+        return   # a blank anonymous event for a contact we know does not exist: nothing to update
+    try:
+        result = await db.contacts.update_one({"contact_id": cid}, pipeline, upsert=creatable)
+        if result.upserted_id is not None:
+            _contact_created(cid)
+        elif not result.matched_count:
+            _absent_cache_put(cid)
+    except DuplicateKeyError:
+        # Race condition: two concurrent upserts both found no document and both
+        # inserted.  The loser applies the same pipeline as an update instead of
+        # crashing the endpoint with a 500.
+        logger.info(f"DuplicateKey on upsert for {cid[:12]} — retrying as update")
+        await db.contacts.update_one({"contact_id": cid}, pipeline)
+
+
+def _visit_doc(contact_id: str, session_id: Optional[str],
+               current_url: str, referrer_url: Optional[str],
+               page_title: Optional[str], attribution: Optional[dict],
+               now: datetime, client_ip: Optional[str] = None, visit_id: Optional[str] = None,
+               sample_rate: Optional[float] = None) -> dict:
+    # Built field by field in PageVisit field order (no model, no strip_nulls pass)
+    vdoc = {
+        'id':           visit_id or str(uuid.uuid4()),
+        'contact_id':   contact_id,
+        'session_id':   session_id,
+        'client_ip':    client_ip,
+        'current_url':  current_url,
+        'referrer_url': referrer_url,
+        'page_title':   page_title,
+        'attribution':  _clean_attribution(attribution) or None,
+        'timestamp':    dt_to_str(now),
+        'sample_rate':  sample_rate,
+    }
+    return {k: v for k, v in vdoc.items() if v is not None}
+
+
+async def _log_visit(contact_id: str, session_id: Optional[str],
+                     current_url: str, referrer_url: Optional[str],
+                     page_title: Optional[str], attribution: Optional[dict],
+                     now: datetime, client_ip: Optional[str] = None, visit_id: Optional[str] = None,
+                     sample_rate: Optional[float] = None) -> str:
+    vdoc = _visit_doc(contact_id, session_id, current_url, referrer_url, page_title, attribution, now,
+                      client_ip, visit_id, sample_rate)
+    try:
+        await db.page_visits.insert_one(vdoc)
+    except DuplicateKeyError:
+        pass      # the journal replayer stored this event first (visit ids are unique)
+    return vdoc['id']
 
-    existing = await db.contacts.find_one({"contact_id": cid}, {"_id": 0})
-    now_str = dt_to_str(now)
 
+async def _insert_visits(visits: List[dict]) -> None:
+    """
+    insert_many that skips visits already stored under the same id — an event the
+    journal replayer and its inline write both applied.  The unique page_visits.id
+    index makes this atomic; any other write error is raised.
+    """
+    try:
+        await db.page_visits.insert_many(visits, ordered=False)
+    except BulkWriteError as e:
+        details = e.details or {}
+        if details.get("writeConcernErrors") or any(
+                err.get("code") != 11000 for err in details.get("writeErrors", [])):
+            raise
+
+
+async def _apply_tag(contact_id: str, tag: str, session_id: Optional[str],
+                     now: datetime, client_ip: Optional[str] = None) -> None:
+    """Add tag to the contact, creating a minimal contact if none exists yet."""
+    # Create the contact if it doesn't exist yet (e.g. thank-you page without prior pageview)
+    existing = None if _absent_cache_get(contact_id) else await db.contacts.find_one(
+        {"contact_id": contact_id}, {"_id": 0, "contact_id": 1})
+    if existing is None:
+        try:
+            await db.contacts.insert_one(_tagged_contact_doc(contact_id, tag, session_id, now, client_ip))
+            _contact_created(contact_id)
+        except DuplicateKeyError:
+            existing = True   # created since we looked (or the absent cache was stale)
+            _absent_cache_invalidate([contact_id])
     if existing:
-        update: dict = {"updated_at": now_str}
-        for field in ['name', 'email', 'phone', 'session_id']:
-            if data.get(field):
-                update[field] = data[field]
-        # Handle first_name/last_name separately - only update if they don't already exist
-        if parsed_first_name and not existing.get('first_name'):
-            update['first_name'] = parsed_first_name
-        if parsed_last_name and not existing.get('last_name'):
-            update['last_name'] = parsed_last_name
-        if client_ip and not existing.get('client_ip'):
-            update['client_ip'] = client_ip
-        # Store user_agent if provided and not already set (first-seen wins)
-        if data.get('user_agent') and not existing.get('user_agent'):
-            update['user_agent'] = data['user_agent'][:1000]  # Truncate to prevent bloat
-        if data.get('attribution'):
-            existing_attr = existing.get('attribution')
-            if not existing_attr or not isinstance(existing_attr, dict):
-                built = safe_attribution(data['attribution'])
-                if built:
-                    update['attribution'] = strip_nulls(built.model_dump())
-            else:
-                for k, v in data['attribution'].items():
-                    if k == 'extra' and isinstance(v, dict):
-                        existing_extra = existing_attr.get('extra')
-                        new_extra = {ek: str(ev)[:500] for ek, ev in v.items()
-                                     if ev and (not isinstance(existing_extra, dict) or not existing_extra.get(ek))}
-                        if new_extra:
-                            if not isinstance(existing_extra, dict):
-                                update['attribution.extra'] = new_extra
-                            else:
-                                for ek, ev in new_extra.items():
-                                    update[f'attribution.extra.{ek}'] = ev
-                    elif v and not existing_attr.get(k):
-                        update[f'attribution.{k}'] = v
-        await db.contacts.update_one({"contact_id": cid}, {"$set": update})
-    else:
-        # Only create a new contact if it has identity OR meaningful attribution.
-        # Pure anonymous page loads (no UTMs, no email) are skipped -- their visits
-        # are still logged in page_visits and will be attached once identified.
-        has_identity = any(data.get(f) for f in ['name', 'email', 'phone', 'first_name', 'last_name']) or parsed_first_name or parsed_last_name
-        raw_attr = data.get('attribution') or {}
-        attr_signal_fields = {
-            'utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content',
-            'utm_id', 'campaign_id', 'adset_id', 'ad_id',
-            'fbclid', 'fbc', 'fbp',  # fbc/fbp are FB cookies for CAPI matching
-            'gclid', 'ttclid', 'source_link_tag', 'fb_ad_set_id', 'google_campaign_id'
-        }
-        has_attribution = any(raw_attr.get(k) for k in attr_signal_fields)
-        # Also allow contacts that carry URL extra params (e.g. ?layout=styled-0 from joinnow.live).
-        # These are legitimate iframe visitors who need a document so IP-based stitching can
-        # later merge them with the attribution-rich landing-page contact.
-        has_extra = isinstance(raw_attr.get('extra'), dict) and bool(raw_attr.get('extra'))
-        if not has_identity and not has_attribution and not has_extra:
-            return  # skip truly blank page loads (no info whatsoever)
-
-        contact = Contact(
-            contact_id=cid,
-            session_id=data.get('session_id'),
-            client_ip=client_ip,
-            user_agent=data.get('user_agent')[:1000] if data.get('user_agent') else None,
-            name=data.get('name'),
-            email=data.get('email'),
-            phone=data.get('phone'),
-            first_name=parsed_first_name,
-            last_name=parsed_last_name,
-            attribution=safe_attribution(data.get('attribution')),
-            created_at=now,
-            updated_at=now
+        await db.contacts.update_one(
+            {"contact_id": contact_id},
+            {"$addToSet": {"tags": tag},
+             "$set":      {"updated_at": dt_to_str(now)}}
+        )
+    logger.info(f"Tag '{tag}' applied to contact {contact_id[:12]}...")
+
+
+def _tagged_contact_doc(contact_id: str, tag: str, session_id: Optional[str],
+                        now: datetime, client_ip: Optional[str] = None) -> dict:
+    """Minimal contact — no email yet, but we have a contact_id and tag."""
+    cdoc = {
+        'id':         str(uuid.uuid4()),
+        'contact_id': contact_id,
+        'session_id': session_id,
+        'client_ip':  client_ip,
+        'tags':       [tag],
+        'created_at': dt_to_str(now),
+        'updated_at': dt_to_str(now),
+    }
+    return {k: v for k, v in cdoc.items() if v is not None}
+
+
+TRACK_EVENT_MODELS = {
+    'pageview':     PageViewCreate,
+    'lead':         LeadCreate,
+    'registration': RegistrationCreate,
+    'tag':          TagCreate,
+}
+
+
+# ─── Attribution fingerprints ───
+# A browser's attribution is captured once and then re-sent unchanged with every event.
+# The server answers a full attribution object with its fingerprint (attribution_ack);
+# the tracker then sends only attribution_hash until the attribution changes.  The
+# fingerprint is computed here from the sanitized attribution, so a client can only
+# ever reference attribution it (or someone with identical attribution) sent before.
+ATTRIBUTION_FP_CACHE_MAX_ENTRIES = 20_000
+
+_attribution_fp_cache: Dict[str, dict] = {}
+
+
+def _attribution_fingerprint(clean: dict) -> str:
+    return hashlib.sha256(json.dumps(clean, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()[:24]
+
+
+def _cache_attribution_fp(fp: str, clean: dict) -> None:
+    if len(_attribution_fp_cache) >= ATTRIBUTION_FP_CACHE_MAX_ENTRIES:
+        _attribution_fp_cache.pop(next(iter(_attribution_fp_cache)), None)
+    _attribution_fp_cache[fp] = clean
+
+
+async def _register_attribution(raw: Optional[dict], now: datetime) -> str:
+    """Store the sanitized attribution under its fingerprint (once) and return the fingerprint."""
+    clean = _clean_attribution(raw)
+    fp = _attribution_fingerprint(clean)
+    if fp not in _attribution_fp_cache:
+        await db.attribution_fingerprints.update_one(
+            {"hash": fp},
+            {"$setOnInsert": {"hash": fp, "attribution": clean, "created_at": dt_to_str(now)}},
+            upsert=True,
         )
-        cdoc = strip_nulls(contact.model_dump())
-        cdoc['created_at'] = dt_to_str(contact.created_at)
-        cdoc['updated_at'] = dt_to_str(contact.updated_at)
+        _cache_attribution_fp(fp, clean)
+    return fp
+
+
+async def _lookup_attribution(fp: str) -> Optional[dict]:
+    """Attribution for a fingerprint, or None when the server has never seen it."""
+    clean = _attribution_fp_cache.get(fp)
+    if clean is None:
+        doc = await db.attribution_fingerprints.find_one({"hash": fp}, {"_id": 0, "attribution": 1})
+        if not doc:
+            return None
+        clean = doc.get("attribution") or {}
+        _cache_attribution_fp(fp, clean)
+    return clean
+
+
+async def _event_attribution(data: BaseModel, now: datetime) -> tuple[Optional[dict], bool, dict]:
+    """
+    (attribution, attribution_merged, reply) for one event: a full attribution object is
+    registered and acknowledged, a bare attribution_hash is resolved back to its object.
+    """
+    if data.attribution is not None:
+        return data.attribution, False, {'attribution_ack': await _register_attribution(data.attribution, now)}
+    if data.attribution_hash:
+        attribution = await _lookup_attribution(data.attribution_hash)
+        if attribution is None:
+            return None, False, {'attribution_unknown': True}   # tracker re-sends the full object next time
+        return attribution, True, {}
+    return None, False, {}
+
+
+def _event_contact_fields(kind: str, data: BaseModel, eid: str,
+                          attribution: Optional[dict], user_agent: Optional[str]) -> dict:
+    """The _upsert_contact payload for a pageview / lead / registration event."""
+    fields = {
+        'contact_id': eid, 'session_id': data.session_id,
+        'attribution': attribution, 'user_agent': data.user_agent or user_agent
+    }
+    if kind in ('lead', 'registration'):
+        fields.update({
+            'email': data.email, 'phone': data.phone, 'name': data.name,
+            'first_name': data.first_name, 'last_name': data.last_name,
+        })
+    return fields
+
+
+def _attribution_reply(result: dict) -> dict:
+    """The attribution_ack / attribution_unknown keys of an _apply_track_event result."""
+    return {k: result[k] for k in ('attribution_ack', 'attribution_unknown') if k in result}
+
+
+async def _apply_track_event(kind: str, data: BaseModel, eid: str, now: datetime,
+                             client_ip: Optional[str] = None, user_agent: Optional[str] = None,
+                             event_id: Optional[str] = None) -> dict:
+    """
+    Persist one tracking event for an already-resolved contact_id.
+    Stitching and automations are left to the caller so a batch can run them once per contact.
+    user_agent is the request's User-Agent header; a user_agent in the payload wins.
+    event_id (the ingest journal's id for the event) becomes the visit id.
+    """
+    if kind == 'tag':
+        await _apply_tag(eid, data.tag, data.session_id, now, client_ip)
+        return {"status": "ok", "tag": data.tag}
+
+    attribution, attribution_merged, reply = await _event_attribution(data, now)
+    result: dict = {"status": "ok", **reply}
+    fields = _event_contact_fields(kind, data, eid, attribution, user_agent)
+    await _upsert_contact(fields, now, client_ip, attribution_merged)
+
+    if kind == 'pageview':
+        result['visit_id'] = await _log_visit(eid, data.session_id, data.current_url, data.referrer_url,
+                                              data.page_title, attribution, now, client_ip, event_id,
+                                              data._sample_rate)
+    elif kind == 'registration' and data.current_url:
+        result['visit_id'] = await _log_visit(eid, data.session_id, data.current_url, data.referrer_url,
+                                              data.page_title or "Registration", attribution, now, client_ip,
+                                              event_id)
+    return result
+
+
+# ─── Fast ingest codec ───
+# Tracking bodies are parsed with orjson (when installed) and turned into request
+# models without pydantic validation when they do not need it: for each model a flat
+# spec (field → accepted types, max length) is derived once from its fields, and a
+# body whose values already have exactly the declared types becomes the model via
+# model_construct — no validation pass, no copies.  Anything else (a missing required
+# field, a value pydantic would coerce or reject, a field the spec cannot express)
+# goes through model(**body) as before, so coercions and 422 errors are unchanged.
+# Responses of the /track routes are rendered by orjson as well (_track_response).
+
+def _json_loads(raw):
+    if orjson is not None:
         try:
-            await db.contacts.insert_one(cdoc)
-        except DuplicateKeyError:
-            # Race condition: two concurrent requests both saw "no existing document"
-            # and both tried to insert. The second one wins with a graceful update
-            # instead of crashing the endpoint with a 500.
-            logger.info(f"DuplicateKey on insert for {cid[:12]} — falling back to update")
-            # Re-fetch to check existing values before updating
-            existing_doc = await db.contacts.find_one({"contact_id": cid}, {"_id": 0})
-            update: dict = {"updated_at": dt_to_str(now)}
-            for field in ['name', 'email', 'phone', 'session_id']:
-                if data.get(field):
-                    update[field] = data[field]
-            # Respect first_name/last_name protection even in race condition
-            if parsed_first_name and (not existing_doc or not existing_doc.get('first_name')):
-                update['first_name'] = parsed_first_name
-            if parsed_last_name and (not existing_doc or not existing_doc.get('last_name')):
-                update['last_name'] = parsed_last_name
-            if client_ip:
-                update.setdefault('client_ip', client_ip)
-            await db.contacts.update_one({"contact_id": cid}, {"$set": update})
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass       # NaN, integers past 64 bits, non-UTF-8: leave the verdict to json
+    return json.loads(raw)
+
+
+def _field_spec(info) -> tuple:
+    """(required, accepted types, max length, item model); no accepted types = always validate."""
+    annotation, optional = info.annotation, False
+    if get_origin(annotation) is Union:
+        args = [a for a in get_args(annotation) if a is not type(None)]
+        annotation, optional = (args[0], True) if len(args) == 1 else (None, False)
+    max_len, item_model = None, None
+    for constraint in info.metadata:
+        if not isinstance(constraint, MaxLen):
+            return info.is_required(), (), None, None
+        max_len = constraint.max_length
+    if annotation in (str, int):
+        types = (annotation,)
+    elif get_origin(annotation) is dict and get_args(annotation)[1:] == (Any,):
+        types = (dict,)
+    elif (get_origin(annotation) is list and isinstance(get_args(annotation)[0], type)
+          and issubclass(get_args(annotation)[0], BaseModel)):
+        types, item_model = (list,), get_args(annotation)[0]
+    else:
+        return info.is_required(), (), None, None
+    return info.is_required(), types + ((type(None),) if optional else ()), max_len, item_model
 
 
-async def _log_visit(contact_id: str, session_id: Optional[str],
-                     current_url: str, referrer_url: Optional[str],
-                     page_title: Optional[str], attribution: Optional[dict],
-                     now: datetime, client_ip: Optional[str] = None) -> str:
-    visit = PageVisit(
-        contact_id=contact_id,
-        session_id=session_id,
-        client_ip=client_ip,
-        current_url=current_url,
-        referrer_url=referrer_url,
-        page_title=page_title,
-        attribution=safe_attribution(attribution),
-        timestamp=now
-    )
-    vdoc = strip_nulls(visit.model_dump())
-    vdoc['timestamp'] = dt_to_str(visit.timestamp)
-    await db.page_visits.insert_one(vdoc)
-    return visit.id
+@lru_cache(maxsize=None)
+def _model_spec(model) -> Dict[str, tuple]:
+    return {name: _field_spec(info) for name, info in model.model_fields.items()}
+
+
+def _fits(spec: Dict[str, tuple], body: dict) -> bool:
+    for name, (required, types, max_len, item_model) in spec.items():
+        if name not in body:
+            if required:
+                return False
+            continue
+        value = body[name]
+        if type(value) not in types:
+            return False
+        if value is not None:
+            if max_len is not None and len(value) > max_len:
+                return False
+            if item_model is not None and not all(
+                    type(item) is dict and _fits(_model_spec(item_model), item) for item in value):
+                return False
+    return True
+
+
+def _track_model(model, body: dict):
+    """model(**body), skipping validation when the body already has the declared types."""
+    spec = _model_spec(model)
+    if not _fits(spec, body):
+        return model(**body)
+    values = {}
+    for name, (_, _, _, item_model) in spec.items():
+        if name in body:
+            value = body[name]
+            values[name] = [_track_model(item_model, item) for item in value] if item_model and value else value
+    return model.model_construct(**values)
+
+
+class _TrackJSONResponse(JSONResponse):
+    """JSONResponse rendered by orjson (same compact UTF-8 output), json when it is not installed."""
+
+    def render(self, content: Any) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content)
+
+
+def _track_response(result):
+    """A /track route's result as a response, so FastAPI's jsonable_encoder pass is skipped."""
+    return result if isinstance(result, Response) else _TrackJSONResponse(result)
+
+
+async def _parse_track_body(request: Request) -> dict:
+    """
+    Read a tracking request body regardless of Content-Type.
+
+    The tracker posts JSON as text/plain (a CORS "simple" request, so no OPTIONS
+    preflight) and navigator.sendBeacon() posts strings the same way.  Form posts
+    are accepted too: either a single `payload` field holding JSON, or flat fields.
+    application/json keeps working for server-to-server callers.
+    """
+    content_type = (request.headers.get('content-type') or '').split(';')[0].strip().lower()
+    try:
+        if content_type in ('application/x-www-form-urlencoded', 'multipart/form-data'):
+            form = await request.form()
+            body = _json_loads(form['payload']) if 'payload' in form else {k: v for k, v in form.items()}
+        else:
+            body = _json_loads(await request.body() or b'{}')
+    except Exception:
+        raise HTTPException(status_code=400, detail="Request body must be valid JSON")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="Request body must be a JSON object")
+    return body
+
+
+async def _parse_track_model(request: Request, model):
+    """_parse_track_body + model validation, reporting errors the way FastAPI does (422)."""
+    body = await _parse_track_body(request)
+    try:
+        return _track_model(model, body)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=json.loads(e.json(include_url=False)))
+
+
+# ─── Idempotency keys ───
+# Every tracking event may carry a client event_id.  Retries (fetch → xhr fallback,
+# beacon + fetch) and double-fired submit handlers re-deliver the same event; each
+# copy would otherwise insert another visit and re-run the upsert, the stitch passes
+# and the automations.  Before any work the event is claimed in track_idempotency
+# (unique _id, TTL-indexed): the insert that succeeds owns the event, a duplicate key
+# means it was seen before and gets the stored original response back.  A per-process
+# front cache answers repeats within this worker without a round trip.  A claim is a
+# lease: if its owner died before storing a response (worker killed mid-request), the
+# claim stops blocking retries once it is IDEMPOTENCY_LEASE_SECONDS old and the next
+# delivery takes it over, instead of answering "duplicate" for the full TTL.
+IDEMPOTENCY_TTL_SECONDS = 24 * 3600
+IDEMPOTENCY_LEASE_SECONDS = 60
+IDEMPOTENCY_CACHE_TTL_SECONDS = 600
+IDEMPOTENCY_CACHE_MAX_ENTRIES = 50_000
+
+_IN_PROGRESS: dict = {}                                   # claimed, original response not stored yet
+_idempotency_cache: Dict[str, tuple] = {}                 # key → (expires, response or _IN_PROGRESS)
+_idempotency_stats = {"claimed": 0, "reclaimed": 0, "duplicates": 0, "front_cache_hits": 0, "store_errors": 0}
+
+
+def _idempotency_key(data: BaseModel) -> Optional[str]:
+    event_id = getattr(data, 'event_id', None)
+    return f"{event_id[:64]}:{data.contact_id}" if event_id else None
+
+
+def _idempotency_cache_put(key: str, response: dict, ttl: float = IDEMPOTENCY_CACHE_TTL_SECONDS) -> None:
+    now = time.monotonic()
+    if len(_idempotency_cache) >= IDEMPOTENCY_CACHE_MAX_ENTRIES:
+        for k in [k for k, (exp, _) in _idempotency_cache.items() if exp <= now]:
+            del _idempotency_cache[k]
+        while len(_idempotency_cache) >= IDEMPOTENCY_CACHE_MAX_ENTRIES:
+            _idempotency_cache.pop(next(iter(_idempotency_cache)))
+    _idempotency_cache[key] = (now + ttl, response)
+
+
+async def _idempotency_claim(keys: List[Optional[str]]) -> List[Optional[dict]]:
+    """
+    Claim each keyed event for this request.  Per key: None when the caller now owns the
+    event (or it has no key), else the stored {"status_code", "body"} of the original —
+    _IN_PROGRESS while the original is still being processed.  A claim older than the
+    lease with no stored response is taken over.  Fails open: if the store is
+    unreachable the events are processed as new.
+    """
+    out: List[Optional[dict]] = [None] * len(keys)
+    now = time.monotonic()
+    to_claim: List[int] = []
+    for i, key in enumerate(keys):
+        if key is None:
+            continue
+        hit = _idempotency_cache.get(key)
+        if hit and hit[0] > now:
+            out[i] = hit[1]
+            _idempotency_stats["front_cache_hits"] += 1
+        else:
+            to_claim.append(i)
+    if not to_claim:
+        _idempotency_stats["duplicates"] += sum(1 for r in out if r is not None)
+        return out
+
+    claimed_at = datetime.now(timezone.utc)
+    expire_at = claimed_at + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS)
+    taken: set = set()
+    try:
+        await db.track_idempotency.insert_many(
+            [{"_id": keys[i], "claimed_at": claimed_at, "expire_at": expire_at} for i in to_claim], ordered=False
+        )
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(err.get("code") != 11000 for err in errors):
+            logger.warning(f"Idempotency claim failed, processing as new: {errors[:1]}")
+        taken = {to_claim[err["index"]] for err in errors if err.get("code") == 11000}
+    except Exception as e:
+        logger.warning(f"Idempotency store unavailable, processing as new: {e}")
+        return out
+
+    if taken:
+        stored = await db.track_idempotency.find(
+            {"_id": {"$in": [keys[i] for i in taken]}, "body": {"$exists": True}}, {"expire_at": 0, "claimed_at": 0}
+        ).to_list(None)
+        by_key = {d.pop("_id"): d for d in stored}
+        stale_before = claimed_at - timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)
+        for i in list(taken):
+            out[i] = by_key.get(keys[i], _IN_PROGRESS)
+            if out[i] is not _IN_PROGRESS:
+                _idempotency_cache_put(keys[i], out[i])
+                continue
+            # No response stored: take the claim over if its lease ran out (claims from
+            # before leases existed have no claimed_at and count as expired).  The filter
+            # makes the takeover atomic — of two concurrent retries only one matches.
+            reclaimed = await db.track_idempotency.update_one(
+                {"_id": keys[i], "body": {"$exists": False},
+                 "$or": [{"claimed_at": {"$lt": stale_before}}, {"claimed_at": {"$exists": False}}]},
+                {"$set": {"claimed_at": claimed_at, "expire_at": expire_at}},
+            )
+            if reclaimed.modified_count:
+                out[i] = None
+                taken.discard(i)
+                _idempotency_stats["reclaimed"] += 1
+    for i in to_claim:
+        if i not in taken:
+            # In flight only for the lease: past it, another delivery may own the event
+            _idempotency_cache_put(keys[i], _IN_PROGRESS, IDEMPOTENCY_LEASE_SECONDS)
+            _idempotency_stats["claimed"] += 1
+    _idempotency_stats["duplicates"] += sum(1 for r in out if r is not None)
+    return out
+
+
+async def _write_idempotency(ops: list) -> None:
+    try:
+        await db.track_idempotency.bulk_write(ops, ordered=False)
+    except Exception as e:
+        _idempotency_stats["store_errors"] += len(ops)
+        logger.warning(f"Idempotency store write failed: {e}")
+
+
+def _idempotency_store(keys: List[Optional[str]], bodies: List[dict], status_code: int = 200) -> None:
+    """Record the original responses (front cache now, the store in the background)."""
+    ops = []
+    for key, body in zip(keys, bodies):
+        if key is None:
+            continue
+        response = {"status_code": status_code, "body": body}
+        _idempotency_cache_put(key, response)
+        ops.append(UpdateOne({"_id": key}, {"$set": response}))
+    if ops:
+        asyncio.create_task(_write_idempotency(ops))
+
+
+def _idempotency_release(keys: List[Optional[str]]) -> None:
+    """Drop claims for events that failed, so the client's retry is processed."""
+    keys = [k for k in keys if k is not None]
+    for key in keys:
+        _idempotency_cache.pop(key, None)
+    if keys:
+        asyncio.create_task(_write_idempotency([DeleteOne({"_id": key}) for key in keys]))
+
+
+def _duplicate_body(seen: dict, data: BaseModel) -> dict:
+    """Body answered for a duplicate: the original's, or a stand-in while it is in flight."""
+    return seen.get("body") or {"status": "duplicate", "contact_id": data.contact_id}
+
+
+async def _once(data: BaseModel, handle) -> Any:
+    """Run a single-event route handler at most once per event_id; duplicates get the original response."""
+    key = _idempotency_key(data)
+    if key is None:
+        return await handle()
+    [seen] = await _idempotency_claim([key])
+    if seen is not None:
+        return JSONResponse(status_code=seen.get("status_code", 200), content=_duplicate_body(seen, data))
+    try:
+        response = await handle()
+    except Exception:
+        _idempotency_release([key])
+        raise
+    if isinstance(response, Response):
+        _idempotency_store([key], [json.loads(response.body)], response.status_code)
+    else:
+        _idempotency_store([key], [response])
+    return response
 
 
 async def _do_stitch(parent_id: str, child_id: str, now: datetime) -> dict:
@@ -633,8 +1579,8 @@ async def _do_stitch(parent_id: str, child_id: str, now: datetime) -> dict:
     if parent_id == child_id:
         return {"status": "same", "contact_id": parent_id}
 
-    parent = await db.contacts.find_one({"contact_id": parent_id}, {"_id": 0})
-    child  = await db.contacts.find_one({"contact_id": child_id},  {"_id": 0})
+    parent = await _load_contact(parent_id)
+    child  = await _load_contact(child_id)
 
     if not parent or not child:
         return {"status": "not_found"}
@@ -652,6 +1598,7 @@ async def _do_stitch(parent_id: str, child_id: str, now: datetime) -> dict:
             {"contact_id": old_parent_id},
             {"$pull": {"merged_children": child_id}}
         )
+        _contact_uow_forget(old_parent_id)
         # Re-assign visits back to child temporarily (will be moved to new parent below)
         await db.page_visits.update_many(
             {"contact_id": old_parent_id, "original_contact_id": child_id},
@@ -662,6 +1609,7 @@ async def _do_stitch(parent_id: str, child_id: str, now: datetime) -> dict:
             {"contact_id": child_id},
             {"$unset": {"merged_into": ""}}
         )
+        _contact_uow_set(child_id, {"merged_into": None})
 
     now_str = dt_to_str(now)
 
@@ -677,9 +1625,9 @@ async def _do_stitch(parent_id: str, child_id: str, now: datetime) -> dict:
     if isinstance(child_attr, dict) and child_attr:
         if not parent_attr or not isinstance(parent_attr, dict):
             # Parent has no attribution -- set the whole child attribution at once
-            built = safe_attribution(child_attr)
-            if built:
-                parent_update['attribution'] = strip_nulls(built.model_dump())
+            clean = _clean_attribution(child_attr)
+            if clean:
+                parent_update['attribution'] = clean
         else:
             # Parent already has attribution -- patch missing fields individually
             for k, v in child_attr.items():
@@ -704,6 +1652,7 @@ async def _do_stitch(parent_id: str, child_id: str, now: datetime) -> dict:
     parent_update['merged_children'] = existing_children
 
     await db.contacts.update_one({"contact_id": parent_id}, {"$set": parent_update})
+    _contact_uow_set(parent_id, parent_update)
 
     # Reassign all child visits → parent
     await db.page_visits.update_many(
@@ -711,11 +1660,14 @@ async def _do_stitch(parent_id: str, child_id: str, now: datetime) -> dict:
         {"$set": {"contact_id": parent_id, "original_contact_id": child_id}}
     )
 
-    # Mark child as merged
+    # Mark child as merged, and point it and its own children at the parent's root
     await db.contacts.update_one(
         {"contact_id": child_id},
         {"$set": {"merged_into": parent_id, "updated_at": now_str}}
     )
+    _contact_uow_set(child_id, {"merged_into": parent_id, "updated_at": now_str})
+    root_id = await _resolve_contact_id(parent_id) if parent.get('merged_into') else parent_id
+    await _set_merge_root(child_id, root_id, now)
 
     logger.info(f"Stitched {child_id} → {parent_id}")
     return {"status": "stitched", "parent_contact_id": parent_id, "child_contact_id": child_id}
@@ -738,8 +1690,9 @@ async def _session_auto_stitch(contact_id: str, session_id: Optional[str], now:
 
     if not contacts:
         return
+    _keep_contacts(contacts)
 
-    current = await db.contacts.find_one({"contact_id": contact_id}, {"_id": 0})
+    current = await _load_contact(contact_id)
     if not current or current.get('merged_into'):
         return
 
@@ -776,11 +1729,14 @@ async def _session_auto_stitch(contact_id: str, session_id: Optional[str], now:
                 await _do_stitch(candidate['contact_id'], contact_id, now)
 
         # Refresh current after stitch in case it was merged
-        current = await db.contacts.find_one({"contact_id": contact_id}, {"_id": 0})
+        current = await _load_contact(contact_id)
         if not current or current.get('merged_into'):
             break
 
 
+IP_STITCH_WINDOW_MINUTES = 30
+
+
 async def _ip_auto_stitch(contact_id: str, client_ip: Optional[str], now: datetime) -> None:
     """
     Auto-stitch contacts that share the same IP within a 30-minute window.
@@ -798,7 +1754,7 @@ async def _ip_auto_stitch(contact_id: str, client_ip: Optional[str], now: dateti
     if not client_ip:
         return
 
-    window_start = dt_to_str(now - timedelta(minutes=30))
+    window_start = dt_to_str(now - timedelta(minutes=IP_STITCH_WINDOW_MINUTES))
     candidates = await db.contacts.find({
         "client_ip": client_ip,
         "contact_id": {"$ne": contact_id},
@@ -808,11 +1764,21 @@ async def _ip_auto_stitch(contact_id: str, client_ip: Optional[str], now: dateti
 
     if not candidates:
         return
+    _keep_contacts(candidates)
 
-    current = await db.contacts.find_one({"contact_id": contact_id}, {"_id": 0})
+    current = await _load_contact(contact_id)
     if not current or current.get('merged_into'):
         return
 
+    for candidate in candidates:
+        pair = _ip_stitch_pair(current, candidate)
+        if pair:
+            await _do_stitch(pair[0], pair[1], now)
+            break
+
+
+def _ip_stitch_pair(current: dict, candidate: dict) -> Optional[tuple[str, str]]:
+    """(parent_id, child_id) when _ip_auto_stitch's rules merge these two contacts, else None."""
     def has_real_attribution(c):
         """True only when there are actual UTM/click-ID signals (excludes extra)."""
         attr = c.get('attribution') or {}
@@ -821,31 +1787,25 @@ async def _ip_auto_stitch(contact_id: str, client_ip: Optional[str], now: dateti
     def has_identity(c):
         return bool(c.get('email') or c.get('phone'))
 
-    c_attr  = has_real_attribution(current)
-    c_ident = has_identity(current)
-
-    for candidate in candidates:
-        cand_attr  = has_real_attribution(candidate)
-        cand_ident = has_identity(candidate)
-
-        # ── Rule 1: attribution ↔ identity cross-match ──────────────────────────
-        if c_attr and cand_ident and not c_ident and not cand_attr:
-            await _do_stitch(contact_id, candidate['contact_id'], now)
-            break
-        elif cand_attr and c_ident and not c_attr and not cand_ident:
-            await _do_stitch(candidate['contact_id'], contact_id, now)
-            break
-
-        # ── Rule 2: iframe companion -- attribution-rich + completely anonymous ──
-        # The anonymous side has no real UTMs and no identity (likely an iframe
-        # companion).  Since joinnow.live is only accessible as an iframe on the
-        # landing page, sharing an IP is definitive proof they're the same person.
-        elif c_attr and not cand_attr and not cand_ident:
-            await _do_stitch(contact_id, candidate['contact_id'], now)
-            break
-        elif cand_attr and not c_attr and not c_ident:
-            await _do_stitch(candidate['contact_id'], contact_id, now)
-            break
+    contact_id, candidate_id = current['contact_id'], candidate['contact_id']
+    c_attr, c_ident = has_real_attribution(current), has_identity(current)
+    cand_attr, cand_ident = has_real_attribution(candidate), has_identity(candidate)
+
+    # ── Rule 1: attribution ↔ identity cross-match ──────────────────────────
+    if c_attr and cand_ident and not c_ident and not cand_attr:
+        return contact_id, candidate_id
+    elif cand_attr and c_ident and not c_attr and not cand_ident:
+        return candidate_id, contact_id
+
+    # ── Rule 2: iframe companion -- attribution-rich + completely anonymous ──
+    # The anonymous side has no real UTMs and no identity (likely an iframe
+    # companion).  Since joinnow.live is only accessible as an iframe on the
+    # landing page, sharing an IP is definitive proof they're the same person.
+    elif c_attr and not cand_attr and not cand_ident:
+        return contact_id, candidate_id
+    elif cand_attr and not c_attr and not c_ident:
+        return candidate_id, contact_id
+    return None
 
 
 async def _email_auto_stitch(contact_id: str, email: Optional[str], now: datetime) -> str:
@@ -878,8 +1838,9 @@ async def _email_auto_stitch(contact_id: str, email: Optional[str], now: datetim
     
     if not existing:
         return contact_id
+    _keep_contacts([existing])
     
-    current = await db.contacts.find_one({"contact_id": contact_id}, {"_id": 0})
+    current = await _load_contact(contact_id)
     if not current or current.get('merged_into'):
         return contact_id
     
@@ -1178,7 +2139,7 @@ async def _execute_step_pipeline(
 
 
 async def _run_automations(contact_id: str) -> None:
-    contact = await db.contacts.find_one({"contact_id": contact_id}, {"_id": 0})
+    contact = await _load_contact(contact_id)
     if not contact or not (contact.get('email') or contact.get('phone')):
         return
 
@@ -1311,7 +2272,14 @@ async def _run_automations(contact_id: str) -> None:
 
 # ─────────────────────────── Tracker JS ───────────────────────────
 
-def build_tracker_js(backend_url: str, auto_tag: str = '') -> str:
+def build_tracker_js(backend_url: str, auto_tag: str = '', forms_url: str = '',
+                     rum_sample_rate: float = 0.0) -> str:
+    """
+    Core tracker: ids, attribution, pageviews, tags, the event queue and the iframe
+    handshake.  Form capture is a separate module (build_tracker_forms_js) fetched from
+    forms_url only when the page has something to capture.  rum_sample_rate is the share
+    of page loads that report their timings to /track/rum.
+    """
     return r"""/**
  * Shumard - Lead Attribution & Cross-Frame Identity Script
  * Architecture: Hyros-style field capture + postMessage cross-frame stitching
@@ -1321,7 +2289,31 @@ def build_tracker_js(backend_url: str, auto_tag: str = '') -> str:
 
   var BACKEND_URL = '""" + backend_url + r"""';
   var API_BASE    = BACKEND_URL + '/api';
-  var AUTO_TAG    = '""" + auto_tag + r"""';   /* injected by server when ?tag=... is in script src */
+  var AUTO_TAG    = '""" + auto_tag + r"""' ||   /* injected by server when ?tag=... is in script src */
+                    (window.__shumard_cfg && window.__shumard_cfg.tag) || '';   /* or set by the loader stub */
+  var FORMS_URL   = '""" + forms_url + r"""' || API_BASE + '/shumard-forms.js';   /* content-hashed URL injected by server */
+  var VERSION     = '""" + TRACKER_VERSION + r"""';
+  var T_START     = nowMs();
+
+  /* ─── Field timings (RUM) ───
+     A sampled share of page loads records how long the script took to evaluate and
+     init, how long from init the first pageview took to be acknowledged (queueing and
+     flush delay included: the funnel pays for them), the round trip of the first send
+     (rtt_ms) and how often sends failed, then reports it in one beacon to /track/rum
+     when the page is hidden. */
+  var RUM_SAMPLE_RATE = """ + repr(float(rum_sample_rate)) + r""";
+  var rum = Math.random() < RUM_SAMPLE_RATE ? { m: {}, c: { send_fail: 0, xhr_fallback: 0 }, sent: false } : null;
+  var initStart = 0;
+
+  function sendRum() {
+    if (!rum || rum.sent || !navigator.sendBeacon) return;
+    rum.sent = true;
+    for (var k in rum.m) rum.m[k] = Math.round(rum.m[k] * 10) / 10;
+    try {
+      navigator.sendBeacon(API_BASE + '/track/rum',
+        JSON.stringify({ d: window.location.hostname, v: VERSION, m: rum.m, c: rum.c }));
+    } catch (e) {}
+  }
 
   /* ─── Central store ─── */
   var store = {
@@ -1341,7 +2333,8 @@ def build_tracker_js(backend_url: str, auto_tag: str = '') -> str:
       currentUrl:     window.location.href,
       pageTitle:      document.title || ''
     },
-    processedData: { emailSent: false, phoneSent: false, pageSent: false }
+    processedData: { emailSent: false, phoneSent: false, pageSent: false },
+    perf: { mutationCallbacks: 0, nodesScanned: 0, mutationMs: 0, maxMutationMs: 0, overBudget: 0 }
   };
 
   /* ─── Detect iframe context ─── */
@@ -1507,40 +2500,129 @@ def build_tracker_js(backend_url: str, auto_tag: str = '') -> str:
   }
 
   /* ─── Network ─── */
-  function send(endpoint, payload) {
+  /* JSON is sent as text/plain: a CORS "simple" request, so the browser skips the
+     OPTIONS preflight it would otherwise make before every POST.  The server parses
+     the body as JSON regardless of Content-Type. */
+  var CONTENT_TYPE = 'text/plain;charset=UTF-8';
+
+  /* onResult(json) is best-effort: only called for fetch responses that parse */
+  function send(endpoint, payload, onResult) {
     var url  = API_BASE + endpoint;
     var body = JSON.stringify(payload);
-    var hdrs = { 'Content-Type': 'application/json' };
+    var hdrs = { 'Content-Type': CONTENT_TYPE };
+    var t0   = nowMs();
     if (typeof fetch !== 'undefined') {
-      try { fetch(url, { method: 'POST', headers: hdrs, body: body, keepalive: true }).catch(function () { xhrSend(url, body); }); return; }
-      catch (e) {}
+      try {
+        fetch(url, { method: 'POST', headers: hdrs, body: body, keepalive: true }).then(function (r) {
+          if (rum) { if (!r.ok) rum.c.send_fail++; else if (rum.m.rtt_ms === undefined) rum.m.rtt_ms = nowMs() - t0; }
+          if (onResult && r.ok) r.json().then(onResult, function () {});
+        }, function () { if (rum) rum.c.send_fail++; xhrSend(url, body); });
+        return;
+      } catch (e) {}
     }
     xhrSend(url, body);
   }
 
   function xhrSend(url, body) {
-    try { var x = new XMLHttpRequest(); x.open('POST', url, true); x.setRequestHeader('Content-Type', 'application/json'); x.send(body); }
-    catch (e) {}
+    if (rum) rum.c.xhr_fallback++;
+    try {
+      var x = new XMLHttpRequest(); x.open('POST', url, true); x.setRequestHeader('Content-Type', CONTENT_TYPE);
+      if (rum) x.onerror = function () { rum.c.send_fail++; };
+      x.send(body);
+    } catch (e) {}
   }
 
-  /* ─── Common payload ─── */
-  function buildPayload(extra) {
-    return Object.assign({
-      contact_id:   store.config.contactId,
-      session_id:   store.config.sessionId || null,
-      current_url:  window.location.href,
-      referrer_url: store.config.prevUrl || null,
-      page_title:   document.title || null,
-      attribution:  store.source,
-      user_agent:   navigator.userAgent || null   /* For FB CAPI: client_user_agent */
-    }, extra || {});
+  /* ─── Event queue: events are batched into one /track/batch request ─── */
+  var FLUSH_DELAY_MS = 1000;
+  var MAX_BATCH      = 20;
+  var queue = [], flushTimer = null;
+
+  /* fp: fingerprint of the attribution object in payload, if it carries one */
+  function enqueue(type, payload, fp) {
+    queue.push({ type: type, data: payload, fp: fp || '' });
+    if (queue.length >= MAX_BATCH) { flush(); return; }
+    if (!flushTimer) flushTimer = setTimeout(function () { flush(); }, FLUSH_DELAY_MS);
   }
 
-  /* ─── Tracking calls ─── */
+  /* useBeacon: page is being hidden/unloaded — sendBeacon survives navigation */
+  function flush(useBeacon) {
+    if (flushTimer) { clearTimeout(flushTimer); flushTimer = null; }
+    if (!queue.length) return;
+    var items = queue.splice(0, queue.length), batch = { events: [] };
+    for (var i = 0; i < items.length; i++) batch.events.push({ type: items[i].type, data: items[i].data });
+    if (useBeacon && navigator.sendBeacon) {
+      try { if (navigator.sendBeacon(API_BASE + '/track/batch', JSON.stringify(batch))) return; } catch (e) {}
+    }
+    send('/track/batch', batch, function (res) { onBatchResult(items, res); });
+  }
+
+  /* results[] is in event order -- pick up attribution acknowledgements */
+  function onBatchResult(items, res) {
+    var results = (res && res.results) || [];
+    for (var i = 0; i < items.length && i < results.length; i++) {
+      var r = results[i] || {};
+      if (rum && rum.m.ack_ms === undefined && items[i].type === 'pageview' && (r.status === 'ok' || r.status === 'queued')) rum.m.ack_ms = nowMs() - initStart;
+      if (r.attribution_ack && items[i].fp) saveAttrAck(items[i].data.contact_id, items[i].fp, r.attribution_ack);
+      else if (r.attribution_unknown) saveAttrAck('', '', '');
+    }
+  }
+
+  document.addEventListener('visibilitychange', function () {
+    if (document.visibilityState === 'hidden') { if (forms) forms.flushLead(); flush(true); sendRum(); }
+  });
+  window.addEventListener('pagehide', function () { if (forms) forms.flushLead(); flush(true); sendRum(); });
+
+  /* ─── Attribution fingerprint ───
+     The full attribution object is only sent until the server acknowledges it for this
+     contact (attribution_ack); after that events carry just attribution_hash.  A new
+     fingerprint (e.g. _fbc/_fbp appearing) sends the full object again.  The user agent
+     is not sent at all -- the server reads it from the request's User-Agent header. */
+  var ATTR_ACK_KEY = 'st_attr_ack';
+
+  function fingerprint(str) {   /* FNV-1a, 32 bit */
+    var h = 0x811c9dc5;
+    for (var i = 0; i < str.length; i++) { h ^= str.charCodeAt(i); h = (h + (h << 1) + (h << 4) + (h << 7) + (h << 8) + (h << 24)) >>> 0; }
+    return h.toString(36) + str.length.toString(36);
+  }
+  function loadAttrAck() {
+    try { return JSON.parse(localStorage.getItem(ATTR_ACK_KEY)) || {}; } catch (e) { return {}; }
+  }
+  function saveAttrAck(cid, fp, hash) {
+    try { localStorage.setItem(ATTR_ACK_KEY, JSON.stringify({ c: cid, f: fp, h: hash })); } catch (e) {}
+  }
+
+  /* ─── Common payload ─── */
+  /* Headless-browser hints for the server's bot filter (bits: 1 webdriver, 2 HeadlessChrome UA,
+     4 no languages, 8 zero-size outer window); 0 for a normal browser and then not sent */
+  var HEADLESS = (navigator.webdriver ? 1 : 0) |
+                 (/HeadlessChrome/.test(navigator.userAgent || '') ? 2 : 0) |
+                 (navigator.languages && !navigator.languages.length ? 4 : 0) |
+                 (window.outerWidth === 0 && window.outerHeight === 0 ? 8 : 0);
+
+  function buildPayload(extra) {
+    return Object.assign({
+      contact_id:   store.config.contactId,
+      session_id:   store.config.sessionId || null,
+      current_url:  window.location.href,
+      referrer_url: store.config.prevUrl || null,
+      page_title:   document.title || null,
+      headless:     HEADLESS || undefined
+    }, extra || {});
+  }
+
+  /* Queue an event with either the attribution fingerprint or a snapshot of the full object */
+  function enqueueWithAttribution(type, payload) {
+    var src = JSON.stringify(store.source), fp = fingerprint(src), ack = loadAttrAck();
+    if (ack.h && ack.c === payload.contact_id && ack.f === fp) { payload.attribution_hash = ack.h; fp = ''; }
+    else payload.attribution = JSON.parse(src);
+    enqueue(type, payload, fp);
+  }
+
+  /* ─── Tracking calls ─── */
   function sendPageview() {
     if (store.processedData.pageSent) return;
     store.processedData.pageSent = true;
-    send('/track/pageview', buildPayload());
+    enqueueWithAttribution('pageview', buildPayload({ event_id: genUUID() }));
   }
 
   function sendLead(fields) {
@@ -1558,7 +2640,7 @@ def build_tracker_js(backend_url: str, auto_tag: str = '') -> str:
       if (phone) parts.push('phone: ' + phone);
       logger('Tethered!');
     }
-    send('/track/lead', buildPayload(fields));
+    enqueueWithAttribution('lead', buildPayload(Object.assign({ event_id: genUUID() }, fields)));
   }
 
   function sendRegistration(fields) {
@@ -1573,7 +2655,7 @@ def build_tracker_js(backend_url: str, auto_tag: str = '') -> str:
     if (fields && fields.phone) parts.push('phone: ' + fields.phone);
     if (fields && fields.name)  parts.push('name: ' + fields.name);
     if (parts.length) logger('Tethered!');
-    send('/track/registration', buildPayload(fields));
+    enqueueWithAttribution('registration', buildPayload(Object.assign({ event_id: genUUID() }, fields)));
   }
 
   /* ─── Stitch is now backend-only -- function kept as no-op for public API compat ─── */
@@ -1593,35 +2675,56 @@ def build_tracker_js(backend_url: str, auto_tag: str = '') -> str:
      CROSS-FRAME IDENTITY STITCHING (postMessage bridge)
      ═══════════════════════════════════════════════════════════════
 
-     HOW IT WORKS:
-     1. Parent page broadcasts {type:'st_parent_id', contactId, sessionId} to ALL iframes
-     2. iframe receives this, records parentContactId, updates its session_id,
-        fires stitch API, and replies with its own contactId
-     3. Parent receives child reply and fires stitch API as a double-confirm
-
-     This ensures BOTH ends initiate the stitch even if one message is dropped.
+     HOW IT WORKS (request/response, no timers):
+     1. iframe asks its parent with {type:'st_session_request'} before its first pageview
+     2. Parent answers that one window with {type:'st_parent_id', contactId, sessionId}
+     3. Parent also sends st_parent_id once to each iframe as it loads (existing iframes
+        at init, new ones as the MutationObserver reports them) -- this covers iframes
+        whose request arrived before the parent's tracker was listening
+     4. iframe adopts the parent session_id, then sends its pageview, so both contacts
+        share a session from the first event and _session_auto_stitch can merge them.
+        With no answer within HANDSHAKE_TIMEOUT_MS the iframe proceeds on its own session.
   */
+  var HANDSHAKE_TIMEOUT_MS = 500;
+  var onParentSession = null;   /* iframe: pending start() waiting for the handshake */
 
-  /* ─── Parent: broadcast identity to all child iframes ─── */
-  function broadcastToIframes() {
-    if (store.config.isIframe) return; // don't re-broadcast from iframes
-    var frames = document.querySelectorAll('iframe');
-    if (!frames.length) return;
-    var msg = {
+  function sessionMessage() {
+    return {
       type:      'st_parent_id',
-      contactId: store.config.contactId,
-      sessionId: store.config.sessionId,
-      version:   '2'
+      contactId: store.config.contactId || (store.config.contactId = getContactId()),
+      sessionId: store.config.sessionId || (store.config.sessionId = initSessionId()),
+      version:   '3'
     };
-    frames.forEach(function (f) {
-      try { f.contentWindow.postMessage(msg, '*'); } catch (e) {}
-    });
+  }
+
+  function postSession(win) {
+    try { if (win) win.postMessage(sessionMessage(), '*'); } catch (e) {}
+  }
+
+  /* ─── Parent: send identity to an iframe once it has loaded ─── */
+  function watchIframe(frame) {
+    if (store.config.isIframe || !markBound(frame)) return;
+    frame.addEventListener('load', function () { postSession(frame.contentWindow); });
+    postSession(frame.contentWindow);   /* already loaded (bound at init) */
+  }
+
+  /* ─── iframe: ask the parent for its session, then call done() exactly once ─── */
+  function requestParentSession(done) {
+    if (!store.config.isIframe) { done(); return; }
+    onParentSession = function () { onParentSession = null; done(); };
+    try { window.parent.postMessage({ type: 'st_session_request', version: '3' }, '*'); } catch (e) {}
+    setTimeout(function () { if (onParentSession) onParentSession(); }, HANDSHAKE_TIMEOUT_MS);
   }
 
   /* ─── Handle incoming postMessages ─── */
   window.addEventListener('message', function (e) {
     if (!e.data || typeof e.data !== 'object') return;
 
+    /* Parent: an iframe asked for the session -- answer it directly */
+    if (e.data.type === 'st_session_request' && !store.config.isIframe) {
+      postSession(e.source);
+    }
+
     /*
      * iframe receives parent session_id -- adopt it so the backend can stitch
      * the two contacts together via _session_auto_stitch when a lead/registration
@@ -1633,6 +2736,7 @@ def build_tracker_js(backend_url: str, auto_tag: str = '') -> str:
         store.config.sessionId = parentSess;
         ssSet(SESS_KEY, parentSess);
       }
+      if (onParentSession) onParentSession();
     }
 
     /* Capture form data posted by webinar platform iframes */
@@ -1642,6 +2746,213 @@ def build_tracker_js(backend_url: str, auto_tag: str = '') -> str:
     }
   });
 
+  /* ─── Form-capture module (loaded on demand) ───
+     Field classification, lead coalescing and the submit/field binders live in
+     shumard-forms.js.  Most pages carrying the tracker have no form at all, so the
+     module is only fetched once a form or input shows up in the DOM, or when
+     Shumard.identify / the stealthtrack_email event needs it. */
+  var forms = null, formsLoading = false, formsWaiting = [];
+
+  function loadForms() {
+    if (forms || formsLoading) return;
+    formsLoading = true;
+    try {
+      var s = document.createElement('script');
+      s.async = true;
+      s.src = FORMS_URL;
+      s.onerror = function () { formsLoading = false; };
+      (document.head || document.documentElement).appendChild(s);
+    } catch (e) { formsLoading = false; }
+  }
+  function withForms(fn) {
+    if (forms) { fn(forms); return; }
+    formsWaiting.push(fn);
+    loadForms();
+  }
+  /* Called by shumard-forms.js once it has evaluated */
+  function formsReady(api) {
+    if (forms) return;
+    forms = api;
+    forms.bindTree(document);   /* everything that appeared before the module arrived */
+    var waiting = formsWaiting.splice(0, formsWaiting.length);
+    for (var i = 0; i < waiting.length; i++) { try { waiting[i](forms); } catch (e) {} }
+  }
+
+  /* ─── DOM scanning ───
+     Scanning is incremental: the initial pass walks the document once, after that only
+     nodes reported as added by the MutationObserver are inspected.  Bound elements are
+     remembered in a WeakSet (expando flags on browsers without one); the forms module
+     uses the same set. */
+  var boundEls = typeof WeakSet !== 'undefined' ? new WeakSet() : null;
+  function markBound(el) {
+    if (boundEls) { if (boundEls.has(el)) return false; boundEls.add(el); return true; }
+    if (el._st_bound) return false; el._st_bound = true; return true;
+  }
+  var FIELD_SELECTOR = 'form, input:not([type=hidden]), textarea, select';
+  /* Hand iframes under root the session; bind (or fetch the module for) forms/fields */
+  function scanTree(root) {
+    var tag = (root.tagName || '').toUpperCase();
+    if (tag === 'IFRAME') { watchIframe(root); return; }
+    var hasFields = tag === 'FORM' || tag === 'INPUT' || tag === 'TEXTAREA' || tag === 'SELECT';
+    if (root.querySelectorAll && root.firstElementChild) {   /* leaf: nothing beneath */
+      var frames = root.querySelectorAll('iframe');
+      for (var i = 0; i < frames.length; i++) watchIframe(frames[i]);
+      hasFields = hasFields || root.querySelector(FIELD_SELECTOR) !== null;
+    }
+    if (!hasFields) return;
+    if (forms) forms.bindTree(root); else loadForms();
+  }
+
+  /* ─── MutationObserver ───
+     Each callback only looks at added element nodes and is held to MUTATION_BUDGET_MS of
+     main-thread time; whatever is left over is finished in an idle callback.  The cost is
+     recorded in store.perf (Shumard.store.perf) so it can be checked on real pages. */
+  var MUTATION_BUDGET_MS = 4;
+  var _obs=null, pendingNodes=[], idleScheduled=false;
+  function nowMs() { return (window.performance && performance.now) ? performance.now() : Date.now(); }
+  function scheduleIdle(fn) {
+    if (window.requestIdleCallback) requestIdleCallback(fn, { timeout: 500 }); else setTimeout(fn, 50);
+  }
+  function drainPending() {
+    var t0 = nowMs(), perf = store.perf;
+    while (pendingNodes.length && nowMs() - t0 < MUTATION_BUDGET_MS) {
+      var node = pendingNodes.shift();
+      if (node.isConnected !== false) { scanTree(node); perf.nodesScanned++; }
+    }
+    var dt = nowMs() - t0;
+    perf.mutationCallbacks++;
+    perf.mutationMs += dt;
+    if (dt > perf.maxMutationMs) perf.maxMutationMs = dt;
+    if (pendingNodes.length) {
+      perf.overBudget++;
+      if (!idleScheduled) { idleScheduled = true; scheduleIdle(function(){ idleScheduled = false; drainPending(); }); }
+    }
+  }
+  function watchDOM() {
+    if (_obs||!window.MutationObserver) return;
+    _obs=new MutationObserver(function(mutations){
+      for (var i = 0; i < mutations.length; i++) {
+        var added = mutations[i].addedNodes;
+        for (var j = 0; j < added.length; j++) { if (added[j].nodeType === 1) pendingNodes.push(added[j]); }
+      }
+      if (pendingNodes.length) drainPending();
+    });
+    _obs.observe(document.body,{childList:true,subtree:true});
+  }
+
+  /* ─── Custom event ─── */
+  window.addEventListener('stealthtrack_email', function(e){
+    var em=e.detail&&e.detail.email;
+    if (em) withForms(function(f){ f.captureEmail(em); });
+  });
+
+  /* ─── SPA URL change detection ───
+     history.pushState/replaceState are wrapped and popstate/hashchange observed, so route
+     changes are seen the moment they happen without polling location.href. */
+  (function(){
+    var lastUrl=window.location.href;
+    function onUrlChange(){
+      var cur=window.location.href;
+      if (cur!==lastUrl){
+        lastUrl=cur; store.config.prevUrl=store.config.currentUrl; store.config.currentUrl=cur;
+        store.processedData.pageSent=false; sendPageview();
+      }
+    }
+    ['pushState', 'replaceState'].forEach(function(m){
+      var orig = window.history && history[m];
+      if (typeof orig !== 'function') return;
+      history[m] = function(){ var r = orig.apply(this, arguments); onUrlChange(); return r; };
+    });
+    window.addEventListener('popstate', onUrlChange);
+    window.addEventListener('hashchange', onUrlChange);
+  })();
+
+  /* ─── Init ─── */
+  function init() {
+    initStart = nowMs();
+    store.config.contactId = getContactId();
+    store.config.sessionId = initSessionId();
+    captureAttribution();
+    scanTree(document);   /* also hands the session to iframes already on the page */
+    watchDOM();
+    requestParentSession(start);
+
+    /* ─── Delayed fbc/fbp re-capture ─── */
+    /* Facebook Pixel often sets _fbc/_fbp cookies AFTER initial page load.
+       Re-check cookies after a delay to capture them if FB Pixel was slow. */
+    setTimeout(function() {
+      var fbc = getCookie('_fbc');
+      var fbp = getCookie('_fbp');
+      if ((fbc && store.source.fbc !== fbc) || (fbp && store.source.fbp !== fbp)) {
+        if (fbc) store.source.fbc = fbc;
+        if (fbp) store.source.fbp = fbp;
+        lsSet(ATTR_KEY, JSON.stringify(store.source));
+        logger('FB cookies captured (delayed)', {fbc: fbc, fbp: fbp});
+      }
+    }, 2000);  /* 2 second delay for FB Pixel to set cookies */
+    if (rum) rum.m.init_ms = nowMs() - initStart;
+  }
+
+  /* ─── First events: run once the iframe handshake (if any) has settled the session ─── */
+  function start() {
+    sendPageview();
+
+    /* ─── Auto-tag: fire when script was loaded with ?tag=... ─── */
+    if (AUTO_TAG) {
+      enqueue('tag', {
+        contact_id: store.config.contactId,
+        session_id: store.config.sessionId || null,
+        tag:        AUTO_TAG,
+        event_id:   genUUID(),
+        headless:   HEADLESS || undefined
+      });
+      logger('Tethered!');
+    }
+  }
+
+  if (document.readyState === 'loading') {
+    document.addEventListener('DOMContentLoaded', init);
+  } else {
+    init();
+  }
+
+  /* ─── Public API ─── */
+  var queued = (window.Shumard && window.Shumard._q) || [];   /* calls made against the loader stub */
+  window.Shumard = {
+    getContactId:  getContactId,
+    getSessionId:  function(){ return store.config.sessionId; },
+    identify: function(fields){
+      if (fields && fields.email) withForms(function(f){ f.identify(fields); });
+    },
+    stitch:    sendStitch,
+    trackEvent: sendLead,
+    store:     store,
+    /* internal: the hooks shumard-forms.js attaches to */
+    _core: { store: store, sendLead: sendLead, sendRegistration: sendRegistration, flush: flush,
+             markBound: markBound, formsReady: formsReady }
+  };
+  queued.forEach(function (call) {
+    try { window.Shumard[call[0]].apply(window.Shumard, call[1]); } catch (e) {}
+  });
+
+  if (rum) rum.m.eval_ms = nowMs() - T_START;
+})();
+"""
+
+
+def build_tracker_forms_js() -> str:
+    """
+    Form-capture module for the core tracker.  Loaded on demand by build_tracker_js
+    output; attaches to window.Shumard._core and reports back through formsReady().
+    """
+    return r"""/* Shumard forms */
+(function () {
+  'use strict';
+
+  var core = window.Shumard && window.Shumard._core;
+  if (!core) return;
+  var store = core.store;
+
   /* ─── Field detection ─── */
   var CLASSES = {
     email:     ['st-email', 'hyros-email'],
@@ -1689,41 +3000,44 @@ def build_tracker_js(backend_url: str, auto_tag: str = '') -> str:
     var ft = classifyInput(el); if (!ft) return;
     var val = (el.value||'').trim(); if (!val) return;
 
-    /* Helper: build name from whatever is already stored */
-    function storedName() {
-      return store.lead.name || ((store.lead.firstName+' '+store.lead.lastName).trim()) || null;
-    }
+    if (ft==='email') { if (!isEmail(val)) return; store.lead.email = val; }
+    else if (ft==='phone') { if (!isPhone(val)) return; store.lead.phone = val; }
+    else if (ft==='firstName') store.lead.firstName = val;
+    else if (ft==='lastName')  store.lead.lastName  = val;
+    else if (ft==='name')      store.lead.name      = val;
+    if (store.lead.email || store.lead.phone) scheduleLead();
+  }
 
-    if (ft==='email' && isEmail(val) && val!==store.lead.email) {
-      store.lead.email = val;
-      var p = { email: val };
-      var n = storedName(); if (n) p.name = n;
-      if (store.lead.firstName) p.first_name = store.lead.firstName;
-      if (store.lead.lastName)  p.last_name  = store.lead.lastName;
-      sendLead(p);
-    }
-    else if (ft==='phone' && isPhone(val) && val!==store.lead.phone) {
-      store.lead.phone = val;
-      var pp = { phone: val };
-      if (store.lead.email) pp.email = store.lead.email;
-      var pn = storedName(); if (pn) pp.name = pn;
-      sendLead(pp);
-    }
-    else if (ft==='firstName') {
-      store.lead.firstName = val;
-      if (store.lead.email || store.lead.phone)
-        sendLead({ email: store.lead.email||null, phone: store.lead.phone||null, first_name: val, name: storedName() });
-    }
-    else if (ft==='lastName') {
-      store.lead.lastName = val;
-      if (store.lead.email || store.lead.phone)
-        sendLead({ email: store.lead.email||null, phone: store.lead.phone||null, last_name: val, name: storedName() });
-    }
-    else if (ft==='name') {
-      store.lead.name = val;
-      if (store.lead.email || store.lead.phone)
-        sendLead({ email: store.lead.email||null, phone: store.lead.phone||null, name: val });
-    }
+  /* ─── Lead coalescing ───
+     change + blur (and typing through several fields) used to emit one /track/lead per
+     event.  Captures are now debounced and a lead is only sent when the identity
+     (email/phone/name) actually differs from the last one sent. */
+  var LEAD_DEBOUNCE_MS = 700;
+  var leadTimer = null, lastLeadKey = '', lastRegKey = '';
+
+  function leadFields() {
+    var l = store.lead, p = {};
+    if (l.email) p.email = l.email;
+    if (l.phone) p.phone = l.phone;
+    var n = l.name || ((l.firstName+' '+l.lastName).trim()); if (n) p.name = n;
+    if (l.firstName) p.first_name = l.firstName;
+    if (l.lastName)  p.last_name  = l.lastName;
+    return p;
+  }
+  function identityKey(p) {
+    return [p.email, p.phone, p.name, p.first_name, p.last_name].join('|').toLowerCase();
+  }
+  function scheduleLead() {
+    if (leadTimer) clearTimeout(leadTimer);
+    leadTimer = setTimeout(flushLead, LEAD_DEBOUNCE_MS);
+  }
+  function flushLead() {
+    if (leadTimer) { clearTimeout(leadTimer); leadTimer = null; }
+    if (!store.lead.email && !store.lead.phone) return;
+    var p = leadFields(), key = identityKey(p);
+    if (key === lastLeadKey) return;
+    lastLeadKey = key;
+    core.sendLead(p);
   }
 
   /* ─── Form submit ─── */
@@ -1737,30 +3051,35 @@ def build_tracker_js(backend_url: str, auto_tag: str = '') -> str:
       if (ft==='name')                  store.lead.name=v;
     });
     if (!store.lead.email && !store.lead.phone) return;
-    var fullName = store.lead.name || ((store.lead.firstName+' '+store.lead.lastName).trim()) || null;
-    sendRegistration({ email:store.lead.email||null, phone:store.lead.phone||null, name:fullName, first_name:store.lead.firstName||null, last_name:store.lead.lastName||null });
+    /* submit listener + submit-button click both land here — one registration per identity */
+    var p = leadFields(), key = identityKey(p);
+    if (key === lastRegKey) return;
+    lastRegKey = lastLeadKey = key;
+    if (leadTimer) { clearTimeout(leadTimer); leadTimer = null; }   /* registration carries the same identity */
+    core.sendRegistration({ email:p.email||null, phone:p.phone||null, name:p.name||null, first_name:p.first_name||null, last_name:p.last_name||null });
   }
 
   /* ─── Form binding ─── */
-  function bindInputListeners(form) {
-    if (!form||form._st_inputs_bound) return; form._st_inputs_bound=true;
-    form.querySelectorAll('input, textarea, select').forEach(function (el) {
-      if (el._st_bound) return; el._st_bound=true;
-      el.addEventListener('change', function(){handleFieldChange(el);}, true);
-      el.addEventListener('blur',   function(){handleFieldChange(el);}, true);
-    });
+  function bindField(el) {
+    if (el.tagName.toUpperCase() === 'SELECT' && !el.form) return;   /* loose selects were never captured */
+    if (!core.markBound(el)) return;
+    el.addEventListener('change', function(){handleFieldChange(el);}, true);
+    el.addEventListener('blur',   function(){handleFieldChange(el);}, true);
   }
   function bindSubmitListener(form) {
-    if (!form||form._st_submit_bound) return; form._st_submit_bound=true;
+    if (!core.markBound(form)) return;
     form.addEventListener('submit', function(){setTimeout(function(){handleFormSubmit(form);},0);}, true);
   }
-  function bindForms() { document.querySelectorAll('form').forEach(function(f){bindInputListeners(f);bindSubmitListener(f);}); }
-  function bindLooseInputs() {
-    document.querySelectorAll('input, textarea').forEach(function(el){
-      if (el.form||el._st_bound) return; el._st_bound=true;
-      el.addEventListener('change', function(){handleFieldChange(el);}, true);
-      el.addEventListener('blur',   function(){handleFieldChange(el);}, true);
-    });
+  /* Bind root itself (if it is a form or field) and every form/field beneath it */
+  function bindTree(root) {
+    var tag = (root.tagName || '').toUpperCase();
+    if (tag === 'FORM') bindSubmitListener(root);
+    else if (tag === 'INPUT' || tag === 'TEXTAREA' || tag === 'SELECT') { bindField(root); return; }
+    if (!root.querySelectorAll || root.firstElementChild === null) return;   /* leaf: nothing beneath */
+    var list = root.querySelectorAll('form'), i;
+    for (i = 0; i < list.length; i++) bindSubmitListener(list[i]);
+    list = root.querySelectorAll('input, textarea, select');
+    for (i = 0; i < list.length; i++) bindField(list[i]);
   }
 
   /* ─── Click capture for SPA submit buttons ─── */
@@ -1775,96 +3094,948 @@ def build_tracker_js(backend_url: str, auto_tag: str = '') -> str:
     }
   }, {capture:true, passive:true});
 
-  /* ─── MutationObserver ─── */
-  var _obs=null;
-  function watchDOM() {
-    if (_obs||!window.MutationObserver) return;
-    _obs=new MutationObserver(function(){bindForms();bindLooseInputs();});
-    _obs.observe(document.body,{childList:true,subtree:true});
-  }
-
-  /* ─── Custom event ─── */
-  window.addEventListener('stealthtrack_email', function(e){
-    var em=e.detail&&e.detail.email;
-    if (em&&isEmail(em)&&em!==store.lead.email){store.lead.email=em;sendLead({email:em});}
+  core.formsReady({
+    bindTree:  bindTree,
+    flushLead: flushLead,
+    captureEmail: function (em) {
+      if (isEmail(em) && em !== store.lead.email) { store.lead.email = em; scheduleLead(); }
+    },
+    identify: function (fields) {
+      if (isEmail(fields.email)) { store.lead.email = fields.email; core.sendLead(fields); core.flush(); }
+    }
   });
+})();
+"""
 
-  /* ─── SPA URL change detection ─── */
-  (function(){
-    var lastUrl=window.location.href;
-    setInterval(function(){
-      var cur=window.location.href;
-      if (cur!==lastUrl){
-        lastUrl=cur; store.config.prevUrl=store.config.currentUrl; store.config.currentUrl=cur;
-        store.processedData.pageSent=false; sendPageview(); bindForms(); bindLooseInputs();
-      }
-    }, 800);
-  })();
 
-  /* ─── Init ─── */
-  function init() {
-    store.config.contactId = getContactId();
-    store.config.sessionId = initSessionId();
-    captureAttribution();
-    bindForms();
-    bindLooseInputs();
-    watchDOM();
-    sendPageview();
+def build_tracker_loader_js(core_url: str) -> str:
+    """
+    Tiny loader for the split delivery mode.  It is identical for every page, reads the
+    tag from the script element's data-tag (or ?tag=) at runtime, queues calls made to
+    window.Shumard before the core arrives, and injects the content-hashed core script.
+    """
+    return r"""/* Shumard loader */
+(function (w, d) {
+  if (w.Shumard) return;
+  var s = d.currentScript, t = '', q = [];
+  if (s) t = s.getAttribute('data-tag') || (/[?&]tag=([^&#]*)/.exec(s.src) || [])[1] || '';
+  try { t = decodeURIComponent(t); } catch (e) {}
+  w.__shumard_cfg = { tag: t.replace(/[^a-zA-Z0-9_\-]/g, '').slice(0, 64) };
+  function stub(n) { return function () { q.push([n, [].slice.call(arguments)]); }; }
+  function get(k, st) { try { return w[st].getItem(k); } catch (e) { return null; } }
+  w.Shumard = { _q: q, identify: stub('identify'), trackEvent: stub('trackEvent'), stitch: stub('stitch'),
+    getContactId: function () { return get('st_contact_id', 'localStorage'); },
+    getSessionId: function () { return get('st_session_id', 'sessionStorage'); } };
+  var c = d.createElement('script');
+  c.async = true;
+  c.src = '""" + core_url + r"""';
+  (d.head || d.documentElement).appendChild(c);
+})(window, document);
+"""
 
-    /* ─── Delayed fbc/fbp re-capture ─── */
-    /* Facebook Pixel often sets _fbc/_fbp cookies AFTER initial page load.
-       Re-check cookies after a delay to capture them if FB Pixel was slow. */
-    setTimeout(function() {
-      var fbc = getCookie('_fbc');
-      var fbp = getCookie('_fbp');
-      if ((fbc && store.source.fbc !== fbc) || (fbp && store.source.fbp !== fbp)) {
-        if (fbc) store.source.fbc = fbc;
-        if (fbp) store.source.fbp = fbp;
-        lsSet(ATTR_KEY, JSON.stringify(store.source));
-        logger('FB cookies captured (delayed)', {fbc: fbc, fbp: fbp});
-      }
-    }, 2000);  /* 2 second delay for FB Pixel to set cookies */
 
-    /* ─── Auto-tag: fire when script was loaded with ?tag=... ─── */
-    if (AUTO_TAG) {
-      send('/track/tag', {
-        contact_id: store.config.contactId,
-        session_id: store.config.sessionId || null,
-        tag:        AUTO_TAG
-      });
-      logger('Tethered!');
+_JS_ID_CHARS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_$')
+_JS_REGEX_AFTER = frozenset('(,=:[!&|?{};+-*%<>~^')
+_JS_REGEX_KEYWORDS = ('return', 'typeof', 'case', 'do', 'else', 'in', 'of', 'new', 'delete', 'void', 'throw')
+_JS_NEWLINE_DROP_AFTER = frozenset('{[(,;:=&|?*<>!~^%')
+_JS_NEWLINE_DROP_BEFORE = frozenset(')]},;.?:=')
+
+
+def minify_js(src: str) -> str:
+    """
+    Conservative minifier for the tracker template: strips comments and indentation and
+    collapses whitespace.  Strings and regex literals are copied verbatim and identifiers are
+    left alone, so the BACKEND_URL/AUTO_TAG injection and the window.Shumard API survive.
+    A newline is only dropped where it cannot affect automatic semicolon insertion.
+    """
+    out: List[str] = []
+    i, n = 0, len(src)
+    pending = ''          # '' | ' ' | '\n' — whitespace seen since the last token
+
+    def last() -> str:
+        return out[-1][-1] if out else ''
+
+    def emit(tok: str) -> None:
+        nonlocal pending
+        if pending and out:
+            prev, nxt = last(), tok[0]
+            if pending == '\n' and prev not in _JS_NEWLINE_DROP_AFTER and nxt not in _JS_NEWLINE_DROP_BEFORE:
+                out.append('\n')
+            elif (prev in _JS_ID_CHARS and nxt in _JS_ID_CHARS) or (prev == nxt and prev in '+-'):
+                out.append(' ')
+        pending = ''
+        out.append(tok)
+
+    def regex_allowed() -> bool:
+        prev = last()
+        if not prev or prev in _JS_REGEX_AFTER:
+            return True
+        tail = ''.join(out[-3:])
+        return any(tail.endswith(k) and (len(tail) == len(k) or tail[-len(k) - 1] not in _JS_ID_CHARS)
+                   for k in _JS_REGEX_KEYWORDS)
+
+    while i < n:
+        c = src[i]
+        if c in ' \t\r\n':
+            if c == '\n' or pending == '\n':
+                pending = '\n'
+            elif not pending:
+                pending = ' '
+            i += 1
+        elif src.startswith('/*', i):
+            end = src.find('*/', i + 2)
+            end = n if end < 0 else end + 2
+            if '\n' in src[i:end]:
+                pending = '\n'
+            elif not pending:
+                pending = ' '
+            i = end
+        elif src.startswith('//', i):
+            end = src.find('\n', i)
+            i = n if end < 0 else end
+        elif c in '\'"`':
+            j = i + 1
+            while j < n and src[j] != c:
+                j += 2 if src[j] == '\\' else 1
+            emit(src[i:j + 1])
+            i = j + 1
+        elif c == '/' and regex_allowed():
+            j, in_class = i + 1, False
+            while j < n and (in_class or src[j] != '/'):
+                if src[j] == '\\':
+                    j += 1
+                elif src[j] == '[':
+                    in_class = True
+                elif src[j] == ']':
+                    in_class = False
+                j += 1
+            j += 1
+            while j < n and src[j] in _JS_ID_CHARS:   # flags
+                j += 1
+            emit(src[i:j])
+            i = j
+        else:
+            j = i + 1
+            if c in _JS_ID_CHARS:
+                while j < n and src[j] in _JS_ID_CHARS:
+                    j += 1
+            emit(src[i:j])
+            i = j
+    return ''.join(out) + '\n'
+
+
+# ─────────────────────────── Tracker asset cache ───────────────────────────
+#
+# shumard.js is the most requested route we have (every page load of every funnel
+# page).  The rendered script only depends on (backend URL, tag, template version),
+# so it is built and compressed once per key and then served from memory.  Browsers
+# and proxies get an ETag and a short max-age, so repeat views cost a 304.
+
+TRACKER_VERSION = '2.13.0'          # bump whenever the tracker JS output changes
+TRACKER_CACHE_MAX_ENTRIES = 512    # tags come from the URL — keep the cache bounded
+TRACKER_CACHE_CONTROL = "public, max-age=300, stale-while-revalidate=86400"
+TRACKER_IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+TRACKER_GZIP_BUDGET_BYTES = 6 * 1024   # minified + gzipped core; enforced by tests/test_tracker_size.py
+TRACKER_FORMS_GZIP_BUDGET_BYTES = 3 * 1024   # the lazily loaded form-capture module
+TRACKER_RUM_SAMPLE_RATE = float(os.environ.get('TRACKER_RUM_SAMPLE_RATE', '0.05'))   # 0 disables field timings
+
+_tracker_asset_cache: Dict[tuple, dict] = {}
+
+
+def _sanitize_script_tag(tag: Optional[str]) -> str:
+    """Alphanumeric + dash/underscore, max 64 chars — safe to inject into the JS source."""
+    if not tag:
+        return ''
+    return re.sub(r'[^a-zA-Z0-9_\-]', '', tag)[:64]
+
+
+def _cached_tracker_asset(key: tuple, render) -> dict:
+    """
+    Return the cached asset for key, rendering it with render() on a miss:
+    {'hash': str, 'etag': str, 'identity': bytes, 'gzip': bytes, 'br': Optional[bytes]}.
+    Compression happens once per key, never per request.
+    """
+    asset = _tracker_asset_cache.get(key)
+    if asset is not None:
+        return asset
+
+    body = render().encode('utf-8')
+    digest = hashlib.sha256(body).hexdigest()
+    asset = {
+        'hash':     digest[:16],
+        'etag':     '"' + digest[:32] + '"',
+        'identity': body,
+        'gzip':     gzip.compress(body, compresslevel=9),
+        'br':       brotli.compress(body, quality=11) if brotli else None,
     }
+    # Evict the oldest entry (dicts keep insertion order) once the cap is reached
+    if len(_tracker_asset_cache) >= TRACKER_CACHE_MAX_ENTRIES:
+        _tracker_asset_cache.pop(next(iter(_tracker_asset_cache)), None)
+    _tracker_asset_cache[key] = asset
+    return asset
+
+
+def _get_forms_asset(debug: bool = False) -> dict:
+    """Form-capture module, fetched by the core only on pages that have forms."""
+    return _cached_tracker_asset(
+        ('forms', debug, TRACKER_VERSION),
+        lambda: build_tracker_forms_js() if debug else minify_js(build_tracker_forms_js()),
+    )
+
 
-    /* Parent page: broadcast session identity to iframes */
-    if (!store.config.isIframe) {
-      var broadcastCount = 0;
-      var broadcastInterval = setInterval(function () {
-        broadcastToIframes();
-        if (++broadcastCount >= 30) clearInterval(broadcastInterval);
-      }, 1000);
+def _get_tracker_asset(backend_url: str, safe_tag: str, debug: bool = False) -> dict:
+    """
+    Core tracker with the tag baked in.  safe_tag='' is the tag-neutral core.
+    Minified unless debug=True (?debug=1), which serves the readable template.
+    The core points at the content-hashed forms module, so it is keyed by that hash.
+    """
+    forms = _get_forms_asset(debug)
+    forms_url = f"{backend_url}/api/shumard-forms.{forms['hash']}.js" + ('?debug=1' if debug else '')
+    return _cached_tracker_asset(
+        ('tracker', backend_url, safe_tag, forms['hash'], debug, TRACKER_VERSION),
+        lambda: build_tracker_js(backend_url, safe_tag, forms_url, TRACKER_RUM_SAMPLE_RATE) if debug
+        else minify_js(build_tracker_js(backend_url, safe_tag, forms_url, TRACKER_RUM_SAMPLE_RATE)),
+    )
+
+
+def _get_loader_asset(backend_url: str, debug: bool = False) -> dict:
+    """Loader stub pointing at the current content-hashed core URL."""
+    core = _get_tracker_asset(backend_url, '', debug)
+    core_url = f"{backend_url}/api/shumard.{core['hash']}.js" + ('?debug=1' if debug else '')
+    return _cached_tracker_asset(
+        ('loader', backend_url, core['hash'], debug, TRACKER_VERSION),
+        lambda: build_tracker_loader_js(core_url) if debug else minify_js(build_tracker_loader_js(core_url)),
+    )
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """RFC 7232 weak comparison of an If-None-Match header against our ETag."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def _pick_encoding(accept_encoding: Optional[str], asset: dict) -> str:
+    """Choose br > gzip > identity based on the client's Accept-Encoding header."""
+    accepted = set()
+    for part in (accept_encoding or '').split(','):
+        token, _, params = part.strip().partition(';')
+        token = token.strip().lower()
+        if not token:
+            continue
+        q = params.strip()
+        if q.startswith('q='):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                pass
+        accepted.add(token)
+    if asset.get('br') and ('br' in accepted or '*' in accepted):
+        return 'br'
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    return 'identity'
+
+
+def _tracker_response(request: Request, asset: dict, cache_control: str) -> Response:
+    """Serve a cached tracker asset with ETag revalidation and content negotiation."""
+    headers = {
+        "Cache-Control":               cache_control,
+        "ETag":                        asset['etag'],
+        "Vary":                        "Accept-Encoding",
+        "Access-Control-Allow-Origin": "*",
     }
-  }
+    if _etag_matches(request.headers.get('if-none-match'), asset['etag']):
+        return Response(status_code=304, headers=headers)
+
+    encoding = _pick_encoding(request.headers.get('accept-encoding'), asset)
+    if encoding != 'identity':
+        headers["Content-Encoding"] = encoding
+    return Response(
+        content=asset[encoding],
+        media_type="application/javascript; charset=utf-8",
+        headers=headers,
+    )
+
+
+# ─────────────────────────── Tracker RUM telemetry ───────────────────────────
+#
+# Sampled tracker page loads beacon a handful of timings to /track/rum.  Nothing raw is
+# stored: each report is folded into per-minute, per-domain histograms (fixed ms buckets)
+# with $inc, so the two workers and every browser add into the same documents.
+
+RUM_TIMING_METRICS = ('eval_ms', 'init_ms', 'ack_ms', 'rtt_ms')
+RUM_COUNTERS = ('send_fail', 'xhr_fallback')
+RUM_BUCKETS_MS = (1, 2, 3, 5, 7, 10, 15, 20, 30, 50, 70, 100, 150, 200, 300, 500, 700,
+                  1000, 1500, 2000, 3000, 5000, 7000, 10000, 15000, 30000)   # upper bounds
+RUM_MAX_MS = 600_000
+RUM_RETENTION_DAYS = 14
+_RUM_DOMAIN_RE = re.compile(r'^[a-z0-9.\-]{1,253}$')
+
+
+def _rum_bucket(value_ms: float) -> int:
+    """Index of the first bucket whose upper bound holds value_ms (len(RUM_BUCKETS_MS) = overflow)."""
+    for i, bound in enumerate(RUM_BUCKETS_MS):
+        if value_ms <= bound:
+            return i
+    return len(RUM_BUCKETS_MS)
+
+
+def _rum_percentile(buckets: Dict[str, int], count: int, q: float) -> Optional[float]:
+    """Estimate the q-quantile from bucket counts, interpolating linearly inside the bucket."""
+    if not count:
+        return None
+    rank = q * count
+    seen = 0
+    for i in range(len(RUM_BUCKETS_MS) + 1):
+        n = buckets.get(str(i), 0)
+        if n and seen + n >= rank:
+            lower = RUM_BUCKETS_MS[i - 1] if i else 0
+            if i == len(RUM_BUCKETS_MS):
+                return float(lower)
+            return round(lower + (RUM_BUCKETS_MS[i] - lower) * (rank - seen) / n, 1)
+        seen += n
+    return float(RUM_BUCKETS_MS[-1])
+
+
+def _rum_updates(report: TrackerRumReport, now: datetime) -> List[UpdateOne]:
+    """One $inc upsert per metric/counter in the report; unknown keys and absurd values are dropped."""
+    domain = report.d.strip().lower()
+    if domain.startswith('www.'):
+        domain = domain[4:]
+    if not _RUM_DOMAIN_RE.match(domain):
+        return []
+    minute = dt_to_str(now.replace(second=0, microsecond=0))
+    expire_at = now + timedelta(days=RUM_RETENTION_DAYS)
+    version = re.sub(r'[^0-9a-zA-Z.\-]', '', report.v or '') or None
+
+    ops: List[UpdateOne] = []
+    for metric in RUM_TIMING_METRICS:
+        value = report.m.get(metric)
+        if value is None or not (0 <= value <= RUM_MAX_MS):
+            continue
+        ops.append(UpdateOne(
+            {"minute": minute, "domain": domain, "version": version, "metric": metric},
+            {"$inc": {"count": 1, "sum": value, f"buckets.{_rum_bucket(value)}": 1},
+             "$setOnInsert": {"expire_at": expire_at}},
+            upsert=True,
+        ))
+    for counter in RUM_COUNTERS:
+        value = report.c.get(counter)
+        if value is None or not (0 <= value <= 1000):
+            continue
+        ops.append(UpdateOne(
+            {"minute": minute, "domain": domain, "version": version, "metric": counter},
+            {"$inc": {"count": 1, "sum": value}, "$setOnInsert": {"expire_at": expire_at}},
+            upsert=True,
+        ))
+    return ops
+
+
+# ─────────────────────────── Bot filtering ───────────────────────────
+#
+# Link previewers, uptime checkers and scrapers load funnel pages and run the tracker.
+# Their pageviews and tags are classified before any database work — user-agent
+# patterns (verdicts memoised per UA string), known datacenter / crawler IP ranges
+# (BOT_DATACENTER_RANGES_FILE) and headless-browser hints the tracker sends — and
+# counted into bot_traffic per day / reason / domain instead of being written.
+# Leads and registrations are never filtered: they carry identity and drive automations.
+# Nothing from a trusted caller is filtered either: our own form backends replay
+# events with HTTP-library user agents (or none) from server addresses.  The datacenter
+# check uses the address our proxy saw (verified_client_ip), not a client-written one.
+
+BOT_FILTER = os.environ.get('BOT_FILTER', '1').lower() not in ('0', 'false', 'no', 'off')
+BOT_FILTERED_EVENTS = ('pageview', 'tag')
+BOT_DATACENTER_RANGES_FILE = os.environ.get('BOT_DATACENTER_RANGES_FILE', str(ROOT_DIR / 'datacenter_ranges.txt'))
+BOT_UA_CACHE_SIZE = 4096
+BOT_STATS_FLUSH_SECONDS = 60
+BOT_STATS_RETENTION_DAYS = 90
+
+BOT_UA_PATTERN = re.compile(
+    r"bot\b|crawl|spider|slurp|facebookexternalhit|facebookcatalog|meta-externalagent|embedly|"
+    r"preview|headlesschrome|phantomjs|puppeteer|playwright|selenium|lighthouse|pagespeed|"
+    r"pingdom|uptime|statuscake|site24x7|monitor|python-requests|python-urllib|aiohttp|httpx|"
+    r"go-http-client|okhttp|java/|curl/|wget/|libwww|scrapy|axios/|node-fetch|"
+    r"bingpreview|whatsapp|telegrambot|slackbot|discordbot|twitterbot|linkedinbot|skypeuripreview",
+    re.IGNORECASE,
+)
+
+# Tracker hint bits (see the core's HEADLESS): webdriver and a HeadlessChrome UA are
+# conclusive; no languages and a zero-size outer window only together.
+HEADLESS_WEBDRIVER, HEADLESS_UA, HEADLESS_NO_LANGUAGES, HEADLESS_NO_WINDOW = 1, 2, 4, 8
+
+_bot_counts: Dict[tuple, int] = defaultdict(int)      # (day, reason, domain) → not yet flushed
+_datacenter_ranges: Dict[int, tuple] = {4: ([], []), 6: ([], [])}   # version → (starts, ends), merged
+
+
+def _load_datacenter_ranges(path: str) -> int:
+    """Read CIDRs (one per line, # comments) into sorted, merged integer ranges; returns the count."""
+    spans: Dict[int, list] = {4: [], 6: []}
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if not line:
+                    continue
+                try:
+                    net = ipaddress.ip_network(line, strict=False)
+                except ValueError:
+                    logger.warning(f"Bot filter: skipping bad range {line!r} in {path}")
+                    continue
+                spans[net.version].append((int(net.network_address), int(net.broadcast_address)))
+    except FileNotFoundError:
+        logger.info(f"Bot filter: no datacenter ranges file at {path}")
+        return 0
+    count = 0
+    for version, ranges in spans.items():
+        starts, ends = [], []
+        for start, end in sorted(ranges):
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        _datacenter_ranges[version] = (starts, ends)
+        count += len(ranges)
+    return count
+
+
+def _in_datacenter(ip: str) -> bool:
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    starts, ends = _datacenter_ranges[addr.version]
+    i = bisect.bisect_right(starts, int(addr)) - 1
+    return i >= 0 and int(addr) <= ends[i]
+
+
+@lru_cache(maxsize=BOT_UA_CACHE_SIZE)
+def _ua_bot_reason(user_agent: str) -> Optional[str]:
+    m = BOT_UA_PATTERN.search(user_agent)
+    return f"ua:{m.group(0).lower().rstrip('/')}" if m else None
+
+
+def _bot_reason(kind: str, data: BaseModel, client_ip: Optional[str], user_agent: Optional[str]) -> Optional[str]:
+    """Why this event looks automated, or None.  Pure CPU — no I/O."""
+    if not BOT_FILTER or kind not in BOT_FILTERED_EVENTS:
+        return None
+    ua = getattr(data, 'user_agent', None) or user_agent
+    if not ua:
+        return "ua:missing"
+    reason = _ua_bot_reason(ua[:512])
+    if reason:
+        return reason
+    hints = getattr(data, 'headless', None) or 0
+    weak = HEADLESS_NO_LANGUAGES | HEADLESS_NO_WINDOW
+    if hints & (HEADLESS_WEBDRIVER | HEADLESS_UA) or hints & weak == weak:
+        return "headless"
+    if client_ip and _in_datacenter(client_ip):
+        return "datacenter"
+    return None
+
+
+def _count_bot(reason: str, data: BaseModel, now: datetime) -> None:
+    url = getattr(data, 'current_url', None) or ''
+    domain = (urlparse(url).hostname or '')[:253] if url else ''
+    _bot_counts[(now.strftime('%Y-%m-%d'), reason, domain)] += 1
+
+
+def _filter_bot(kind: str, data: BaseModel, caller: "_Caller", user_agent: Optional[str],
+                now: datetime) -> Optional[dict]:
+    """Count and swallow a bot event: the body to answer with, or None for real traffic."""
+    if caller.trusted:
+        return None
+    reason = _bot_reason(kind, data, caller.ip, user_agent)
+    if reason is None:
+        return None
+    _count_bot(reason, data, now)
+    return {"status": "filtered", "contact_id": data.contact_id}
+
+
+async def _flush_bot_counts() -> None:
+    if not _bot_counts:
+        return
+    counts = dict(_bot_counts)
+    _bot_counts.clear()
+    expire_at = datetime.now(timezone.utc) + timedelta(days=BOT_STATS_RETENTION_DAYS)
+    try:
+        await db.bot_traffic.bulk_write([
+            UpdateOne({"day": day, "reason": reason, "domain": domain},
+                      {"$inc": {"count": n}, "$setOnInsert": {"expire_at": expire_at}}, upsert=True)
+            for (day, reason, domain), n in counts.items()
+        ], ordered=False)
+    except Exception as e:
+        for key, n in counts.items():
+            _bot_counts[key] += n
+        logger.warning(f"Bot traffic stats flush failed: {e}")
+
+
+async def _bot_stats_flusher() -> None:
+    while True:
+        await asyncio.sleep(BOT_STATS_FLUSH_SECONDS)
+        await _flush_bot_counts()
+
+
+# ─────────────────────────── Load shedding ───────────────────────────
+#
+# In-memory admission control for the /track endpoints, decided before any database
+# work (per uvicorn worker):
+#   rate limits  token buckets per client IP and per contact id, refilled continuously
+#                (a sliding window, not fixed per-second slots).  A client over either
+#                bucket gets 429 + Retry-After; the tracker never sends at these rates.
+#                A request is charged to both buckets only when both admit it.  Our own
+#                server-side callers (form backends replaying batches) are exempt when
+#                they send TRACK_SERVER_KEY in X-Track-Server-Key, or come from
+#                TRACK_RATE_LIMIT_EXEMPT (comma-separated CIDRs, empty by default)
+#                as seen by our proxy (verified_client_ip) — never by a client-written
+#                X-Forwarded-For.
+#   overload     a cap on in-flight track requests, and a MongoDB latency probe (EWMA of
+#                a ping every TRACK_LATENCY_PROBE_SECONDS).  Past either limit, pageviews
+#                and tags get a fast 202 "dropped" — or "journaled" when the ingest
+#                journal is on — while leads and registrations are still admitted: they
+#                carry identity and are a small share of the volume.
+# Every shed event is counted per reason and event type in /ingest/metrics.
+
+TRACK_IP_RATE       = float(os.environ.get('TRACK_IP_RATE', '20'))        # events/second per client IP (0 = off)
+TRACK_IP_BURST      = float(os.environ.get('TRACK_IP_BURST', '200'))
+TRACK_CONTACT_RATE  = float(os.environ.get('TRACK_CONTACT_RATE', '5'))    # events/second per contact id (0 = off)
+TRACK_CONTACT_BURST = float(os.environ.get('TRACK_CONTACT_BURST', '50'))
+TRACK_RATE_LIMIT_EXEMPT = [
+    ipaddress.ip_network(net.strip(), strict=False)
+    for net in os.environ.get('TRACK_RATE_LIMIT_EXEMPT', '').split(',') if net.strip()
+]
+TRACK_SERVER_KEY = os.environ.get('TRACK_SERVER_KEY', '')
+TRACK_MAX_IN_FLIGHT = int(os.environ.get('TRACK_MAX_IN_FLIGHT', '200'))   # per worker (0 = off)
+TRACK_SHED_LATENCY_MS = float(os.environ.get('TRACK_SHED_LATENCY_MS', '250'))  # probe EWMA (0 = off)
+TRACK_LATENCY_PROBE_SECONDS = 1.0
+TRACK_LATENCY_PROBE_TIMEOUT_SECONDS = 5.0
+TRACK_LATENCY_EWMA_ALPHA = 0.3
+RATE_LIMIT_MAX_KEYS = 100_000
+SHED_EVENTS = ('pageview', 'tag')
+
+
+class _TokenBuckets:
+    """Token buckets by key: `rate` tokens/second up to `burst`, least recently used keys evicted."""
+
+    def __init__(self, rate: float, burst: float, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.rate, self.burst, self.max_keys = rate, burst, max_keys
+        self.buckets: OrderedDict = OrderedDict()     # key → (tokens, monotonic time)
+
+    def _tokens(self, key: str, now: float) -> float:
+        prev = self.buckets.get(key)
+        return self.burst if prev is None else min(self.burst, prev[0] + (now - prev[1]) * self.rate)
+
+    def wait(self, key: Optional[str], cost: float = 1) -> float:
+        """Seconds until the bucket could cover `cost` tokens (0 = it can now).  Spends nothing."""
+        if not self.rate or not key:
+            return 0.0
+        cost = min(cost, self.burst)
+        tokens = self._tokens(key, time.monotonic())
+        return 0.0 if tokens >= cost else (cost - tokens) / self.rate
+
+    def take(self, key: Optional[str], cost: float = 1) -> None:
+        """Spend `cost` tokens of a bucket wait() found able to cover them."""
+        if not self.rate or not key:
+            return
+        now = time.monotonic()
+        tokens = self._tokens(key, now) - min(cost, self.burst)
+        self.buckets.pop(key, None)
+        self.buckets[key] = (max(tokens, 0.0), now)
+        if len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+
+
+_ip_buckets = _TokenBuckets(TRACK_IP_RATE, TRACK_IP_BURST)
+_contact_buckets = _TokenBuckets(TRACK_CONTACT_RATE, TRACK_CONTACT_BURST)
+_shed_state = {"in_flight": 0, "mongo_latency_ms": 0.0}
+_shed_counts: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))   # reason → kind → events
+
+
+class _Caller(NamedTuple):
+    ip: Optional[str]       # verified_client_ip
+    trusted: bool           # one of our own server-side callers
+
+
+def _track_caller(request: Request) -> _Caller:
+    ip = verified_client_ip(request)
+    key = request.headers.get('x-track-server-key')
+    trusted = bool(TRACK_SERVER_KEY and key and hmac.compare_digest(key, TRACK_SERVER_KEY))
+    return _Caller(ip, trusted or _in_networks(ip, TRACK_RATE_LIMIT_EXEMPT))
+
+
+def _rate_limited(kind_counts: Dict[str, int], caller: _Caller,
+                  contact_counts: Dict[str, int]) -> Optional[JSONResponse]:
+    """429 for a request over its IP or contact bucket (events counted per type), else None."""
+    if caller.trusted:
+        return None
+    # Check both buckets first: a request one of them rejects spends nothing from the
+    # other (a NAT's shared IP bucket is not drained by one over-eager contact)
+    events = sum(kind_counts.values())
+    ip_wait = _ip_buckets.wait(caller.ip, events)
+    contact_wait = max((_contact_buckets.wait(cid, n) for cid, n in contact_counts.items()), default=0.0)
+    if not ip_wait and not contact_wait:
+        _ip_buckets.take(caller.ip, events)
+        for cid, n in contact_counts.items():
+            _contact_buckets.take(cid, n)
+        return None
+    reason, wait = ("rate_ip", ip_wait) if ip_wait else ("rate_contact", contact_wait)
+    for kind, n in kind_counts.items():
+        _shed_counts[reason][kind] += n
+    return JSONResponse(status_code=429, content={"detail": "rate limited"},
+                        headers={"Retry-After": str(max(1, int(wait + 0.999)))})
+
+
+def _overloaded() -> Optional[str]:
+    """Why pageviews and tags should be shed right now, or None."""
+    if TRACK_MAX_IN_FLIGHT and _shed_state["in_flight"] >= TRACK_MAX_IN_FLIGHT:
+        return "in_flight"
+    if TRACK_SHED_LATENCY_MS and _shed_state["mongo_latency_ms"] >= TRACK_SHED_LATENCY_MS:
+        return "mongo_latency"
+    return None
+
+
+async def _shed(items: List[tuple], reason: str) -> str:
+    """Shed ingest items: journaled for later replay when the journal is on, else dropped."""
+    for kind, *_ in items:
+        _shed_counts[reason][kind] += 1
+    items = await _journal_append(items)
+    return "journaled" if all(item[5] for item in items) else "dropped"
+
+
+async def _admit(kind: str, data: BaseModel, caller: _Caller, client_ip: Optional[str],
+                 user_agent: Optional[str], now: datetime) -> Optional[JSONResponse]:
+    """Admission for a single-event route: the fast answer for a shed event, or None to process it."""
+    limited = _rate_limited({kind: 1}, caller, {data.contact_id: 1})
+    if limited or kind not in SHED_EVENTS:
+        return limited
+    reason = _overloaded()
+    if reason is None:
+        return None
+    status = await _shed([(kind, data, client_ip, user_agent, now, None)], reason)
+    return JSONResponse(status_code=202, content={"status": status, "contact_id": data.contact_id})
+
+
+class _InFlight:
+    """Counts a track request toward TRACK_MAX_IN_FLIGHT while it is being processed."""
+
+    def __enter__(self):
+        _shed_state["in_flight"] += 1
+
+    def __exit__(self, *exc):
+        _shed_state["in_flight"] -= 1
+
+
+async def _mongo_latency_probe() -> None:
+    while True:
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(db.command("ping"), TRACK_LATENCY_PROBE_TIMEOUT_SECONDS)
+            sample = (time.perf_counter() - start) * 1000
+        except Exception:
+            sample = TRACK_LATENCY_PROBE_TIMEOUT_SECONDS * 1000
+        prev = _shed_state["mongo_latency_ms"]
+        _shed_state["mongo_latency_ms"] = prev + TRACK_LATENCY_EWMA_ALPHA * (sample - prev)
+        await asyncio.sleep(TRACK_LATENCY_PROBE_SECONDS)
+
+
+def _shed_metrics() -> dict:
+    return {
+        "in_flight":        _shed_state["in_flight"],
+        "max_in_flight":    TRACK_MAX_IN_FLIGHT,
+        "mongo_latency_ms": round(_shed_state["mongo_latency_ms"], 2),
+        "latency_threshold_ms": TRACK_SHED_LATENCY_MS,
+        "overloaded":       _overloaded(),
+        "rate_limited_keys": {"ip": len(_ip_buckets.buckets), "contact": len(_contact_buckets.buckets)},
+        "shed":             {reason: dict(kinds) for reason, kinds in _shed_counts.items()},
+    }
+
+
+# ─────────────────────────── Anonymous visit rollup ───────────────────────────
+#
+# Opt-in retention mode (VISIT_ROLLUP_DAYS > 0).  Raw page_visits of visitors who never
+# identified are rarely read but dominate the collection and its indexes.  Once a visit
+# is VISIT_ROLLUP_DAYS old it is kept only if its contact is identified (email, phone or
+# name), merged into another contact or the parent of merged contacts — stitching
+# re-points a visitor's visits to the identified contact, so anyone who identified
+# within the window keeps their history.  Every other visit is counted into
+# visit_rollups per day / URL (without query string) / source and deleted — unless a
+# stitch could still pick its contact up: one created within the IP stitch window, or
+# one sharing its session_id with another unmerged contact.  Those visits are flagged
+# rollup_recheck and examined again on every pass until they are rolled up or their
+# contact is kept.  One worker at a time holds the job's lease in visit_rollup_state,
+# which also records how far the scan has got, so every other visit is examined once.
+# A crash between counting a chunk and deleting it can count that chunk twice; the
+# rollups are reporting aggregates.
+
+VISIT_ROLLUP_DAYS = int(os.environ.get('VISIT_ROLLUP_DAYS', '0'))
+VISIT_ROLLUP_INTERVAL_SECONDS = 3600
+VISIT_ROLLUP_BATCH_SIZE = 1000
+VISIT_ROLLUP_LEASE_SECONDS = 600
+VISIT_ROLLUP_STATE_ID = "page_visits"
+VISIT_ROLLUP_FIELDS = {"contact_id": 1, "timestamp": 1, "current_url": 1, "referrer_url": 1,
+                       "attribution.utm_source": 1, "sample_rate": 1, "rollup_recheck": 1}
+
+
+def _page_key(url: Optional[str]) -> str:
+    """Host + path of a page URL, without query string or fragment."""
+    if not url:
+        return ''
+    parts = urlparse(url)
+    return f"{parts.netloc}{parts.path}"[:500] if parts.netloc else url.split('?', 1)[0][:500]
+
+
+def _rollup_source(visit: dict) -> str:
+    """utm_source, else the referrer's host, else "(direct)"."""
+    source = (visit.get('attribution') or {}).get('utm_source')
+    if source:
+        return str(source)[:200]
+    referrer = visit.get('referrer_url')
+    return (urlparse(referrer).hostname or '(direct)')[:253] if referrer else '(direct)'
+
+
+def _rollup_lease_until() -> str:
+    return dt_to_str(datetime.now(timezone.utc) + timedelta(seconds=VISIT_ROLLUP_LEASE_SECONDS))
+
+
+async def _rollup_kept_contacts(contact_ids: List[str], now: datetime) -> tuple[set, set]:
+    """
+    (kept, stitchable) among contact_ids: contacts whose visits are never rolled up,
+    and contacts whose visits wait because a stitch could still pick them up.
+    """
+    ip_window_start = dt_to_str(now - timedelta(minutes=IP_STITCH_WINDOW_MINUTES))
+    kept, stitchable, by_session = set(), set(), defaultdict(set)
+    for c in await db.contacts.find(
+        {"contact_id": {"$in": contact_ids}},
+        {"_id": 0, "contact_id": 1, "email": 1, "phone": 1, "name": 1, "merged_into": 1,
+         "merged_children": 1, "session_id": 1, "created_at": 1},
+    ).to_list(None):
+        if c.get("email") or c.get("phone") or c.get("name") or c.get("merged_into") or c.get("merged_children"):
+            kept.add(c["contact_id"])
+        elif (dt_to_str(c.get("created_at")) or '') >= ip_window_start:
+            stitchable.add(c["contact_id"])
+        elif c.get("session_id"):
+            by_session[c["session_id"]].add(c["contact_id"])
+    if by_session:
+        for other in await db.contacts.find(
+            {"session_id": {"$in": list(by_session)}, "merged_into": None},
+            {"_id": 0, "contact_id": 1, "session_id": 1},
+        ).to_list(None):
+            sharing = by_session[other["session_id"]]
+            if sharing - {other["contact_id"]}:
+                stitchable |= sharing
+    return kept, stitchable
+
+
+async def _rollup_visits(visits: List[dict], now: datetime) -> int:
+    """Roll up the anonymous visits of a chunk and flag the ones to recheck; returns how many were rolled up."""
+    kept, stitchable = await _rollup_kept_contacts(list({v["contact_id"] for v in visits}), now)
+    anonymous = [v for v in visits if v["contact_id"] not in kept and v["contact_id"] not in stitchable]
+    counts: Dict[tuple, float] = defaultdict(float)
+    for v in anonymous:
+        key = (v["timestamp"][:10], _page_key(v.get("current_url")), _rollup_source(v))
+        counts[key] += _visit_weight(v)
+    if counts:
+        await db.visit_rollups.bulk_write([
+            UpdateOne({"day": day, "url": url, "source": source}, {"$inc": {"visits": n}}, upsert=True)
+            for (day, url, source), n in counts.items()
+        ], ordered=False)
+        await db.page_visits.delete_many({"_id": {"$in": [v["_id"] for v in anonymous]}})
+    recheck = [v["_id"] for v in visits if v["contact_id"] in stitchable and not v.get("rollup_recheck")]
+    settled = [v["_id"] for v in visits if v["contact_id"] in kept and v.get("rollup_recheck")]
+    if recheck:
+        await db.page_visits.update_many({"_id": {"$in": recheck}}, {"$set": {"rollup_recheck": True}})
+    if settled:
+        await db.page_visits.update_many({"_id": {"$in": settled}}, {"$unset": {"rollup_recheck": ""}})
+    return len(anonymous)
+
+
+async def _rollup_anonymous_visits(now: datetime) -> int:
+    """One pass over visits past the window; returns how many were rolled up."""
+    state = await db.visit_rollup_state.find_one_and_update(
+        {"_id": VISIT_ROLLUP_STATE_ID, "lease_until": {"$lt": dt_to_str(now)}},
+        {"$set": {"lease_until": _rollup_lease_until()}},
+    )
+    if state is None:
+        return 0       # another worker holds the lease
+    cutoff = dt_to_str(now - timedelta(days=VISIT_ROLLUP_DAYS))
+    after_ts, after_id = state.get("after_ts"), state.get("after_id")
+    rolled = 0
+    try:
+        # Visits left waiting for a possible stitch by earlier passes
+        recheck_after = None
+        while True:
+            query: dict = {"rollup_recheck": True}
+            if recheck_after is not None:
+                query["_id"] = {"$gt": recheck_after}
+            visits = await db.page_visits.find(query, VISIT_ROLLUP_FIELDS).sort("_id", 1) \
+                .limit(VISIT_ROLLUP_BATCH_SIZE).to_list(VISIT_ROLLUP_BATCH_SIZE)
+            if not visits:
+                break
+            rolled += await _rollup_visits(visits, now)
+            recheck_after = visits[-1]["_id"]
+            if len(visits) < VISIT_ROLLUP_BATCH_SIZE:
+                break
+
+        # Visits that crossed the window since the last pass
+        while True:
+            query = {"timestamp": {"$lt": cutoff}}
+            if after_id is not None:
+                query["$or"] = [{"timestamp": {"$gt": after_ts}}, {"timestamp": after_ts, "_id": {"$gt": after_id}}]
+            visits = await db.page_visits.find(query, VISIT_ROLLUP_FIELDS) \
+                .sort([("timestamp", 1), ("_id", 1)]).limit(VISIT_ROLLUP_BATCH_SIZE).to_list(VISIT_ROLLUP_BATCH_SIZE)
+            if not visits:
+                break
+            rolled += await _rollup_visits(visits, now)
+            after_ts, after_id = visits[-1]["timestamp"], visits[-1]["_id"]
+            await db.visit_rollup_state.update_one(
+                {"_id": VISIT_ROLLUP_STATE_ID},
+                {"$set": {"after_ts": after_ts, "after_id": after_id, "lease_until": _rollup_lease_until()}},
+            )
+            if len(visits) < VISIT_ROLLUP_BATCH_SIZE:
+                break
+    finally:
+        await db.visit_rollup_state.update_one({"_id": VISIT_ROLLUP_STATE_ID}, {"$set": {"lease_until": ""}})
+    if rolled:
+        logger.info(f"Visit rollup: folded {rolled} anonymous visits older than {VISIT_ROLLUP_DAYS} days")
+    return rolled
+
+
+async def _visit_rollup_loop() -> None:
+    while True:
+        try:
+            await _rollup_anonymous_visits(datetime.now(timezone.utc))
+        except Exception as e:
+            logger.warning(f"Visit rollup failed: {e}")
+        await asyncio.sleep(VISIT_ROLLUP_INTERVAL_SECONDS)
+
+
+# ─────────────────────────── Pageview sampling ───────────────────────────
+#
+# During big launches anonymous pageviews outnumber identified ones by orders of
+# magnitude.  PAGEVIEW_SAMPLING_RULES (JSON) records only a share of them per domain or
+# URL pattern, e.g.
+#     [{"match": "launch.example.com", "rate": 0.1}, {"match": "*/replay*", "rate": 0.25}]
+# A match without "/" is a host pattern; otherwise it is matched against host + path.
+# The first matching rule wins.  The decision hashes the contact_id, so a visitor is
+# either fully tracked or not at all, on every page with the same rate.  It applies only
+# to anonymous pageviews: anything carrying identity or attribution signals, and any
+# contact we already have a document for, is always recorded in full.  A sampled-out
+# pageview only bumps this worker's counters (/ingest/metrics); a sampled-in one stores
+# its rate on the visit, and visit reports count it as 1/rate visits.
+
+def _load_sampling_rules(raw: str) -> List[tuple]:
+    """(match pattern, rate) pairs from PAGEVIEW_SAMPLING_RULES; bad rules are logged and skipped."""
+    if not raw.strip():
+        return []
+    try:
+        rules = json.loads(raw)
+    except ValueError as e:
+        logger.error(f"PAGEVIEW_SAMPLING_RULES is not valid JSON, sampling is off: {e}")
+        return []
+    parsed = []
+    for rule in rules if isinstance(rules, list) else []:
+        try:
+            match, rate = str(rule['match']).lower(), float(rule['rate'])
+        except (KeyError, TypeError, ValueError):
+            logger.warning(f"Pageview sampling: skipping bad rule {rule!r}")
+            continue
+        parsed.append((match, min(max(rate, 0.0), 1.0)))
+    return parsed
+
+
+PAGEVIEW_SAMPLING_RULES = _load_sampling_rules(os.environ.get('PAGEVIEW_SAMPLING_RULES', ''))
+
+_sampling_counts: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))   # rule → outcome → pageviews
+
+
+def _sampling_rule(url: Optional[str]) -> Optional[tuple]:
+    if not url:
+        return None
+    page = _page_key(url).lower()
+    host = page.split('/', 1)[0]
+    for match, rate in PAGEVIEW_SAMPLING_RULES:
+        if fnmatch.fnmatchcase(page if '/' in match else host, match):
+            return match, rate
+    return None
+
+
+def _sample_bucket(contact_id: str) -> float:
+    """Stable position of a contact in [0, 1): sampled in at rate r when below r."""
+    digest = hashlib.blake2b(contact_id.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') / 2 ** 64
+
+
+async def _sampled_out(pageviews: List[PageViewCreate]) -> List[bool]:
+    """
+    Which pageviews to answer "sampled" without recording them.  Sampled-in anonymous
+    pageviews get their rule's rate set (data._sample_rate) for the visit document.
+    """
+    candidates = []
+    for i, data in enumerate(pageviews):
+        rule = _sampling_rule(data.current_url)
+        if rule is None or rule[1] >= 1 or data.attribution_hash or _has_contact_signal(data.model_dump()):
+            continue
+        candidates.append((i, rule))
+    out = [False] * len(pageviews)
+    if not candidates:
+        return out
+    contact_ids = [cid for cid in {pageviews[i].contact_id for i, _ in candidates} if not _absent_cache_get(cid)]
+    try:
+        known = {c["contact_id"] for c in await db.contacts.find(
+            {"contact_id": {"$in": contact_ids}}, {"_id": 0, "contact_id": 1}).to_list(None)} if contact_ids else set()
+    except Exception as e:
+        logger.warning(f"Pageview sampling skipped, contact lookup failed: {e}")
+        return out
+    for cid in contact_ids:
+        if cid not in known:
+            _absent_cache_put(cid)
+    for i, (match, rate) in candidates:
+        data = pageviews[i]
+        if data.contact_id in known:
+            _sampling_counts[match]["known_contact"] += 1
+        elif _sample_bucket(data.contact_id) < rate:
+            data._sample_rate = rate
+            _sampling_counts[match]["sampled_in"] += 1
+        else:
+            out[i] = True
+            _sampling_counts[match]["sampled_out"] += 1
+    return out
+
+
+# What one page_visits row stands for: 1, or 1/sample_rate for a sampled visit.  Every
+# visit count sums this ($sum: VISIT_WEIGHT in a $group, _visit_weight in Python)
+# rather than counting rows, so sampled pages are not under-reported.
+VISIT_WEIGHT = {"$cond": [{"$gt": ["$sample_rate", 0]}, {"$divide": [1, "$sample_rate"]}, 1]}
 
-  if (document.readyState === 'loading') {
-    document.addEventListener('DOMContentLoaded', init);
-  } else {
-    init();
-  }
 
-  /* ─── Public API ─── */
-  window.Shumard = {
-    getContactId:  getContactId,
-    getSessionId:  function(){ return store.config.sessionId; },
-    identify: function(fields){
-      if (fields.email && isEmail(fields.email)){ store.lead.email=fields.email; sendLead(fields); }
-    },
-    stitch:    sendStitch,
-    trackEvent: sendLead,
-    store:     store
-  };
+def _visit_weight(visit: dict) -> float:
+    return 1 / visit["sample_rate"] if visit.get("sample_rate") else 1
 
-})();
-"""
+
+async def _weighted_visit_count(match: dict) -> int:
+    """page_visits matching `match`, with each sampled visit counted as 1/sample_rate."""
+    total = await db.page_visits.aggregate([
+        {"$match": match},
+        {"$group": {"_id": None, "visits": {"$sum": VISIT_WEIGHT}}},
+    ]).to_list(1)
+    return round(total[0]["visits"]) if total else 0
+
+
+def _sampling_metrics() -> dict:
+    return {
+        "rules":  [{"match": match, "rate": rate} for match, rate in PAGEVIEW_SAMPLING_RULES],
+        "counts": {match: dict(outcomes) for match, outcomes in _sampling_counts.items()},
+    }
 
 
 # ─────────────────────────── Routes ───────────────────────────
@@ -1875,132 +4046,1155 @@ async def root():
 
 
 @api_router.get("/shumard.js", response_class=PlainTextResponse)
-async def get_shumard_js(tag: Optional[str] = None):
+async def get_shumard_js(request: Request, tag: Optional[str] = None, debug: bool = False):
     backend_url = os.environ.get('REACT_APP_BACKEND_URL', '')
-    # Sanitise tag: alphanumeric + dash/underscore, max 64 chars, no JS injection
-    safe_tag = ''
-    if tag:
-        import re
-        safe_tag = re.sub(r'[^a-zA-Z0-9_\-]', '', tag)[:64]
-    return PlainTextResponse(
-        content=build_tracker_js(backend_url, auto_tag=safe_tag),
-        media_type="application/javascript",
-        headers={"Cache-Control": "no-cache, no-store, must-revalidate", "Access-Control-Allow-Origin": "*"}
-    )
+    asset = _get_tracker_asset(backend_url, _sanitize_script_tag(tag), debug)
+    return _tracker_response(request, asset, TRACKER_CACHE_CONTROL)
+
+
+@api_router.get("/shumard-loader.js", response_class=PlainTextResponse)
+async def get_shumard_loader_js(request: Request, debug: bool = False):
+    """
+    Split delivery mode:  <script src=".../api/shumard-loader.js" data-tag="thank-you"></script>
+    The loader is the same for every page and tag, and pulls in the immutable core below.
+    """
+    backend_url = os.environ.get('REACT_APP_BACKEND_URL', '')
+    return _tracker_response(request, _get_loader_asset(backend_url, debug), TRACKER_CACHE_CONTROL)
+
+
+@api_router.get("/shumard.{content_hash}.js", response_class=PlainTextResponse)
+async def get_shumard_core_js(content_hash: str, request: Request, debug: bool = False):
+    """
+    Content-hashed, tag-neutral core script.  Cached for a year when the hash is current;
+    a stale hash (loader cached across a deploy) still gets the latest core, briefly cached.
+    """
+    backend_url = os.environ.get('REACT_APP_BACKEND_URL', '')
+    asset = _get_tracker_asset(backend_url, '', debug)
+    cache_control = TRACKER_IMMUTABLE_CACHE_CONTROL if content_hash == asset['hash'] else TRACKER_CACHE_CONTROL
+    return _tracker_response(request, asset, cache_control)
+
+
+@api_router.get("/shumard-forms.js", response_class=PlainTextResponse)
+async def get_shumard_forms_js(request: Request, debug: bool = False):
+    """Form-capture module, unhashed (for pages pinned to an old core)."""
+    return _tracker_response(request, _get_forms_asset(debug), TRACKER_CACHE_CONTROL)
+
+
+@api_router.get("/shumard-forms.{content_hash}.js", response_class=PlainTextResponse)
+async def get_shumard_forms_hashed_js(content_hash: str, request: Request, debug: bool = False):
+    """Content-hashed form-capture module the core injects on demand; same caching as the core."""
+    asset = _get_forms_asset(debug)
+    cache_control = TRACKER_IMMUTABLE_CACHE_CONTROL if content_hash == asset['hash'] else TRACKER_CACHE_CONTROL
+    return _tracker_response(request, asset, cache_control)
 
 
 @api_router.post("/track/tag")
-async def track_tag(data: TagCreate, request: Request):
+async def track_tag(request: Request):
     """
     Add a tag to a contact.  Called automatically by the script when loaded with ?tag=...
     Uses $addToSet so the tag is stored exactly once no matter how many times the page loads.
     """
+    data = await _parse_track_model(request, TagCreate)
+    ip, caller, now = get_client_ip(request), _track_caller(request), datetime.now(timezone.utc)
+    filtered = _filter_bot('tag', data, caller, request.headers.get('user-agent'), now)
+    if filtered:
+        return _track_response(filtered)
+    shed = await _admit('tag', data, caller, ip, None, now)
+    if shed:
+        return shed
+    with _InFlight():
+        return _track_response(await _once(data, lambda: _track_tag(data, request)))
+
+
+async def _track_tag(data: TagCreate, request: Request):
+    now = datetime.now(timezone.utc)
+    ip  = get_client_ip(request)
+    [(*_, jid)] = await _journal_append([('tag', data, ip, None, now, None)])
     try:
-        now = datetime.now(timezone.utc)
-        ip  = get_client_ip(request)
         eid = await _resolve_contact_id(data.contact_id)
-
-        # Create the contact if it doesn't exist yet (e.g. thank-you page without prior pageview)
-        existing = await db.contacts.find_one({"contact_id": eid}, {"_id": 0})
-        if existing:
-            await db.contacts.update_one(
-                {"contact_id": eid},
-                {"$addToSet": {"tags": data.tag},
-                 "$set":      {"updated_at": dt_to_str(now)}}
-            )
-        else:
-            # Minimal contact — no email yet, but we have a contact_id and tag
-            contact = Contact(
-                contact_id=eid,
-                session_id=data.session_id,
-                client_ip=ip,
-                tags=[data.tag],
-                created_at=now,
-                updated_at=now,
-            )
-            cdoc = strip_nulls(contact.model_dump())
-            cdoc['created_at'] = dt_to_str(now)
-            cdoc['updated_at'] = dt_to_str(now)
-            cdoc['tags']       = [data.tag]
-            await db.contacts.insert_one(cdoc)
-
-        logger.info(f"Tag '{data.tag}' applied to contact {eid[:12]}...")
-        # Attempt to stitch by IP in case this is a thank-you page visit
-        await _ip_auto_stitch(eid, ip, now)
+        await _apply_track_event('tag', data, eid, now, ip)
+        # Stitch by IP in the background in case this is a thank-you page visit
+        _signal_stitch(eid, ip=ip)
+        _journal_ack([jid])
         return {"status": "ok", "contact_id": data.contact_id, "tag": data.tag}
     except Exception as e:
         logger.error(f"Error applying tag: {e}")
+        if jid:
+            return _journaled_response({"contact_id": data.contact_id, "tag": data.tag})
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @api_router.post("/track/pageview")
-async def track_pageview(data: PageViewCreate, request: Request):
+async def track_pageview(request: Request):
+    data = await _parse_track_model(request, PageViewCreate)
+    ip, ua, now = get_client_ip(request), request.headers.get('user-agent'), datetime.now(timezone.utc)
+    caller = _track_caller(request)
+    filtered = _filter_bot('pageview', data, caller, ua, now)
+    if filtered:
+        return _track_response(filtered)
+    shed = await _admit('pageview', data, caller, ip, ua, now)
+    if shed:
+        return shed
+    if PAGEVIEW_SAMPLING_RULES and (await _sampled_out([data]))[0]:
+        return _track_response({"status": "sampled", "contact_id": data.contact_id})
+    with _InFlight():
+        return _track_response(await _once(data, lambda: _track_pageview(data, request)))
+
+
+async def _track_pageview(data: PageViewCreate, request: Request):
+    now = datetime.now(timezone.utc)
+    ip  = get_client_ip(request)
+    ua  = request.headers.get('user-agent')
+    [item] = await _journal_append([('pageview', data, ip, ua, now, None)])
+    jid = item[5]
     try:
-        now = datetime.now(timezone.utc)
-        ip  = get_client_ip(request)
+        if TRACK_WRITE_BEHIND and _write_behind_eligible(data) and _write_behind_offer([item]):
+            return JSONResponse(status_code=202, content={"status": "accepted", "contact_id": data.contact_id,
+                                                          **_attribution_preview(data)})
         # Always resolve the effective (non-merged) contact_id before any operation
         eid = await _resolve_contact_id(data.contact_id)
-        await _upsert_contact({
-            'contact_id': eid, 'session_id': data.session_id,
-            'attribution': data.attribution, 'user_agent': data.user_agent
-        }, now, ip)
-        vid = await _log_visit(eid, data.session_id, data.current_url, data.referrer_url, data.page_title, data.attribution, now, ip)
-        await _ip_auto_stitch(eid, ip, now)
-        return {"status": "ok", "visit_id": vid, "contact_id": data.contact_id}
+        result = await _apply_track_event('pageview', data, eid, now, ip, ua, jid)
+        _signal_stitch(eid, ip=ip)
+        _journal_ack([jid])
+        return {"status": "ok", "visit_id": result['visit_id'], "contact_id": data.contact_id,
+                **_attribution_reply(result)}
     except Exception as e:
         logger.error(f"Error tracking pageview: {e}")
+        if jid:
+            return _journaled_response({"visit_id": jid, "contact_id": data.contact_id})
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @api_router.post("/track/lead")
-async def track_lead(data: LeadCreate, request: Request):
+async def track_lead(request: Request, sync: bool = False):
+    """sync=true waits for the stitch passes and answers with the final (possibly merged) contact_id."""
+    data = await _parse_track_model(request, LeadCreate)
+    shed = await _admit('lead', data, _track_caller(request), get_client_ip(request),
+                        request.headers.get('user-agent'), datetime.now(timezone.utc))
+    if shed:
+        return shed
+    with _InFlight():
+        return _track_response(await _once(data, lambda: _track_lead(data, request, sync)))
+
+
+async def _track_lead(data: LeadCreate, request: Request, sync: bool = False):
+    now = datetime.now(timezone.utc)
+    ip  = get_client_ip(request)
+    ua  = request.headers.get('user-agent')
+    [(*_, jid)] = await _journal_append([('lead', data, ip, ua, now, None)])
     try:
-        now = datetime.now(timezone.utc)
-        ip  = get_client_ip(request)
         eid = await _resolve_contact_id(data.contact_id)
-        await _upsert_contact({
-            'contact_id': eid, 'session_id': data.session_id,
-            'email': data.email, 'phone': data.phone, 'name': data.name,
-            'first_name': data.first_name, 'last_name': data.last_name,
-            'attribution': data.attribution, 'user_agent': data.user_agent
-        }, now, ip)
-        # Auto-stitch by email FIRST (most reliable identity match)
-        if data.email:
-            eid = await _email_auto_stitch(eid, data.email, now)
-        await _session_auto_stitch(eid, data.session_id, now)
-        await _ip_auto_stitch(eid, ip, now)
-        asyncio.create_task(_run_automations(eid))
-        return {"status": "ok", "contact_id": eid}  # Return the final contact_id (may have changed after merge)
+        result = await _apply_track_event('lead', data, eid, now, ip, ua, jid)
+        _journal_ack([jid])
+        # Email stitch first (most reliable identity match), then session and IP, then
+        # automations — in the background unless the caller waits for the final contact_id
+        stitched = _signal_stitch(eid, data.email, data.session_id, ip, identity=True, wait=sync)
+        return {"status": "ok", "contact_id": await _await_stitch(stitched, eid), **_attribution_reply(result)}
     except Exception as e:
         logger.error(f"Error tracking lead: {e}")
+        if jid:
+            return _journaled_response({"contact_id": data.contact_id})
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @api_router.post("/track/registration")
-async def track_registration(data: RegistrationCreate, request: Request):
+async def track_registration(request: Request, sync: bool = False):
+    """sync=true waits for the stitch passes and answers with the final (possibly merged) contact_id."""
+    data = await _parse_track_model(request, RegistrationCreate)
+    shed = await _admit('registration', data, _track_caller(request), get_client_ip(request),
+                        request.headers.get('user-agent'), datetime.now(timezone.utc))
+    if shed:
+        return shed
+    with _InFlight():
+        return _track_response(await _once(data, lambda: _track_registration(data, request, sync)))
+
+
+async def _track_registration(data: RegistrationCreate, request: Request, sync: bool = False):
+    now = datetime.now(timezone.utc)
+    ip  = get_client_ip(request)
+    ua  = request.headers.get('user-agent')
+    [(*_, jid)] = await _journal_append([('registration', data, ip, ua, now, None)])
     try:
-        now = datetime.now(timezone.utc)
-        ip  = get_client_ip(request)
         eid = await _resolve_contact_id(data.contact_id)
-        await _upsert_contact({
-            'contact_id': eid, 'session_id': data.session_id,
-            'email': data.email, 'phone': data.phone, 'name': data.name,
-            'first_name': data.first_name, 'last_name': data.last_name,
-            'attribution': data.attribution, 'user_agent': data.user_agent
-        }, now, ip)
-        if data.current_url:
-            await _log_visit(eid, data.session_id, data.current_url, data.referrer_url, data.page_title or "Registration", data.attribution, now, ip)
-        # Auto-stitch by email FIRST (most reliable identity match)
-        if data.email:
-            eid = await _email_auto_stitch(eid, data.email, now)
-        await _session_auto_stitch(eid, data.session_id, now)
-        await _ip_auto_stitch(eid, ip, now)
-        asyncio.create_task(_run_automations(eid))
-        return {"status": "ok", "contact_id": eid}  # Return the final contact_id (may have changed after merge)
+        result = await _apply_track_event('registration', data, eid, now, ip, ua, jid)
+        _journal_ack([jid])
+        # Email stitch first (most reliable identity match), then session and IP, then
+        # automations — in the background unless the caller waits for the final contact_id
+        stitched = _signal_stitch(eid, data.email, data.session_id, ip, identity=True, wait=sync)
+        return {"status": "ok", "contact_id": await _await_stitch(stitched, eid), **_attribution_reply(result)}
     except Exception as e:
         logger.error(f"Error tracking registration: {e}")
+        if jid:
+            return _journaled_response({"contact_id": data.contact_id})
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def _set_path(doc: dict, path: str, value: Any) -> None:
+    """Counterpart of _nested_get: apply a dotted $set path to an in-memory document."""
+    parts = path.split('.')
+    for part in parts[:-1]:
+        if not isinstance(doc.get(part), dict):
+            doc[part] = {}
+        doc = doc[part]
+    doc[parts[-1]] = value
+
+
+BATCH_STITCH_IP_CANDIDATES = 1000   # beyond this, every contact runs the IP pass unfiltered
+
+
+async def _batch_stitch_candidates(pending: Dict[str, dict], now: datetime) -> dict:
+    """
+    Candidates for the email / session / IP stitch passes of a whole batch, fetched with
+    three queries instead of several per contact.  Mirrors the filters of
+    _email_auto_stitch, _session_auto_stitch and _ip_auto_stitch; a contact with no
+    candidate in a pass can skip that pass.
+    """
+    emails = {w["email"].lower().strip() for w in pending.values() if w["email"] and w["email"].strip()}
+    sessions = {w["session_id"] for w in pending.values() if w["identity"] and w["session_id"]}
+    ips = {w["ip"] for w in pending.values() if w["ip"]}
+
+    async def by_email():
+        if not emails:
+            return []
+        patterns = [re.compile(f"^{re.escape(e)}$", re.IGNORECASE) for e in emails]
+        return await db.contacts.find({"email": {"$in": patterns}, "merged_into": None},
+                                      {"_id": 0, "contact_id": 1, "email": 1}).to_list(None)
+
+    async def by_session():
+        if not sessions:
+            return []
+        return await db.contacts.find({"session_id": {"$in": list(sessions)}, "merged_into": None},
+                                      {"_id": 0, "contact_id": 1, "session_id": 1}).to_list(None)
+
+    async def by_ip():
+        if not ips:
+            return []
+        return await db.contacts.find({
+            "client_ip": {"$in": list(ips)},
+            "merged_into": None,
+            "created_at": {"$gte": dt_to_str(now - timedelta(minutes=IP_STITCH_WINDOW_MINUTES))},
+        }, {"_id": 0}).to_list(BATCH_STITCH_IP_CANDIDATES)
+
+    email_docs, session_docs, ip_docs = await asyncio.gather(by_email(), by_session(), by_ip())
+    email_owners: Dict[str, set] = defaultdict(set)
+    for d in email_docs:
+        email_owners[(d.get("email") or "").lower().strip()].add(d["contact_id"])
+    session_owners: Dict[str, set] = defaultdict(set)
+    for d in session_docs:
+        session_owners[d["session_id"]].add(d["contact_id"])
+    ip_candidates: Dict[str, list] = defaultdict(list)
+    for d in ip_docs:
+        ip_candidates[d["client_ip"]].append(d)
+    return {
+        "email": email_owners,
+        "session": session_owners,
+        "ip": None if len(ip_docs) >= BATCH_STITCH_IP_CANDIDATES else ip_candidates,
+    }
+
+
+class _BatchContact:
+    """A contact as a /track/batch request sees it: the stored document plus this batch's changes."""
+    __slots__ = ('doc', 'is_new', 'set_keys', 'tags')
+
+    def __init__(self, doc: Optional[dict]):
+        self.doc = doc            # None until the batch produces something worth storing
+        self.is_new = False
+        self.set_keys: set = set()
+        self.tags: List[str] = []
+
+    def merge(self, update: dict) -> None:
+        for key, value in update.items():
+            _set_path(self.doc, key, value)
+            self.set_keys.add(key)
+
+    def write_op(self, cid: str) -> Optional[UpdateOne]:
+        if self.doc is None:
+            return None
+        if self.is_new:
+            # Upsert instead of insert: a concurrent request may create the same contact.
+            # Fields the insert-race fallback in _upsert_contact would overwrite go in $set,
+            # everything else only applies when the document is actually created.
+            live = {k: self.doc[k] for k in ('name', 'email', 'phone', 'session_id', 'updated_at')
+                    if self.doc.get(k) is not None}
+            on_insert = {k: v for k, v in self.doc.items() if k not in live and k not in ('contact_id', 'tags')}
+            update: dict = {"$setOnInsert": on_insert, "$set": live}
+            if self.doc.get('tags'):
+                update["$addToSet"] = {"tags": {"$each": self.doc['tags']}}
+            return UpdateOne({"contact_id": cid}, update, upsert=True)
+        if not self.set_keys and not self.tags:
+            return None
+        # 'attribution' and 'attribution.fbc' in one $set conflict -- keep the outermost path
+        keys = [k for k in self.set_keys
+                if not any(k.startswith(other + '.') for other in self.set_keys)]
+        update = {"$set": {k: _nested_get(self.doc, k) for k in keys}}
+        if self.tags:
+            update["$addToSet"] = {"tags": {"$each": self.tags}}
+        return UpdateOne({"contact_id": cid}, update)
+
+
+async def _ingest_track_events(items: List[tuple], sync: bool = False) -> List[dict]:
+    """
+    Persist validated events in bulk.  items are (type, model, client_ip, user_agent,
+    received_at, event_id) tuples, in order; returns one result per item.  event_id is
+    the ingest journal's id (or None) and becomes the visit id; a visit already stored
+    under its id is skipped (_insert_visits), which makes re-applying a journaled event
+    idempotent (every contact write is a first-writer-wins $set / $addToSet).
+
+    Contacts are resolved together (one query per merge-chain hop for the whole batch),
+    every event is folded in order into an in-memory view of its contact with the same
+    rules _upsert_contact / _apply_tag apply, and the result is persisted with one
+    contacts bulk_write and one page_visits insert_many.  Every touched contact is then
+    signalled to the background stitcher once (session + email passes only after
+    identity events); with sync=True the results carry the contact ids after stitching.
+    """
+    resolved, docs = await _resolve_contact_ids({item[1].contact_id for item in items})
+    contacts: Dict[str, _BatchContact] = {}   # effective contact_id → batch view
+    visits:   List[dict] = []
+    pending:  Dict[str, dict] = {}            # effective contact_id → stitch signal for the end of the batch
+    results:  List[dict] = []
+
+    for kind, data, ip, ua, at, event_id in items:
+        eid = resolved[data.contact_id]
+        contact = contacts.get(eid)
+        if contact is None:
+            contact = contacts[eid] = _BatchContact(docs.get(eid))
+
+        if kind == 'tag':
+            if contact.doc is None:
+                contact.doc, contact.is_new = _tagged_contact_doc(eid, data.tag, data.session_id, at, ip), True
+            elif data.tag not in (contact.doc.get('tags') or []):
+                contact.doc.setdefault('tags', []).append(data.tag)
+                if not contact.is_new:
+                    contact.tags.append(data.tag)
+                contact.merge({"updated_at": dt_to_str(at)})
+            results.append({"type": kind, "raw_contact_id": data.contact_id, "status": "ok", "tag": data.tag})
+        else:
+            attribution, attribution_merged, reply = await _event_attribution(data, at)
+            fields = _event_contact_fields(kind, data, eid, attribution, ua)
+            if contact.doc is None:
+                contact.doc = _new_contact_doc(fields, at, ip)
+                contact.is_new = contact.doc is not None
+            else:
+                contact.merge(_contact_update_fields(fields, contact.doc, at, ip, attribution_merged))
+            result: dict = {"status": "ok", **reply}
+            if kind == 'pageview' or (kind == 'registration' and data.current_url):
+                vdoc = _visit_doc(eid, data.session_id, data.current_url, data.referrer_url,
+                                  data.page_title if kind == 'pageview' else (data.page_title or "Registration"),
+                                  attribution, at, ip, event_id,
+                                  data._sample_rate if kind == 'pageview' else None)
+                visits.append(vdoc)
+                result['visit_id'] = vdoc['id']
+            results.append({"type": kind, "raw_contact_id": data.contact_id, **result})
+
+        work = pending.setdefault(eid, {"email": None, "session_id": None, "identity": False, "ip": None})
+        work["ip"] = ip or work["ip"]
+        if kind in ('lead', 'registration'):
+            work["identity"] = True
+            work["email"] = data.email or work["email"]
+            work["session_id"] = data.session_id or work["session_id"]
+
+    ops = [op for op in (c.write_op(cid) for cid, c in contacts.items()) if op is not None]
+    for cid, contact in contacts.items():
+        if contact.is_new:
+            _contact_created(cid)
+    writes = []
+    if ops:
+        writes.append(db.contacts.bulk_write(ops, ordered=False))
+    if visits:
+        writes.append(_insert_visits(visits))
+    await asyncio.gather(*writes)
+
+    # Stitch passes and automations run in the background, once per contact
+    waits = {eid: _signal_stitch(eid, wait=sync, **work) for eid, work in pending.items()}
+    final_ids: Dict[str, str] = {eid: eid for eid in pending}
+    if sync:
+        finals = await asyncio.gather(*(_await_stitch(fut, eid) for eid, fut in waits.items()))
+        final_ids.update(zip(waits, finals))
+
+    for r in results:
+        raw = r.pop("raw_contact_id", None)
+        if raw:
+            r["contact_id"] = final_ids.get(resolved[raw], resolved[raw])
+    return results
+
+
+@api_router.post("/track/batch")
+async def track_batch(request: Request, sync: bool = False):
+    """
+    Ordered mixed events (pageview / lead / registration / tag): the tracker's queue,
+    flushed on a short timer or via navigator.sendBeacon on page hide, or events
+    replayed from our own form backends.  Persisted by _ingest_track_events; returns
+    one result per event, in order.  With write-behind enabled, pageview-only batches
+    are queued instead (202); with the ingest journal on, a batch Mongo cannot take is
+    answered 202 "journaled" and replayed later.  Over the rate limits the whole request
+    gets 429; under overload its pageviews and tags are shed (see Load shedding).  Events
+    from a trusted caller record their own client_ip / user_agent (if given), never the
+    caller's.
+    """
+    batch = await _parse_track_model(request, TrackBatchCreate)
+    now = datetime.now(timezone.utc)
+    ip  = get_client_ip(request)
+    ua  = request.headers.get('user-agent')
+    caller = _track_caller(request)
+    results: List[dict] = []
+    indexes: List[int]   = []          # result slot of each accepted event
+    items:   List[tuple] = []          # ingest items of the accepted events
+
+    for ev in batch.events:
+        model = TRACK_EVENT_MODELS.get(ev.type)
+        if not model:
+            results.append({"type": ev.type, "status": "error", "detail": "unknown event type"})
+            continue
+        try:
+            data = _track_model(model, ev.data)
+        except Exception as e:
+            results.append({"type": ev.type, "status": "error", "detail": str(e)})
+            continue
+        filtered = _filter_bot(ev.type, data, caller, ua, now)
+        if filtered:
+            results.append({"type": ev.type, **filtered})
+            continue
+        indexes.append(len(results))
+        if caller.trusted:
+            # A replaying backend's own address is not the visitor's: recording it would
+            # give every replayed contact the same client_ip and IP-stitch them together
+            items.append((ev.type, data, _valid_ip(ev.client_ip), ev.user_agent, now, None))
+        else:
+            items.append((ev.type, data, ip, ua, now, None))
+        results.append({})
+
+    # Rate limits cover the whole request; under overload its pageviews and tags are shed
+    kinds: Dict[str, int] = defaultdict(int)
+    contacts: Dict[str, int] = defaultdict(int)
+    for kind, data, *_ in items:
+        kinds[kind] += 1
+        contacts[data.contact_id] += 1
+    limited = _rate_limited(kinds, caller, contacts)
+    if limited:
+        return limited
+    reason = _overloaded()
+    sheddable = [j for j, (kind, *_) in enumerate(items) if kind in SHED_EVENTS] if reason else []
+    if sheddable:
+        status = await _shed([items[j] for j in sheddable], reason)
+        for j in sheddable:
+            kind, data, *_ = items[j]
+            results[indexes[j]] = {"type": kind, "status": status, "contact_id": data.contact_id}
+        shed = set(sheddable)
+        kept = [j for j in range(len(items)) if j not in shed]
+        indexes, items = [indexes[j] for j in kept], [items[j] for j in kept]
+        if not items:
+            return JSONResponse(status_code=202, content={"status": status, "count": len(results),
+                                                          "results": results})
+    pageviews = [j for j, (kind, *_) in enumerate(items) if kind == 'pageview'] if PAGEVIEW_SAMPLING_RULES else []
+    if pageviews:
+        out = await _sampled_out([items[j][1] for j in pageviews])
+        sampled = {j for j, dropped in zip(pageviews, out) if dropped}
+        for j in sampled:
+            results[indexes[j]] = {"type": "pageview", "status": "sampled", "contact_id": items[j][1].contact_id}
+        kept = [j for j in range(len(items)) if j not in sampled]
+        indexes, items = [indexes[j] for j in kept], [items[j] for j in kept]
+
+    with _InFlight():
+        # Events delivered before (or twice in this batch) get the original result back
+        keys = [_idempotency_key(data) for _, data, *_ in items]
+        seen = await _idempotency_claim(keys) if any(keys) else [None] * len(items)
+        for idx, (kind, data, *_), original in zip(indexes, items, seen):
+            if original is not None:
+                results[idx] = {"type": kind, **_duplicate_body(original, data)}
+        fresh = [j for j, original in enumerate(seen) if original is None]
+        indexes, items, keys = [indexes[j] for j in fresh], [items[j] for j in fresh], [keys[j] for j in fresh]
+
+        items = await _journal_append(items) if items else items
+        try:
+            if items and TRACK_WRITE_BEHIND and all(
+                    kind == 'pageview' and _write_behind_eligible(data) for kind, data, *_ in items):
+                if _write_behind_offer(items):
+                    for idx, (_, data, *_) in zip(indexes, items):
+                        results[idx] = {"type": "pageview", "status": "queued", "contact_id": data.contact_id,
+                                        **_attribution_preview(data)}
+                    _idempotency_store(keys, [results[idx] for idx in indexes])
+                    return JSONResponse(status_code=202, content={"status": "accepted", "count": len(results),
+                                                                  "results": results})
+
+            ingested = await _ingest_track_events(items, sync=sync) if items else []
+            _journal_ack([item[5] for item in items])
+            for idx, result in zip(indexes, ingested):
+                results[idx] = result
+            _idempotency_store(keys, ingested)
+            return _track_response({"status": "ok", "count": len(results), "results": results})
+        except Exception as e:
+            logger.error(f"Error tracking batch: {e}")
+            if items and all(item[5] for item in items):
+                for idx, (kind, data, *_) in zip(indexes, items):
+                    results[idx] = {"type": kind, "status": "journaled", "contact_id": data.contact_id}
+                _idempotency_store(keys, [results[idx] for idx in indexes])
+                return JSONResponse(status_code=202, content={"status": "journaled", "count": len(results),
+                                                              "results": results})
+            _idempotency_release(keys)
+            raise HTTPException(status_code=500, detail=str(e))
+
+
+# ─────────────────────────── Background stitching ───────────────────────────
+#
+# The email / session / IP stitch passes run off the request path.  Ingest signals a
+# changed contact (_signal_stitch) with what the event brought: email, session, IP and
+# whether it carried identity.  Signals for a contact that is already waiting fold
+# into its pending entry, and one scheduler coroutine per worker process evaluates
+# entries STITCH_COALESCE_MS after their first signal.  A burst of events for one
+# visitor therefore costs one evaluation, and a group of due contacts shares the
+# candidate prefetch of _batch_stitch_candidates.  Automations for identity events run
+# after the evaluation, with the final contact id.  Callers that need that id pass
+# ?sync=true: their entry is due at once and the request waits for it, for at most
+# STITCH_SYNC_TIMEOUT_SECONDS.  Pending work lives in memory, so a crash loses it; the
+# contact's next event signals it again.
+
+STITCH_COALESCE_MS = int(os.environ.get('STITCH_COALESCE_MS', '500'))
+STITCH_GROUP_SIZE = 200
+STITCH_SYNC_TIMEOUT_SECONDS = 5.0
+STITCH_SHUTDOWN_TIMEOUT_SECONDS = 10.0
+
+_stitch_pending: Dict[str, dict] = {}        # contact id → folded signals, due time, waiting requests
+_stitch_wakeup: Optional[asyncio.Event] = None
+_stitch_task: Optional[asyncio.Task] = None
+_stitch_stats = {"signals": 0, "coalesced": 0, "evaluated": 0, "groups": 0, "failed": 0, "last_group_ms": 0.0}
+
+
+def _signal_stitch(eid: str, email: Optional[str] = None, session_id: Optional[str] = None,
+                   ip: Optional[str] = None, identity: bool = False, wait: bool = False) -> Optional[asyncio.Future]:
+    """Queue (or fold into) a stitch evaluation for eid; with wait, a future for its final contact id."""
+    now = time.monotonic()
+    work = _stitch_pending.get(eid)
+    if work is None:
+        work = _stitch_pending[eid] = {"email": None, "session_id": None, "identity": False, "ip": None,
+                                       "due": now + STITCH_COALESCE_MS / 1000, "waiters": []}
+    else:
+        _stitch_stats["coalesced"] += 1
+    _stitch_stats["signals"] += 1
+    work["email"] = email or work["email"]
+    work["session_id"] = session_id or work["session_id"]
+    work["ip"] = ip or work["ip"]
+    work["identity"] = work["identity"] or identity
+    future = None
+    if wait:
+        work["due"] = now
+        future = asyncio.get_running_loop().create_future()
+        work["waiters"].append(future)
+    if _stitch_wakeup is not None:
+        _stitch_wakeup.set()
+    return future
+
+
+async def _await_stitch(future: Optional[asyncio.Future], eid: str) -> str:
+    """The contact id after a waited-for stitch evaluation, or eid if it does not finish in time."""
+    if future is None:
+        return eid
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), STITCH_SYNC_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        return eid
+
+
+async def _stitch_contacts(pending: Dict[str, dict], docs: Dict[str, dict], now: datetime) -> Dict[str, str]:
+    """
+    Run the stitch passes for changed contacts (docs: their stored documents) and start
+    automations for identity events; returns each contact's final id.  Passes with no
+    candidate are skipped.  A pass that does run may merge contacts, which invalidates
+    the prefetched candidates, so from then on every pass runs.
+    """
+    candidates = await _batch_stitch_candidates(pending, now) if pending else {}
+    filtered = bool(candidates)
+
+    final_ids: Dict[str, str] = {}
+    for eid, work in pending.items():
+        final = eid
+        # One unit of work per contact, seeded with the group's read of it while no pass
+        # has run (and written) yet; automations started inside it reuse its documents
+        with _ContactUnitOfWork({eid: docs.get(eid)} if filtered else None):
+            try:
+                email = (work["email"] or "").lower().strip()
+                if email and (not filtered or candidates["email"][email] - {eid}):
+                    filtered = False
+                    final = await _email_auto_stitch(final, work["email"], now)
+                if work["identity"] and work["session_id"] and (
+                        not filtered or candidates["session"][work["session_id"]] - {eid}):
+                    filtered = False
+                    await _session_auto_stitch(final, work["session_id"], now)
+                current = docs.get(eid)
+                if work["ip"] and (not filtered or candidates["ip"] is None or (current is not None and any(
+                        c["contact_id"] != eid and _ip_stitch_pair(current, c) for c in candidates["ip"][work["ip"]]))):
+                    filtered = False
+                    await _ip_auto_stitch(final, work["ip"], now)
+            except Exception as e:
+                _stitch_stats["failed"] += 1
+                filtered = False
+                logger.error(f"Stitching {eid[:12]}... failed: {e}")
+            if work["identity"]:
+                asyncio.create_task(_run_automations(final))
+        final_ids[eid] = final
+    return final_ids
+
+
+async def _stitch_group(group: Dict[str, dict]) -> None:
+    started = time.perf_counter()
+    final_ids: Dict[str, str] = {}
+    try:
+        ids = [eid for eid in group if not _absent_cache_get(eid)]
+        docs = {d["contact_id"]: d for d in await db.contacts.find(
+            {"contact_id": {"$in": ids}}, {"_id": 0}).to_list(None)} if ids else {}
+        final_ids = await _stitch_contacts(group, docs, datetime.now(timezone.utc))
+    except Exception as e:
+        _stitch_stats["failed"] += len(group)
+        logger.error(f"Stitch group of {len(group)} failed: {e}")
+    for eid, work in group.items():
+        for future in work["waiters"]:
+            if not future.done():
+                future.set_result(final_ids.get(eid, eid))
+    _stitch_stats["evaluated"] += len(group)
+    _stitch_stats["groups"] += 1
+    _stitch_stats["last_group_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+
+async def _stitch_scheduler(wakeup: asyncio.Event) -> None:
+    while True:
+        now = time.monotonic()
+        due = [eid for eid, work in _stitch_pending.items() if work["due"] <= now][:STITCH_GROUP_SIZE]
+        if due:
+            await _stitch_group({eid: _stitch_pending.pop(eid) for eid in due})
+            continue
+        wakeup.clear()
+        next_due = min((work["due"] for work in _stitch_pending.values()), default=None)
+        try:
+            await asyncio.wait_for(wakeup.wait(), None if next_due is None else next_due - now)
+        except asyncio.TimeoutError:
+            pass
+
+
+def _stitch_metrics() -> dict:
+    return {"pending": len(_stitch_pending), "coalesce_ms": STITCH_COALESCE_MS, **_stitch_stats,
+            "contact_reads": dict(_contact_uow_stats)}
+
+
+# ─────────────────────────── Write-behind pageview ingestion ───────────────────────────
+#
+# Opt-in (TRACK_WRITE_BEHIND=1).  Nothing in the tracker waits on a pageview's result,
+# so /track/pageview and pageview-only /track/batch requests are validated, put on a
+# bounded in-process queue and answered 202 immediately.  Worker coroutines drain the
+# queue in micro-batches through _ingest_track_events.  When the queue is full the
+# request falls back to writing inline — the caller absorbs the backpressure and
+# nothing is dropped.  Each uvicorn worker process has its own queue.
+
+TRACK_WRITE_BEHIND = os.environ.get('TRACK_WRITE_BEHIND', '').lower() in ('1', 'true', 'yes')
+WRITE_BEHIND_QUEUE_SIZE = int(os.environ.get('TRACK_WRITE_BEHIND_QUEUE_SIZE', '10000'))
+WRITE_BEHIND_BATCH_SIZE = 200
+WRITE_BEHIND_BATCH_WAIT_MS = 50
+WRITE_BEHIND_WORKERS = 2
+WRITE_BEHIND_RETRIES = 3
+WRITE_BEHIND_SHUTDOWN_TIMEOUT_SECONDS = 10
+
+_write_behind_queue: Optional[asyncio.Queue] = None
+_write_behind_tasks: List[asyncio.Task] = []
+_write_behind_stats: Dict[str, Any] = {
+    "enqueued": 0, "written": 0, "failed": 0, "batches": 0,
+    "overflow_inline": 0, "max_depth": 0, "last_batch_size": 0, "last_batch_ms": 0.0,
+}
+
+
+def _write_behind_eligible(data: BaseModel) -> bool:
+    """
+    A bare attribution_hash this worker has not seen may be unknown to the server, and
+    the tracker only re-sends the full object when told so — such events go inline.
+    """
+    return data.attribution is not None or not data.attribution_hash or data.attribution_hash in _attribution_fp_cache
+
+
+def _attribution_preview(data: BaseModel) -> dict:
+    """attribution_ack for a queued event, computed without touching the database."""
+    if data.attribution is None:
+        return {}
+    return {'attribution_ack': _attribution_fingerprint(_clean_attribution(data.attribution))}
+
+
+def _write_behind_offer(items: List[tuple]) -> bool:
+    """Queue ingest items; False (nothing queued) when write-behind is off or the queue is full."""
+    queue = _write_behind_queue
+    if queue is None or queue.maxsize - queue.qsize() < len(items):
+        if queue is not None:
+            _write_behind_stats["overflow_inline"] += len(items)
+        return False
+    for item in items:
+        queue.put_nowait(item)
+    _write_behind_stats["enqueued"] += len(items)
+    _write_behind_stats["max_depth"] = max(_write_behind_stats["max_depth"], queue.qsize())
+    return True
+
+
+async def _write_behind_flush(batch: List[tuple]) -> None:
+    started = time.perf_counter()
+    for attempt in range(WRITE_BEHIND_RETRIES):
+        try:
+            await _ingest_track_events(batch)
+            _journal_ack([item[5] for item in batch])
+            _write_behind_stats["written"] += len(batch)
+            break
+        except Exception as e:
+            if attempt == WRITE_BEHIND_RETRIES - 1:
+                _write_behind_stats["failed"] += len(batch)
+                journaled = sum(1 for item in batch if item[5])
+                logger.error(f"Write-behind: {len(batch)} pageviews failed after {WRITE_BEHIND_RETRIES} attempts "
+                             f"({journaled} left to the journal replayer): {e}")
+            else:
+                await asyncio.sleep(0.5 * (attempt + 1))
+    _write_behind_stats["batches"] += 1
+    _write_behind_stats["last_batch_size"] = len(batch)
+    _write_behind_stats["last_batch_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+
+async def _write_behind_worker(queue: asyncio.Queue) -> None:
+    """Take up to WRITE_BEHIND_BATCH_SIZE items, or whatever arrived within the wait, and flush them."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + WRITE_BEHIND_BATCH_WAIT_MS / 1000
+        while len(batch) < WRITE_BEHIND_BATCH_SIZE:
+            try:
+                batch.append(queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        try:
+            await _write_behind_flush(batch)
+        finally:
+            for _ in batch:
+                queue.task_done()
+
+
+def _write_behind_metrics() -> dict:
+    queue = _write_behind_queue
+    return {
+        "enabled":  TRACK_WRITE_BEHIND,
+        "depth":    queue.qsize() if queue else 0,
+        "capacity": WRITE_BEHIND_QUEUE_SIZE,
+        "workers":  len(_write_behind_tasks),
+        **_write_behind_stats,
+    }
+
+
+# ─────────────────────────── Ingest journal ───────────────────────────
+#
+# Opt-in (TRACK_JOURNAL_DIR).  Every accepted /track/* event is appended to a local
+# append-only journal before it is written to Mongo.  Appends are group-committed: the
+# request waits for the next fsync, which covers every append made in the meantime.  A
+# successful write acknowledges the event; when Mongo is down or stalls, the request
+# answers 202 "journaled" instead of 500 and the replayer applies the event once Mongo
+# is back.  The replayer also catches up after a crash or restart: unacknowledged
+# events are re-applied with their journal id as the visit id, so applying an event
+# twice stores it once (see _ingest_track_events).
+#
+# Segments are JSON lines: {"id", "type", "data", "ip", "ua", "at"} per event and
+# {"ack": [ids]} per acknowledgement.  A segment is deleted once it and every older
+# segment are fully acknowledged.  Each uvicorn worker locks its own slot directory,
+# so the two workers never share a file and a restarted worker picks up its slot.
+
+TRACK_JOURNAL_DIR = os.environ.get('TRACK_JOURNAL_DIR', '')
+JOURNAL_SLOTS = 8
+JOURNAL_SEGMENT_MAX_BYTES = 16 * 1024 * 1024
+JOURNAL_FSYNC_WAIT_MS = 2            # let concurrent appends join the same fsync
+JOURNAL_REPLAY_GRACE_SECONDS = 10    # inline writes get this long to acknowledge before the replayer takes over
+JOURNAL_REPLAY_INTERVAL_SECONDS = 1
+JOURNAL_REPLAY_BATCH_SIZE = 200
+
+
+class _IngestJournal:
+    def __init__(self, slot: Path, lock_fd: int):
+        self.slot = slot
+        self.lock_fd = lock_fd
+        self.pending: Dict[str, tuple] = {}      # event id → (record, segment, appended at); append order
+        self.unacked: Dict[int, int] = {}        # segment → unacknowledged events in it
+        self.segment = 0
+        self.file = None
+        self.size = 0
+        self.waiters: List[tuple] = []           # (future, event ids) waiting for the next fsync
+        self.sync_task: Optional[asyncio.Task] = None
+        self.stats: Dict[str, Any] = {
+            "appended": 0, "acked": 0, "replayed": 0, "replay_failed": 0, "recovered": 0,
+            "append_failed": 0, "abandoned": 0, "fsyncs": 0, "last_fsync_ms": 0.0, "last_replay_error": None,
+        }
+
+    @classmethod
+    def open(cls, directory: str) -> Optional['_IngestJournal']:
+        """Claim the first free slot under directory and load what it still holds."""
+        import fcntl
+        for n in range(JOURNAL_SLOTS):
+            slot = Path(directory) / f"slot-{n}"
+            slot.mkdir(parents=True, exist_ok=True)
+            fd = os.open(slot / "LOCK", os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                continue
+            journal = cls(slot, fd)
+            journal._load()
+            return journal
+        return None
+
+    def _segments(self) -> List[int]:
+        return sorted(int(p.stem.split('-')[1]) for p in self.slot.glob("segment-*.jsonl"))
+
+    def _segment_path(self, n: int) -> Path:
+        return self.slot / f"segment-{n:010d}.jsonl"
+
+    def _load(self) -> None:
+        segments = self._segments()
+        for n in segments:
+            self.unacked[n] = 0
+            with open(self._segment_path(n), encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue            # torn tail of a write that never reached fsync
+                    if "ack" in rec:
+                        for eid in rec["ack"]:
+                            entry = self.pending.pop(eid, None)
+                            if entry:
+                                self.unacked[entry[1]] -= 1
+                    else:
+                        self.pending[rec["id"]] = (rec, n, 0.0)
+                        self.unacked[n] += 1
+        self.stats["recovered"] = len(self.pending)
+        self.segment = (segments[-1] + 1) if segments else 0
+        self._open_segment()
+        self._collect()
+
+    def _open_segment(self) -> None:
+        self.file = open(self._segment_path(self.segment), 'a', encoding='utf-8')
+        self.size = 0
+        self.unacked.setdefault(self.segment, 0)
+
+    def _collect(self) -> None:
+        """Delete fully acknowledged segments, oldest first, up to the first one still needed."""
+        for n in sorted(self.unacked):
+            if n == self.segment or self.unacked[n] > 0:
+                break
+            self._segment_path(n).unlink(missing_ok=True)
+            del self.unacked[n]
+
+    def _write(self, rec: dict) -> None:
+        line = json.dumps(rec, separators=(',', ':')) + "\n"
+        self.file.write(line)
+        self.size += len(line)
+
+    async def append(self, items: List[tuple]) -> List[str]:
+        """Journal (type, model, ip, ua, at, _) items; returns their event ids once they are on disk."""
+        ids, appended_at = [], time.monotonic()
+        try:
+            for kind, data, ip, ua, at, _ in items:
+                rec = {"id": str(uuid.uuid4()), "type": kind, "data": data.model_dump(mode='json', exclude_none=True),
+                       "ip": ip, "ua": ua, "at": dt_to_str(at)}
+                if getattr(data, '_sample_rate', None):
+                    rec["sample_rate"] = data._sample_rate       # private, so not in the dump
+                self._write(rec)
+                self.pending[rec["id"]] = (rec, self.segment, appended_at)
+                self.unacked[self.segment] += 1
+                ids.append(rec["id"])
+        except Exception:
+            self._abandon(ids)
+            raise
+        self.stats["appended"] += len(ids)
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append((waiter, ids))
+        if self.sync_task is None:
+            self.sync_task = asyncio.create_task(self._sync())
+        await waiter
+        return ids
+
+    async def _sync(self) -> None:
+        try:
+            await asyncio.sleep(JOURNAL_FSYNC_WAIT_MS / 1000)
+            while self.waiters:
+                waiters, self.waiters = self.waiters, []
+                started = time.perf_counter()
+                try:
+                    self.file.flush()
+                    await asyncio.to_thread(os.fsync, self.file.fileno())
+                except Exception as e:
+                    self._abandon([eid for _, ids in waiters for eid in ids])
+                    for w, _ in waiters:
+                        w.set_exception(e)
+                    continue
+                self.stats["fsyncs"] += 1
+                self.stats["last_fsync_ms"] = round((time.perf_counter() - started) * 1000, 2)
+                for w, _ in waiters:
+                    w.set_result(None)
+            # Nothing is mid-fsync here, so the segment can be rolled safely
+            if self.size >= JOURNAL_SEGMENT_MAX_BYTES:
+                self.file.close()
+                self.segment += 1
+                self._open_segment()
+                self._collect()
+        finally:
+            self.sync_task = None
+
+    def _abandon(self, ids: List[str]) -> None:
+        """
+        Forget events whose append failed.  The caller writes them inline under visit ids
+        of its own, so a later replay under the journal ids would store them twice.
+        """
+        for eid in ids:
+            entry = self.pending.pop(eid, None)
+            if entry:
+                self.unacked[entry[1]] -= 1
+        if ids:
+            self.stats["abandoned"] += len(ids)
+            try:
+                self._write({"ack": ids})    # so a restart does not recover them either, if the disk allows
+            except Exception:
+                pass
+            self._collect()
+
+    def ack(self, ids: List[str]) -> None:
+        acked = []
+        for eid in ids:
+            entry = self.pending.pop(eid, None)
+            if entry:
+                self.unacked[entry[1]] -= 1
+                acked.append(eid)
+        if acked:
+            self._write({"ack": acked})      # not fsynced: losing it only means a harmless re-apply
+            self.stats["acked"] += len(acked)
+            self._collect()
+
+    def due(self, limit: int) -> List[dict]:
+        """Oldest unacknowledged events whose inline write has had its grace period."""
+        cutoff = time.monotonic() - JOURNAL_REPLAY_GRACE_SECONDS
+        out = []
+        for rec, _, appended_at in self.pending.values():
+            if appended_at > cutoff:
+                break
+            out.append(rec)
+            if len(out) >= limit:
+                break
+        return out
+
+    def metrics(self) -> dict:
+        oldest = next(iter(self.pending.values()), None)
+        lag = (datetime.now(timezone.utc) - datetime.fromisoformat(oldest[0]["at"])).total_seconds() if oldest else 0
+        return {
+            "enabled":    True,
+            "slot":       self.slot.name,
+            "pending":    len(self.pending),
+            "lag_seconds": round(lag, 1),
+            "oldest_pending_at": oldest[0]["at"] if oldest else None,
+            "segments":   len(self.unacked),
+            "segment_bytes": self.size,
+            **self.stats,
+        }
+
+    async def close(self) -> None:
+        if self.sync_task:
+            await self.sync_task
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.close(self.lock_fd)
+
+
+_journal: Optional[_IngestJournal] = None
+_journal_replayer: Optional[asyncio.Task] = None
+
+
+async def _journal_append(items: List[tuple]) -> List[tuple]:
+    """
+    Journal ingest items and return them with their event ids filled in.  With the
+    journal off, or the disk failing, the items come back unchanged (event id None)
+    and are written inline exactly as before.
+    """
+    if _journal is None:
+        return items
+    try:
+        ids = await _journal.append(items)
+    except Exception as e:
+        _journal.stats["append_failed"] += len(items)
+        logger.error(f"Ingest journal append failed, writing inline only: {e}")
+        return items
+    return [item[:5] + (eid,) for item, eid in zip(items, ids)]
+
+
+def _journal_ack(event_ids: List[Optional[str]]) -> None:
+    if _journal is not None:
+        _journal.ack([eid for eid in event_ids if eid])
+
+
+def _journaled_response(content: dict) -> JSONResponse:
+    """Answer for an event Mongo could not take right now but the journal holds."""
+    return JSONResponse(status_code=202, content={**content, "status": "journaled"})
+
+
+def _journal_item(rec: dict) -> tuple:
+    """The ingest item a journal record was appended from."""
+    data = TRACK_EVENT_MODELS[rec["type"]](**rec["data"])
+    if rec.get("sample_rate"):
+        data._sample_rate = rec["sample_rate"]
+    return rec["type"], data, rec.get("ip"), rec.get("ua"), datetime.fromisoformat(rec["at"]), rec["id"]
+
+
+async def _journal_replay_loop(journal: _IngestJournal) -> None:
+    backoff = JOURNAL_REPLAY_INTERVAL_SECONDS
+    while True:
+        await asyncio.sleep(backoff)
+        records = journal.due(JOURNAL_REPLAY_BATCH_SIZE)
+        if not records:
+            backoff = JOURNAL_REPLAY_INTERVAL_SECONDS
+            continue
+        items, unreadable = [], []
+        for rec in records:
+            try:
+                items.append(_journal_item(rec))
+            except Exception as e:
+                logger.error(f"Ingest journal: dropping unreadable event {rec.get('id')}: {e}")
+                unreadable.append(rec.get("id"))
+        journal.ack(unreadable)
+        try:
+            if items:
+                await _ingest_track_events(items)
+        except Exception as e:
+            journal.stats["replay_failed"] += len(items)
+            journal.stats["last_replay_error"] = str(e)[:200]
+            backoff = min(backoff * 2, 30)
+            logger.warning(f"Ingest journal replay of {len(records)} events failed, retrying in {backoff}s: {e}")
+            continue
+        journal.ack([item[5] for item in items])
+        journal.stats["replayed"] += len(items)
+        backoff = 0 if len(records) == JOURNAL_REPLAY_BATCH_SIZE else JOURNAL_REPLAY_INTERVAL_SECONDS
+
+
+@api_router.post("/track/rum", status_code=204)
+async def track_rum(request: Request):
+    """Timing beacon from sampled tracker page loads; folded into per-minute histograms."""
+    report = await _parse_track_model(request, TrackerRumReport)
+    ops = _rum_updates(report, datetime.now(timezone.utc))
+    if ops:
+        try:
+            await db.tracker_rum.bulk_write(ops, ordered=False)
+        except Exception as e:
+            logger.warning(f"RUM write failed: {e}")
+    return Response(status_code=204)
+
+
+@api_router.get("/tracker/rum")
+async def get_tracker_rum(minutes: int = Query(60, ge=1, le=RUM_RETENTION_DAYS * 1440),
+                          domain: Optional[str] = None, version: Optional[str] = None):
+    """
+    Field performance of the tracker over the last `minutes`, by page domain:
+    count / mean / p50 / p95 / p99 for each timing, totals and per-report rates for counters.
+    """
+    since = datetime.now(timezone.utc).replace(second=0, microsecond=0) - timedelta(minutes=minutes - 1)
+    query: dict = {"minute": {"$gte": dt_to_str(since)}}
+    if domain:
+        query["domain"] = domain.strip().lower()
+    if version:
+        query["version"] = version
+    # The per-minute histograms are merged in Mongo: one row per (domain, metric) with
+    # its count, sum and at most len(RUM_BUCKETS_MS) + 1 summed buckets comes back,
+    # however many minutes and versions the window spans.  Only the percentile
+    # interpolation over those buckets is done here.
+    pipeline = [
+        {"$match": query},
+        {"$project": {"domain": 1, "metric": 1, "count": 1, "sum": 1,
+                      "buckets": {"$objectToArray": {"$ifNull": ["$buckets", {}]}}}},
+        {"$unwind": {"path": "$buckets", "includeArrayIndex": "i", "preserveNullAndEmptyArrays": True}},
+        # count and sum once per row (on its first bucket), bucket counts per bucket
+        {"$group": {"_id": {"domain": "$domain", "metric": "$metric", "bucket": "$buckets.k"},
+                    "n":     {"$sum": {"$ifNull": ["$buckets.v", 0]}},
+                    "count": {"$sum": {"$cond": [{"$gt": [{"$ifNull": ["$i", 0]}, 0]}, 0, "$count"]}},
+                    "sum":   {"$sum": {"$cond": [{"$gt": [{"$ifNull": ["$i", 0]}, 0]}, 0, "$sum"]}}}},
+        {"$group": {"_id": {"domain": "$_id.domain", "metric": "$_id.metric"},
+                    "count": {"$sum": "$count"}, "sum": {"$sum": "$sum"},
+                    "buckets": {"$push": {"k": "$_id.bucket", "n": "$n"}}}},
+    ]
+    try:
+        rows = await db.tracker_rum.aggregate(pipeline).to_list(None)
+    except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    merged: Dict[str, Dict[str, dict]] = defaultdict(dict)
+    for row in rows:
+        merged[row["_id"]["domain"]][row["_id"]["metric"]] = {
+            "count": row["count"], "sum": row["sum"],
+            "buckets": {b["k"]: b["n"] for b in row["buckets"] if b.get("k") is not None},
+        }
+
+    domains: Dict[str, dict] = {}
+    for dom, metrics in sorted(merged.items()):
+        out: dict = {}
+        for metric, agg in sorted(metrics.items()):
+            if metric in RUM_COUNTERS:
+                out[metric] = {"reports": agg["count"], "total": agg["sum"],
+                               "per_report": round(agg["sum"] / agg["count"], 3) if agg["count"] else None}
+            else:
+                out[metric] = {
+                    "count": agg["count"],
+                    "mean":  round(agg["sum"] / agg["count"], 1) if agg["count"] else None,
+                    "p50":   _rum_percentile(agg["buckets"], agg["count"], 0.50),
+                    "p95":   _rum_percentile(agg["buckets"], agg["count"], 0.95),
+                    "p99":   _rum_percentile(agg["buckets"], agg["count"], 0.99),
+                }
+        domains[dom] = out
+    return {"window_minutes": minutes, "since": dt_to_str(since), "domains": domains}
+
+
+@api_router.get("/ingest/metrics")
+async def ingest_metrics():
+    """Ingestion pipeline health for this worker process."""
+    return {
+        "pid":          os.getpid(),
+        "write_behind": _write_behind_metrics(),
+        "journal":      _journal.metrics() if _journal else {"enabled": False},
+        "resolve_cache": {"size": len(_resolve_cache), "capacity": RESOLVE_CACHE_MAX_ENTRIES,
+                          **_resolve_cache_stats},
+        "absent_cache":  _absent_cache_metrics(),
+        "idempotency":   {"front_cache_size": len(_idempotency_cache), **_idempotency_stats},
+        "shedding":      _shed_metrics(),
+        "sampling":      _sampling_metrics(),
+        "stitching":     _stitch_metrics(),
+    }
+
+
+@api_router.get("/ingest/bots")
+async def ingest_bot_stats(days: int = Query(7, ge=1, le=BOT_STATS_RETENTION_DAYS)):
+    """Filtered bot volume per day, reason and domain (all workers, plus this worker's unflushed counts)."""
+    since = (datetime.now(timezone.utc) - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    rows = await db.bot_traffic.find({"day": {"$gte": since}}, {"_id": 0, "expire_at": 0}).to_list(None)
+    counts: Dict[tuple, int] = defaultdict(int)
+    for r in rows:
+        counts[(r["day"], r["reason"], r["domain"])] += r.get("count", 0)
+    for key, n in _bot_counts.items():
+        if key[0] >= since:
+            counts[key] += n
+    by_day: Dict[str, int] = defaultdict(int)
+    by_reason: Dict[str, int] = defaultdict(int)
+    by_domain: Dict[str, int] = defaultdict(int)
+    for (day, reason, domain), n in counts.items():
+        by_day[day] += n
+        by_reason[reason] += n
+        by_domain[domain] += n
+    return {
+        "enabled":   BOT_FILTER,
+        "days":      days,
+        "total":     sum(counts.values()),
+        "by_day":    dict(sorted(by_day.items())),
+        "by_reason": dict(sorted(by_reason.items(), key=lambda kv: -kv[1])),
+        "by_domain": dict(sorted(by_domain.items(), key=lambda kv: -kv[1])[:50]),
+    }
+
 
 @api_router.post("/track/stitch")
 async def track_stitch(data: StitchRequest, request: Request):
@@ -2061,10 +5255,10 @@ async def get_contacts(search: Optional[str] = None, include_merged: bool = Fals
         contact_ids   = [c['contact_id'] for c in contacts_raw]
         visit_pipeline = [
             {"$match":   {"contact_id": {"$in": contact_ids}}},
-            {"$group":   {"_id": "$contact_id", "count": {"$sum": 1}}},
+            {"$group":   {"_id": "$contact_id", "count": {"$sum": VISIT_WEIGHT}}},
         ]
         visit_counts_raw = await db.page_visits.aggregate(visit_pipeline).to_list(len(contact_ids) + 1)
-        visit_count_map  = {v["_id"]: v["count"] for v in visit_counts_raw}
+        visit_count_map  = {v["_id"]: round(v["count"]) for v in visit_counts_raw}
 
         result = []
         for c in contacts_raw:
@@ -2133,14 +5327,43 @@ async def delete_contact(contact_id: str):
 async def get_stats():
     try:
         total_contacts = await db.contacts.count_documents({"merged_into": None})
-        total_visits   = await db.page_visits.count_documents({})
+        total_visits   = await _weighted_visit_count({})
+        rolled_up      = await db.visit_rollups.aggregate(
+            [{"$group": {"_id": None, "visits": {"$sum": "$visits"}}}]).to_list(1)
+        total_visits  += round(rolled_up[0]["visits"]) if rolled_up else 0
         today_start    = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
-        today_visits   = await db.page_visits.count_documents({"timestamp": {"$gte": dt_to_str(today_start)}})
+        today_visits   = await _weighted_visit_count({"timestamp": {"$gte": dt_to_str(today_start)}})
         return {"total_contacts": total_contacts, "total_visits": total_visits, "today_visits": today_visits}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@api_router.get("/visits/rollups")
+async def get_visit_rollups(days: int = Query(30, ge=1, le=3650), limit: int = Query(20, ge=1, le=500)):
+    """Rolled-up anonymous visits (see Anonymous visit rollup): per day, and the top URLs and sources."""
+    since = (datetime.now(timezone.utc) - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    rows = await db.visit_rollups.find({"day": {"$gte": since}}, {"_id": 0}).to_list(None)
+    by_day: Dict[str, float] = defaultdict(float)
+    by_url: Dict[str, float] = defaultdict(float)
+    by_source: Dict[str, float] = defaultdict(float)
+    for r in rows:
+        by_day[r["day"]] += r["visits"]
+        by_url[r["url"]] += r["visits"]
+        by_source[r["source"]] += r["visits"]
+
+    def top(counts: Dict[str, float]) -> List[dict]:
+        ranked = sorted(counts.items(), key=lambda kv: kv[1], reverse=True)[:limit]
+        return [{"key": k, "visits": round(n)} for k, n in ranked]
+
+    return {
+        "retention_days": VISIT_ROLLUP_DAYS,
+        "total":   round(sum(by_day.values())),
+        "by_day":  [{"day": d, "visits": round(by_day[d])} for d in sorted(by_day)],
+        "urls":    top(by_url),
+        "sources": top(by_source),
+    }
+
+
 class LeadsExportRequest(BaseModel):
     ids:    Optional[List[str]] = None   # specific contact IDs (PDF export path)
     since:  Optional[str] = None
@@ -3138,6 +6361,24 @@ async def get_stealth_registrations(limit: int = 1000):
 
 # ─────────────────────────── Startup: create indexes ───────────────────────────
 
+async def _create_visit_id_index() -> None:
+    """
+    Unique visit ids: replaying a journaled event relies on it (see _insert_visits).
+    Replaces the earlier non-unique index of the same name.  Duplicates already stored
+    keep the unique index from building; they are logged and the old index is kept.
+    """
+    existing = (await db.page_visits.index_information()).get("id_1")
+    if existing and existing.get("unique"):
+        return
+    try:
+        if existing:
+            await db.page_visits.drop_index("id_1")
+        await db.page_visits.create_index("id", unique=True, sparse=True)
+    except Exception as e:
+        logger.error(f"page_visits.id unique index not built (duplicate visit ids?): {e}")
+        await db.page_visits.create_index("id", sparse=True)
+
+
 @app.on_event("startup")
 async def create_indexes():
     try:
@@ -3146,12 +6387,19 @@ async def create_indexes():
         await db.contacts.create_index("session_id",   sparse=True)
         await db.contacts.create_index("client_ip",    sparse=True)
         await db.contacts.create_index("merged_into",  sparse=True)
+        await db.stitch_invalidations.create_index("at")
+        await db.stitch_invalidations.create_index("expire_at", expireAfterSeconds=0)
         await db.contacts.create_index("created_at")
         await db.contacts.create_index("tags",         sparse=True)
         await db.page_visits.create_index("contact_id")
+        await _create_visit_id_index()
         await db.page_visits.create_index("session_id", sparse=True)
         await db.page_visits.create_index("timestamp")
         await db.page_visits.create_index([("contact_id", 1), ("timestamp", 1)])
+        await db.page_visits.create_index([("timestamp", 1), ("_id", 1)])
+        await db.page_visits.create_index("sample_rate", sparse=True)
+        await db.page_visits.create_index("rollup_recheck", sparse=True)
+        await db.visit_rollups.create_index([("day", 1), ("url", 1), ("source", 1)], unique=True)
         await db.automations.create_index("id", unique=True, sparse=True)
         await db.automations.create_index("enabled")
         await db.automation_runs.create_index("automation_id")
@@ -3172,11 +6420,106 @@ async def create_indexes():
         await db.sales.create_index("contact_id", sparse=True)
         await db.sales.create_index("email",      sparse=True)
         await db.sales.create_index("created_at")
+        await db.attribution_fingerprints.create_index("hash", unique=True)
+        await db.track_idempotency.create_index("expire_at", expireAfterSeconds=0)
+        await db.bot_traffic.create_index([("day", 1), ("reason", 1), ("domain", 1)], unique=True)
+        await db.bot_traffic.create_index("expire_at", expireAfterSeconds=0)
+        await db.tracker_rum.create_index(
+            [("minute", 1), ("domain", 1), ("version", 1), ("metric", 1)], unique=True
+        )
+        await db.tracker_rum.create_index("expire_at", expireAfterSeconds=0)
         logger.info("MongoDB indexes created/verified")
     except Exception as e:
         logger.warning(f"Index creation warning: {e}")
 
 
+@app.on_event("startup")
+async def build_tracker_assets():
+    """Build (minify + compress) the default tracker assets before the first page load asks for them."""
+    try:
+        backend_url = os.environ.get('REACT_APP_BACKEND_URL', '')
+        core = _get_tracker_asset(backend_url, '')
+        forms = _get_forms_asset()
+        _get_loader_asset(backend_url)
+        gz = len(core['gzip'])
+        logger.info(
+            f"Tracker v{TRACKER_VERSION} built: {len(core['identity'])} bytes minified, "
+            f"{gz} gzipped (budget {TRACKER_GZIP_BUDGET_BYTES}); "
+            f"forms module {len(forms['gzip'])} gzipped"
+        )
+        if gz > TRACKER_GZIP_BUDGET_BYTES:
+            logger.warning(f"Tracker is over its size budget by {gz - TRACKER_GZIP_BUDGET_BYTES} bytes")
+    except Exception as e:
+        logger.warning(f"Tracker build warning: {e}")
+
+
+@app.on_event("startup")
+async def start_bot_filter():
+    if not BOT_FILTER:
+        return
+    ranges = _load_datacenter_ranges(BOT_DATACENTER_RANGES_FILE)
+    asyncio.create_task(_bot_stats_flusher())
+    logger.info(f"Bot filter on: {ranges} datacenter ranges from {BOT_DATACENTER_RANGES_FILE}")
+
+
+@app.on_event("startup")
+async def start_stitch_scheduler():
+    global _stitch_wakeup, _stitch_task
+    _stitch_wakeup = asyncio.Event()
+    _stitch_task = asyncio.create_task(_stitch_scheduler(_stitch_wakeup))
+
+
+@app.on_event("startup")
+async def start_mongo_latency_probe():
+    if TRACK_SHED_LATENCY_MS:
+        asyncio.create_task(_mongo_latency_probe())
+
+
+@app.on_event("startup")
+async def start_visit_rollup():
+    if VISIT_ROLLUP_DAYS <= 0:
+        return
+    await db.visit_rollup_state.update_one({"_id": VISIT_ROLLUP_STATE_ID},
+                                           {"$setOnInsert": {"lease_until": ""}}, upsert=True)
+    asyncio.create_task(_visit_rollup_loop())
+    logger.info(f"Visit rollup on: anonymous visits older than {VISIT_ROLLUP_DAYS} days are aggregated")
+
+
+@app.on_event("startup")
+async def start_resolve_cache_sync():
+    asyncio.create_task(_sync_resolve_cache())
+
+
+@app.on_event("startup")
+async def start_write_behind():
+    global _write_behind_queue
+    if not TRACK_WRITE_BEHIND:
+        return
+    _write_behind_queue = asyncio.Queue(maxsize=WRITE_BEHIND_QUEUE_SIZE)
+    _write_behind_tasks.extend(
+        asyncio.create_task(_write_behind_worker(_write_behind_queue)) for _ in range(WRITE_BEHIND_WORKERS)
+    )
+    logger.info(f"Write-behind pageview ingestion on: queue {WRITE_BEHIND_QUEUE_SIZE}, "
+                f"{WRITE_BEHIND_WORKERS} workers, batches of {WRITE_BEHIND_BATCH_SIZE}")
+
+
+@app.on_event("startup")
+async def open_ingest_journal():
+    global _journal, _journal_replayer
+    if not TRACK_JOURNAL_DIR:
+        return
+    try:
+        _journal = _IngestJournal.open(TRACK_JOURNAL_DIR)
+    except Exception as e:
+        logger.error(f"Ingest journal unavailable, tracking writes go straight to MongoDB: {e}")
+        return
+    if _journal is None:
+        logger.error(f"Ingest journal: all {JOURNAL_SLOTS} slots under {TRACK_JOURNAL_DIR} are taken")
+        return
+    _journal_replayer = asyncio.create_task(_journal_replay_loop(_journal))
+    logger.info(f"Ingest journal on: {_journal.slot}, {len(_journal.pending)} events to replay")
+
+
 app.include_router(api_router)
 app.add_middleware(
     CORSMiddleware,
@@ -3187,6 +6530,72 @@ app.add_middleware(
 )
 
 
+# Browsers cap this (Chrome at 2h, Firefox at 24h) but it still lets any remaining
+# preflight (e.g. server-to-server JSON callers from a browser) be reused instead of
+# doubling every /track/* call.
+TRACK_PREFLIGHT_MAX_AGE = 86400
+
+
+@app.middleware("http")
+async def cache_track_preflights(request: Request, call_next):
+    response = await call_next(request)
+    if request.method == "OPTIONS" and request.url.path.startswith("/api/track/"):
+        response.headers["Access-Control-Max-Age"] = str(TRACK_PREFLIGHT_MAX_AGE)
+    return response
+
+
+@app.on_event("shutdown")
+async def drain_write_behind():
+    """Stop accepting, flush what is queued (bounded wait), then stop the workers."""
+    global _write_behind_queue
+    queue, _write_behind_queue = _write_behind_queue, None
+    if queue is None:
+        return
+    try:
+        await asyncio.wait_for(queue.join(), WRITE_BEHIND_SHUTDOWN_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        logger.error(f"Write-behind: shutting down with {queue.qsize()} pageviews still queued")
+    for task in _write_behind_tasks:
+        task.cancel()
+    await asyncio.gather(*_write_behind_tasks, return_exceptions=True)
+    _write_behind_tasks.clear()
+
+
+@app.on_event("shutdown")
+async def drain_stitch_queue():
+    """Evaluate every pending stitch now (bounded wait), then stop the scheduler."""
+    if _stitch_task is None:
+        return
+    for work in _stitch_pending.values():
+        work["due"] = 0.0
+    _stitch_wakeup.set()
+    deadline = time.monotonic() + STITCH_SHUTDOWN_TIMEOUT_SECONDS
+    while _stitch_pending and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    if _stitch_pending:
+        logger.error(f"Stitching: shutting down with {len(_stitch_pending)} contacts still pending")
+    _stitch_task.cancel()
+    await asyncio.gather(_stitch_task, return_exceptions=True)
+
+
+@app.on_event("shutdown")
+async def close_ingest_journal():
+    """Unacknowledged events stay on disk and are replayed on the next start."""
+    global _journal
+    journal, _journal = _journal, None
+    if journal is None:
+        return
+    if _journal_replayer:
+        _journal_replayer.cancel()
+        await asyncio.gather(_journal_replayer, return_exceptions=True)
+    await journal.close()
+
+
+@app.on_event("shutdown")
+async def flush_bot_stats():
+    await _flush_bot_counts()
+
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
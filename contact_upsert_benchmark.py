@@ -0,0 +1,130 @@
+"""
+Contact upsert benchmark — MongoDB round trips and latency per tracked event, before vs after.
+
+Feeds the same synthetic pageview stream through two implementations of the contact
+upsert against a real MongoDB:
+
+  two-step  the previous _upsert_contact: find_one on the full contact document, then
+            update_one or insert_one decided in Python.
+  pipeline  the current _upsert_contact: one update_one with an update pipeline
+            (upsert unless the event is a blank anonymous page load).
+
+Per contact the stream is a first pageview with attribution (creates the contact),
+then repeat pageviews on the known contact — the hot path.  Round trips are counted
+with a pymongo command listener.  Use a throwaway database:
+    python contact_upsert_benchmark.py mongodb://localhost:27017 500 5
+
+Usage:  python contact_upsert_benchmark.py [mongo_url] [contacts] [pageviews_per_contact]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'contact_upsert_bench')
+sys.path.insert(0, str(Path(__file__).resolve().parent / 'backend'))
+
+import server  # noqa: E402
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+async def two_step_upsert(data, now, client_ip=None, attribution_merged=False):
+    """The pre-pipeline _upsert_contact (read, decide in Python, write)."""
+    cid = data.get('contact_id')
+    existing = await server.db.contacts.find_one({"contact_id": cid}, {"_id": 0})
+    if existing:
+        update = server._contact_update_fields(data, existing, now, client_ip, attribution_merged)
+        await server.db.contacts.update_one({"contact_id": cid}, {"$set": update})
+        return
+    cdoc = server._new_contact_doc(data, now, client_ip)
+    if cdoc is not None:
+        await server.db.contacts.insert_one(cdoc)
+
+
+class ContactUpsertBenchmark:
+    def __init__(self, mongo_url):
+        self.counter = CommandCounter()
+        self.client = AsyncIOMotorClient(mongo_url, event_listeners=[self.counter])
+        self.db = self.client[f"contact_upsert_bench_{uuid.uuid4().hex[:8]}"]
+        server.db = self.db
+
+    def event_stream(self, contacts, pageviews):
+        events = []
+        for n in range(contacts):
+            cid = str(uuid.uuid4())
+            attribution = {"utm_source": "bench", "utm_campaign": "upsert", "fbclid": f"fb{n}",
+                           "extra": {"layout": "styled-0"}}
+            for v in range(pageviews):
+                events.append({
+                    "contact_id": cid,
+                    "session_id": f"s{n}",
+                    "user_agent": "ContactUpsertBenchmark/1.0",
+                    "attribution": {**attribution, "utm_content": f"v{v}"},
+                })
+        return events
+
+    async def measure(self, name, upsert, contacts, pageviews):
+        await self.db.contacts.create_index("contact_id", unique=True, sparse=True)
+        events = self.event_stream(contacts, pageviews)
+        latencies = []
+        before = self.counter.count
+        for data in events:
+            start = time.perf_counter()
+            await upsert(data, datetime.now(timezone.utc), "203.0.113.7")
+            latencies.append((time.perf_counter() - start) * 1000)
+        round_trips = (self.counter.count - before) / len(events)
+        p95 = statistics.quantiles(latencies, n=20)[-1]
+        print(f"   {name:<9} {round_trips:4.2f} round trips/event   "
+              f"mean {statistics.mean(latencies):6.2f} ms   p50 {statistics.median(latencies):6.2f} ms   "
+              f"p95 {p95:6.2f} ms   ({len(events)} events)")
+        await self.db.contacts.drop()
+        return round_trips, statistics.mean(latencies)
+
+    async def close(self):
+        await self.client.drop_database(self.db.name)
+        self.client.close()
+
+
+async def main():
+    mongo_url = sys.argv[1] if len(sys.argv) > 1 else os.environ['MONGO_URL']
+    contacts = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    pageviews = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    bench = ContactUpsertBenchmark(mongo_url)
+
+    print(f"🚀 Contact upsert benchmark against {mongo_url}  "
+          f"({contacts} contacts × {pageviews} pageviews)")
+    print("=" * 70)
+    try:
+        old_rt, old_ms = await bench.measure("two-step", two_step_upsert, contacts, pageviews)
+        new_rt, new_ms = await bench.measure("pipeline", server._upsert_contact, contacts, pageviews)
+    finally:
+        await bench.close()
+    print("=" * 70)
+    print(f"📊 Round trips per event: {old_rt:.2f} → {new_rt:.2f}   "
+          f"mean latency: {old_ms:.2f} ms → {new_ms:.2f} ms ({(1 - new_ms / old_ms) * 100:.0f}% lower)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -96,7 +96,9 @@ pip install --quiet \
   "pydantic==2.12.5" \
   "httpx==0.28.1" \
   "python-multipart==0.0.22" \
-  "starlette==0.37.2"
+  "starlette==0.37.2" \
+  "Brotli==1.1.0" \
+  "orjson==3.11.5"
 
 ok "Backend dependencies installed"
 
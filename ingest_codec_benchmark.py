@@ -0,0 +1,142 @@
+"""
+Ingest codec microbenchmark — events/second per core spent outside MongoDB, before vs after.
+
+Runs the CPU-only part of a /track request in a single thread for a realistic mix of
+tracker bodies (pageviews with and without attribution, tags, leads):
+
+  validated  json.loads → model(**body) → PageVisit / Contact models + model_dump +
+             strip_nulls for the documents → jsonable_encoder + JSONResponse for the reply
+             (the codec before the fast path).
+  fast       _json_loads (orjson) → _track_model (spec check + model_construct) →
+             _visit_doc / _new_contact_doc built as plain dicts → _track_response.
+
+No database is needed:
+    python ingest_codec_benchmark.py 50000
+
+Usage:  python ingest_codec_benchmark.py [events]
+"""
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'ingest_codec_bench')
+sys.path.insert(0, str(Path(__file__).resolve().parent / 'backend'))
+
+import server  # noqa: E402
+
+
+def attribution_model(raw):
+    """The pre-codec safe_attribution (sanitized attribution as an Attribution model)."""
+    attrs = server._clean_attribution(raw)
+    return server.Attribution(**attrs) if attrs else None
+
+
+def validated_visit_doc(contact_id, session_id, current_url, referrer_url, page_title, attribution, now):
+    """The pre-codec _visit_doc (PageVisit model, model_dump, strip_nulls)."""
+    visit = server.PageVisit(
+        contact_id=contact_id, session_id=session_id, current_url=current_url,
+        referrer_url=referrer_url, page_title=page_title,
+        attribution=attribution_model(attribution), timestamp=now,
+    )
+    vdoc = server.strip_nulls(visit.model_dump())
+    vdoc['timestamp'] = server.dt_to_str(visit.timestamp)
+    return vdoc
+
+
+def validated_contact_doc(data, now):
+    """The pre-codec _new_contact_doc (Contact model, model_dump, strip_nulls)."""
+    if not server._has_contact_signal(data):
+        return None
+    first_name, last_name = server._contact_name_parts(data)
+    contact = server.Contact(
+        contact_id=data['contact_id'], session_id=data.get('session_id'),
+        user_agent=data.get('user_agent'), name=data.get('name'), email=data.get('email'),
+        phone=data.get('phone'), first_name=first_name, last_name=last_name,
+        attribution=attribution_model(data.get('attribution')), created_at=now, updated_at=now,
+    )
+    cdoc = server.strip_nulls(contact.model_dump())
+    cdoc['created_at'] = server.dt_to_str(contact.created_at)
+    cdoc['updated_at'] = server.dt_to_str(contact.updated_at)
+    return cdoc
+
+
+class IngestCodecBenchmark:
+    def event_stream(self, events):
+        """(type, raw body) pairs: 60% pageviews (half with attribution), 25% tags, 15% leads."""
+        stream = []
+        for n in range(events):
+            cid, sid = str(uuid.uuid4()), str(uuid.uuid4())
+            page = {"contact_id": cid, "session_id": sid, "event_id": str(uuid.uuid4()),
+                    "current_url": f"https://landing.example.com/register?n={n}",
+                    "referrer_url": "https://www.facebook.com/", "page_title": "Benchmark Registration"}
+            if n % 2:
+                page["attribution"] = {"utm_source": "fb", "utm_campaign": "codec", "fbclid": f"fb{n}",
+                                       "layout": "styled-0"}
+            kind = ("pageview", "pageview", "pageview", "tag", "lead")[n % 5] if n % 20 else "lead"
+            if kind == "tag":
+                body = {"contact_id": cid, "session_id": sid, "tag": "registered", "event_id": str(uuid.uuid4())}
+            elif kind == "lead":
+                body = {**page, "email": f"bench{n}@example.com", "name": "Bench Mark"}
+            else:
+                body = page
+            stream.append((kind, json.dumps(body).encode('utf-8')))
+        return stream
+
+    def validated(self, kind, raw, now):
+        data = server.TRACK_EVENT_MODELS[kind](**json.loads(raw))
+        if kind != 'tag':
+            fields = server._event_contact_fields(kind, data, data.contact_id, data.attribution, None)
+            validated_contact_doc(fields, now)
+        if kind == 'pageview':
+            validated_visit_doc(data.contact_id, data.session_id, data.current_url, data.referrer_url,
+                                data.page_title, data.attribution, now)
+        return JSONResponse(jsonable_encoder({"status": "ok", "contact_id": data.contact_id})).body
+
+    def fast(self, kind, raw, now):
+        data = server._track_model(server.TRACK_EVENT_MODELS[kind], server._json_loads(raw))
+        if kind != 'tag':
+            fields = server._event_contact_fields(kind, data, data.contact_id, data.attribution, None)
+            server._new_contact_doc(fields, now)
+        if kind == 'pageview':
+            server._visit_doc(data.contact_id, data.session_id, data.current_url, data.referrer_url,
+                              data.page_title, data.attribution, now)
+        return server._track_response({"status": "ok", "contact_id": data.contact_id}).body
+
+    def measure(self, name, codec, stream):
+        now = datetime.now(timezone.utc)
+        start = time.perf_counter()
+        for kind, raw in stream:
+            codec(kind, raw, now)
+        elapsed = time.perf_counter() - start
+        rate = len(stream) / elapsed
+        print(f"   {name:<9} {len(stream):7d} events in {elapsed:6.2f}s   {rate:10.0f} events/s/core   "
+              f"{elapsed / len(stream) * 1e6:6.1f} µs/event")
+        return rate
+
+
+def main():
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    bench = IngestCodecBenchmark()
+    stream = bench.event_stream(events)
+    bench.measure("warm-up", bench.fast, stream[:1000])
+
+    print(f"🚀 Ingest codec microbenchmark  ({events} events, orjson "
+          f"{'on' if server.orjson is not None else 'off'})")
+    print("=" * 70)
+    before = bench.measure("validated", bench.validated, stream)
+    after = bench.measure("fast", bench.fast, stream)
+    print("=" * 70)
+    print(f"📊 Codec throughput per core: {before:.0f} → {after:.0f} events/s ({after / before:.1f}x)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
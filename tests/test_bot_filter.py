@@ -0,0 +1,74 @@
+"""
+Bot filtering of tracker pageviews and tags: user-agent patterns, headless hints,
+datacenter ranges, and the exemption for our own server-side callers.
+Run with:  python -m pytest tests/
+"""
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+from starlette.requests import Request
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'test_database')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+import server  # noqa: E402
+
+CHROME_UA = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+             '(KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36')
+HEADLESS_UA = ('Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 '
+               '(KHTML, like Gecko) HeadlessChrome/124.0.0.0 Safari/537.36')
+NOW = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def pageview(**fields):
+    return server.PageViewCreate(contact_id='c1', current_url='https://lp.example.com/register', **fields)
+
+
+def make_request(peer, forwarded_for=None):
+    headers = [(b'x-forwarded-for', forwarded_for.encode())] if forwarded_for else []
+    return Request({'type': 'http', 'method': 'POST', 'path': '/api/track/pageview', 'query_string': b'',
+                    'headers': headers, 'client': (peer, 50000)})
+
+
+def test_real_browser_is_not_filtered():
+    assert server._bot_reason('pageview', pageview(), '203.0.113.9', CHROME_UA) is None
+    assert server._filter_bot('pageview', pageview(), server._Caller('203.0.113.9', False), CHROME_UA, NOW) is None
+
+
+def test_headless_browser_is_filtered():
+    assert server._bot_reason('pageview', pageview(), None, HEADLESS_UA) == 'ua:headlesschrome'
+    hints = server.HEADLESS_WEBDRIVER
+    assert server._bot_reason('pageview', pageview(headless=hints), None, CHROME_UA) == 'headless'
+    weak = server.HEADLESS_NO_LANGUAGES
+    assert server._bot_reason('pageview', pageview(headless=weak), None, CHROME_UA) is None
+
+
+def test_missing_user_agent_is_filtered_unless_the_caller_is_trusted():
+    untrusted = server._filter_bot('pageview', pageview(), server._Caller('203.0.113.9', False), None, NOW)
+    assert untrusted == {"status": "filtered", "contact_id": "c1"}
+    assert server._filter_bot('pageview', pageview(), server._Caller('203.0.113.9', True), None, NOW) is None
+    library = 'python-requests/2.32.5'
+    assert server._filter_bot('tag', server.TagCreate(contact_id='c1', tag='t'),
+                              server._Caller('10.0.0.5', True), library, NOW) is None
+
+
+def test_identity_events_are_never_filtered():
+    lead = server.LeadCreate(contact_id='c1', email='a@example.com')
+    assert server._bot_reason('lead', lead, None, None) is None
+
+
+def test_datacenter_address_is_the_proxy_verified_one(tmp_path, monkeypatch):
+    ranges = tmp_path / 'ranges.txt'
+    ranges.write_text('# test ranges\n198.51.100.0/24\n')
+    monkeypatch.setattr(server, '_datacenter_ranges', {4: ([], []), 6: ([], [])})
+    assert server._load_datacenter_ranges(str(ranges)) == 1
+    assert server._bot_reason('pageview', pageview(), '198.51.100.20', CHROME_UA) == 'datacenter'
+    assert server._bot_reason('pageview', pageview(), '203.0.113.9', CHROME_UA) is None
+
+    # A datacenter client claiming a residential address in X-Forwarded-For is still caught
+    caller = server._track_caller(make_request('127.0.0.1', '203.0.113.9, 198.51.100.20'))
+    assert caller.ip == '198.51.100.20'
+    assert server._filter_bot('pageview', pageview(), caller, CHROME_UA, NOW)['status'] == 'filtered'
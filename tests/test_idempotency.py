@@ -0,0 +1,88 @@
+"""
+Idempotency claims for tracking events: duplicates get the original response, and a
+claim whose owner died before storing one is taken over once its lease runs out.
+Run with:  python -m pytest tests/
+"""
+import asyncio
+import os
+import sys
+from datetime import timedelta
+from pathlib import Path
+
+from mongomock_motor import AsyncMongoMockClient
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'test_database')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+import server  # noqa: E402
+
+KEY = 'e1:c1'
+
+
+def new_worker():
+    """A restarted (or another) worker: nothing in the front cache."""
+    server._idempotency_cache.clear()
+
+
+async def age_claim(key, seconds):
+    doc = await server.db.track_idempotency.find_one({"_id": key})
+    await server.db.track_idempotency.update_one(
+        {"_id": key}, {"$set": {"claimed_at": doc["claimed_at"] - timedelta(seconds=seconds)}})
+
+
+def test_claim_of_a_crashed_worker_is_reclaimed_after_the_lease(monkeypatch):
+    monkeypatch.setattr(server, 'db', AsyncMongoMockClient()['idempotency_test'])
+    new_worker()
+    async def run():
+        # The first delivery claims the event, then its worker dies before storing a response
+        assert await server._idempotency_claim([KEY]) == [None]
+        new_worker()
+
+        # A retry inside the lease still sees the event in flight
+        assert await server._idempotency_claim([KEY]) == [server._IN_PROGRESS]
+
+        # Past the lease the retry owns the event; a concurrent retry does not
+        await age_claim(KEY, server.IDEMPOTENCY_LEASE_SECONDS + 1)
+        reclaimed = server._idempotency_stats["reclaimed"]
+        assert await server._idempotency_claim([KEY]) == [None]
+        assert server._idempotency_stats["reclaimed"] == reclaimed + 1
+        new_worker()
+        assert await server._idempotency_claim([KEY]) == [server._IN_PROGRESS]
+
+        # Once the retry stores its response, later duplicates get it back
+        server._idempotency_store([KEY], [{"status": "ok", "contact_id": "c1"}])
+        await asyncio.sleep(0)
+        new_worker()
+        [seen] = await server._idempotency_claim([KEY])
+        assert seen == {"status_code": 200, "body": {"status": "ok", "contact_id": "c1"}}
+    asyncio.run(run())
+
+
+def test_completed_event_is_never_reclaimed(monkeypatch):
+    monkeypatch.setattr(server, 'db', AsyncMongoMockClient()['idempotency_done_test'])
+    new_worker()
+    async def run():
+        calls = []
+        async def handle():
+            calls.append(1)
+            return {"status": "ok", "contact_id": "c1"}
+        data = server.TagCreate(contact_id='c1', tag='registered', event_id='e1')
+        assert await server._once(data, handle) == {"status": "ok", "contact_id": "c1"}
+        await asyncio.sleep(0)
+        await age_claim(KEY, server.IDEMPOTENCY_LEASE_SECONDS + 1)
+        new_worker()
+        duplicate = await server._once(data, handle)
+        assert duplicate.status_code == 200 and calls == [1]
+    asyncio.run(run())
+
+
+def test_claim_without_a_timestamp_counts_as_expired(monkeypatch):
+    monkeypatch.setattr(server, 'db', AsyncMongoMockClient()['idempotency_legacy_test'])
+    new_worker()
+    async def run():
+        await server.db.track_idempotency.insert_one({"_id": KEY})
+        assert await server._idempotency_claim([KEY]) == [None]
+        doc = await server.db.track_idempotency.find_one({"_id": KEY})
+        assert "claimed_at" in doc and "expire_at" in doc
+    asyncio.run(run())
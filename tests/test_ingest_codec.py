@@ -0,0 +1,107 @@
+"""
+The fast ingest codec (_fits / _track_model) must give the same model, or the same
+validation error, as model(**body) for every tracker body.  Run with:  python -m pytest tests/
+"""
+import os
+import sys
+from pathlib import Path
+
+import pytest
+from pydantic import ValidationError
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'test_database')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+import server  # noqa: E402
+
+PAGE = {"contact_id": "c1", "session_id": "s1", "current_url": "https://lp.example.com/register",
+        "referrer_url": "https://www.facebook.com/", "page_title": "Register", "event_id": "e1"}
+
+
+def decode(decoder, model, body):
+    try:
+        result = decoder(model, body)
+    except ValidationError as e:
+        return 'error', e.errors(include_url=False)
+    return 'model', type(result), result.model_dump(), result.model_fields_set, result.__pydantic_private__
+
+
+def assert_same(model, body):
+    fast = decode(server._track_model, model, body)
+    assert fast == decode(lambda m, b: m(**b), model, body)
+    return fast
+
+
+@pytest.mark.parametrize('model, body', [
+    (server.PageViewCreate, PAGE),
+    (server.PageViewCreate, {**PAGE, "attribution": {"utm_source": "fb", "extra": {"a": "1"}}, "headless": 3}),
+    (server.PageViewCreate, {**PAGE, "session_id": None, "attribution_hash": "h" * 64}),
+    (server.TagCreate, {"contact_id": "c1", "tag": "registered"}),
+    (server.LeadCreate, {"contact_id": "c1", "email": "a@example.com", "name": "A B"}),
+    (server.RegistrationCreate, {"contact_id": "c1", "email": "a@example.com", "current_url": "https://x/"}),
+])
+def test_well_typed_bodies_take_the_fast_path(model, body):
+    assert server._fits(server._model_spec(model), body)
+    assert assert_same(model, body)[0] == 'model'
+
+
+@pytest.mark.parametrize('model, body', [
+    (server.PageViewCreate, {**PAGE, "headless": True}),                  # bool is not an int
+    (server.PageViewCreate, {**PAGE, "headless": False}),
+    (server.PageViewCreate, {**PAGE, "headless": 3.0}),                   # integral float is coerced
+    (server.PageViewCreate, {**PAGE, "headless": 2.5}),                   # fractional float is rejected
+    (server.PageViewCreate, {**PAGE, "headless": "3"}),
+    (server.TagCreate, {"contact_id": 7, "tag": "registered"}),           # int is not a str
+    (server.PageViewCreate, {**PAGE, "attribution": "utm_source=fb"}),
+])
+def test_values_pydantic_would_coerce_or_reject_are_validated(model, body):
+    assert not server._fits(server._model_spec(model), body)
+    assert_same(model, body)
+
+
+def test_string_over_max_length_gives_the_same_error():
+    body = {**PAGE, "attribution_hash": "h" * 65}
+    assert not server._fits(server._model_spec(server.PageViewCreate), body)
+    assert assert_same(server.PageViewCreate, body)[1][0]["type"] == 'string_too_long'
+
+
+@pytest.mark.parametrize('model, body', [
+    (server.PageViewCreate, {"contact_id": "c1"}),
+    (server.TagCreate, {"tag": "registered"}),
+    (server.LeadCreate, {}),
+    (server.TrackBatchEvent, {"type": "pageview"}),
+])
+def test_missing_required_fields_give_the_same_error(model, body):
+    kind, errors = assert_same(model, body)
+    assert kind == 'error' and {e["type"] for e in errors} == {'missing'}
+
+
+def test_extra_keys_are_dropped_the_same_way():
+    body = {**PAGE, "unknown": 1, "_sample_rate": 0.5, "model_config": {}}
+    assert server._fits(server._model_spec(server.PageViewCreate), body)
+    kind, _, dumped, fields_set, private = assert_same(server.PageViewCreate, body)
+    assert "unknown" not in dumped and "unknown" not in fields_set
+    assert private == {"_sample_rate": None}             # never settable by the client
+
+
+@pytest.mark.parametrize('events', [
+    [{"type": "pageview", "data": PAGE}, {"type": "tag", "data": {"contact_id": "c1", "tag": "t"}}],
+    [],
+    [{"type": "pageview", "data": PAGE, "ignored": True}],
+    [{"type": "pageview", "data": "not-an-object"}],
+    [{"type": 1, "data": PAGE}],
+    [{"data": PAGE}],
+    ["pageview"],
+    [{"type": "pageview", "data": PAGE}] * (server.TRACK_BATCH_MAX_EVENTS + 1),
+])
+def test_nested_batch_events(events):
+    result = assert_same(server.TrackBatchCreate, {"events": events})
+    if result[0] == 'model':
+        assert [type(ev) for ev in server._track_model(server.TrackBatchCreate, {"events": events}).events] \
+            == [server.TrackBatchEvent] * len(events)
+
+
+def test_batch_event_data_decodes_like_a_single_event():
+    for data in (PAGE, {**PAGE, "headless": True}, {"current_url": "https://x/"}):
+        assert_same(server.PageViewCreate, data)
@@ -0,0 +1,200 @@
+"""
+The ingest journal (_IngestJournal): append / acknowledge, recovery of unacknowledged
+events on open, a torn last line, segment rotation and collection, and replaying an
+event that was already written.  Run with:  python -m pytest tests/
+"""
+import asyncio
+import json
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'test_database')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+import server  # noqa: E402
+
+AT = datetime(2026, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def pageview_item(n):
+    data = server.PageViewCreate(contact_id=f'c{n}', current_url=f'https://lp.example.com/p{n}')
+    return ('pageview', data, '203.0.113.9', 'UA', AT, None)
+
+
+def segment_lines(journal):
+    journal.file.flush()
+    return [json.loads(line) for n in journal._segments()
+            for line in journal._segment_path(n).read_text().splitlines() if line.strip()]
+
+
+def test_append_and_ack(tmp_path):
+    async def run():
+        journal = server._IngestJournal.open(str(tmp_path))
+        ids = await journal.append([pageview_item(1), pageview_item(2)])
+        assert len(set(ids)) == 2 and list(journal.pending) == ids
+        journal.ack([ids[0], 'unknown-id'])
+        assert list(journal.pending) == [ids[1]]
+        assert journal.stats["appended"] == 2 and journal.stats["acked"] == 1
+        lines = segment_lines(journal)
+        assert [rec.get("id") for rec in lines[:2]] == ids
+        assert lines[2] == {"ack": [ids[0]]}
+        assert lines[0]["data"] == {"contact_id": "c1", "current_url": "https://lp.example.com/p1"}
+        await journal.close()
+    asyncio.run(run())
+
+
+def test_unacknowledged_events_are_recovered_on_open(tmp_path):
+    async def run():
+        journal = server._IngestJournal.open(str(tmp_path))
+        ids = await journal.append([pageview_item(1), pageview_item(2), pageview_item(3)])
+        journal.ack([ids[1]])
+        await journal.close()
+
+        reopened = server._IngestJournal.open(str(tmp_path))
+        assert reopened.slot == journal.slot
+        assert list(reopened.pending) == [ids[0], ids[2]]
+        assert reopened.stats["recovered"] == 2
+        # Recovered events are due for replay at once (no grace period)
+        assert [rec["id"] for rec in reopened.due(10)] == [ids[0], ids[2]]
+        await reopened.close()
+    asyncio.run(run())
+
+
+def test_torn_last_line_is_ignored(tmp_path):
+    async def run():
+        journal = server._IngestJournal.open(str(tmp_path))
+        ids = await journal.append([pageview_item(1)])
+        path = journal._segment_path(journal.segment)
+        await journal.close()
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write('{"id":"torn","type":"pagev')          # a write that never reached fsync
+
+        reopened = server._IngestJournal.open(str(tmp_path))
+        assert list(reopened.pending) == ids
+        # New appends go to a fresh segment, after the torn one
+        more = await reopened.append([pageview_item(2)])
+        assert reopened.pending[more[0]][1] > reopened.pending[ids[0]][1]
+        await reopened.close()
+    asyncio.run(run())
+
+
+def test_segments_rotate_and_are_collected_once_acknowledged(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'JOURNAL_SEGMENT_MAX_BYTES', 1)     # roll after every fsync
+    async def run():
+        journal = server._IngestJournal.open(str(tmp_path))
+        first = await journal.append([pageview_item(1)])
+        await asyncio.sleep(0.01)
+        second = await journal.append([pageview_item(2)])
+        await asyncio.sleep(0.01)
+        assert len(journal._segments()) == 3          # two full segments and the open one
+
+        journal.ack(second)
+        assert len(journal._segments()) == 3          # the older segment still holds an event
+        journal.ack(first)
+        assert journal._segments() == [journal.segment]
+        await journal.close()
+    asyncio.run(run())
+
+
+def test_replaying_an_event_already_written_stores_it_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'db', AsyncMongoMockClient()['journal_test'])
+    async def run():
+        await server._create_visit_id_index()
+        journal = server._IngestJournal.open(str(tmp_path))
+        ids = await journal.append([pageview_item(1), pageview_item(2)])
+        items = [pageview_item(n)[:5] + (eid,) for n, eid in zip((1, 2), ids)]
+
+        # The inline write stored the first event, then stalled past the grace period
+        visit_id = await server._log_visit('c1', None, 'https://lp.example.com/p1', None, None, None, AT,
+                                           visit_id=ids[0])
+        assert visit_id == ids[0]
+        results = await server._ingest_track_events(items)
+        assert [r["visit_id"] for r in results] == ids
+        # The late inline write and a second replay are both no-ops
+        await server._log_visit('c1', None, 'https://lp.example.com/p1', None, None, None, AT, visit_id=ids[0])
+        await server._ingest_track_events(items)
+
+        visits = await server.db.page_visits.find({}, {"_id": 0, "id": 1}).to_list(None)
+        assert sorted(v["id"] for v in visits) == sorted(ids)
+        await journal.close()
+        server._stitch_pending.clear()
+    asyncio.run(run())
+
+
+def test_visit_id_index_replaces_the_non_unique_one(monkeypatch):
+    monkeypatch.setattr(server, 'db', AsyncMongoMockClient()['journal_index_test'])
+    async def run():
+        await server.db.page_visits.create_index("id", sparse=True)
+        await server._create_visit_id_index()
+        info = await server.db.page_visits.index_information()
+        assert info["id_1"].get("unique") and info["id_1"].get("sparse")
+        await server._create_visit_id_index()           # idempotent
+    asyncio.run(run())
+
+
+def test_sampled_pageview_keeps_its_weight_through_replay(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'db', AsyncMongoMockClient()['journal_sampled_test'])
+    async def run():
+        journal = server._IngestJournal.open(str(tmp_path))
+        sampled, plain = pageview_item(1), pageview_item(2)
+        sampled[1]._sample_rate = 0.25
+        await journal.append([sampled, plain])
+        await journal.close()
+
+        reopened = server._IngestJournal.open(str(tmp_path))
+        items = [server._journal_item(rec) for rec in reopened.due(10)]
+        assert [item[1]._sample_rate for item in items] == [0.25, None]
+        await server._ingest_track_events(items)
+        assert await server._weighted_visit_count({}) == 5
+        await reopened.close()
+        server._stitch_pending.clear()
+    asyncio.run(run())
+
+
+def test_events_whose_fsync_failed_are_not_replayed(tmp_path, monkeypatch):
+    async def run():
+        journal = server._IngestJournal.open(str(tmp_path))
+        monkeypatch.setattr(server, '_journal', journal)
+        kept = await server._journal_append([pageview_item(1)])
+        assert kept[0][5] is not None
+
+        def failing_fsync(fd):
+            raise OSError(5, 'Input/output error')
+        monkeypatch.setattr(os, 'fsync', failing_fsync)
+        items = await server._journal_append([pageview_item(2), pageview_item(3)])
+        monkeypatch.undo()
+
+        # Written inline without journal ids, so the journal must not replay them later
+        assert [item[5] for item in items] == [None, None]
+        assert list(journal.pending) == [kept[0][5]]
+        assert journal.stats["abandoned"] == 2 and journal.stats["append_failed"] == 2
+        await journal.close()
+
+        reopened = server._IngestJournal.open(str(tmp_path))
+        assert [rec["id"] for rec in reopened.due(10)] == [kept[0][5]]
+        await reopened.close()
+    asyncio.run(run())
+
+
+def test_events_written_before_a_failed_write_are_not_replayed(tmp_path, monkeypatch):
+    async def run():
+        journal = server._IngestJournal.open(str(tmp_path))
+        real_write, writes = journal._write, []
+
+        def second_write_fails(rec):
+            writes.append(rec)
+            if len(writes) == 2:
+                raise OSError(28, 'No space left on device')
+            real_write(rec)
+        monkeypatch.setattr(journal, '_write', second_write_fails)
+        with pytest.raises(OSError):
+            await journal.append([pageview_item(1), pageview_item(2)])
+        assert journal.pending == {} and journal.stats["abandoned"] == 1
+        await journal.close()
+    asyncio.run(run())
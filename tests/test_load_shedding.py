@@ -0,0 +1,101 @@
+"""
+Admission control for the /track endpoints: who counts as a trusted server-side caller,
+and the per-IP / per-contact token buckets.  Run with:  python -m pytest tests/
+"""
+import ipaddress
+import os
+import sys
+from pathlib import Path
+
+from starlette.requests import Request
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'test_database')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+import server  # noqa: E402
+
+LOOPBACK = [ipaddress.ip_network('127.0.0.0/8'), ipaddress.ip_network('::1/128')]
+
+
+def make_request(peer, forwarded_for=None, server_key=None):
+    headers = []
+    if forwarded_for:
+        headers.append((b'x-forwarded-for', forwarded_for.encode()))
+    if server_key:
+        headers.append((b'x-track-server-key', server_key.encode()))
+    return Request({'type': 'http', 'method': 'POST', 'path': '/api/track/batch', 'query_string': b'',
+                    'headers': headers, 'client': (peer, 50000)})
+
+
+def fresh_buckets(monkeypatch, ip_burst=3, contact_burst=50):
+    monkeypatch.setattr(server, '_ip_buckets', server._TokenBuckets(0.001, ip_burst))
+    monkeypatch.setattr(server, '_contact_buckets', server._TokenBuckets(0.001, contact_burst))
+
+
+def test_forwarded_for_is_read_from_the_right_behind_our_proxy():
+    request = make_request('127.0.0.1', '127.0.0.1, 203.0.113.9')
+    assert server.verified_client_ip(request) == '203.0.113.9'
+    assert server.get_client_ip(request) == '127.0.0.1'
+
+
+def test_forwarded_for_is_ignored_from_an_untrusted_peer():
+    assert server.verified_client_ip(make_request('198.51.100.7', '127.0.0.1')) == '198.51.100.7'
+
+
+def test_nobody_is_exempt_by_default():
+    assert server.TRACK_RATE_LIMIT_EXEMPT == []
+    assert not server._track_caller(make_request('127.0.0.1')).trusted
+
+
+def test_spoofed_forwarded_for_is_still_rate_limited(monkeypatch):
+    monkeypatch.setattr(server, 'TRACK_RATE_LIMIT_EXEMPT', LOOPBACK)
+    fresh_buckets(monkeypatch)
+    caller = server._track_caller(make_request('127.0.0.1', '127.0.0.1, 203.0.113.9'))
+    assert caller == server._Caller('203.0.113.9', False)
+    for n in range(3):
+        assert server._rate_limited({'pageview': 1}, caller, {f'c{n}': 1}) is None
+    limited = server._rate_limited({'pageview': 1}, caller, {'c9': 1})
+    assert limited is not None and limited.status_code == 429
+    assert int(limited.headers['retry-after']) >= 1
+
+
+def test_exempt_network_is_matched_on_the_verified_address(monkeypatch):
+    monkeypatch.setattr(server, 'TRACK_RATE_LIMIT_EXEMPT', [ipaddress.ip_network('10.0.0.0/8')])
+    assert server._track_caller(make_request('127.0.0.1', '10.1.2.3')).trusted
+    assert not server._track_caller(make_request('127.0.0.1', '10.1.2.3, 203.0.113.9')).trusted
+
+
+def test_server_key_marks_a_trusted_caller(monkeypatch):
+    monkeypatch.setattr(server, 'TRACK_SERVER_KEY', 's3cret')
+    fresh_buckets(monkeypatch, ip_burst=1)
+    trusted = server._track_caller(make_request('127.0.0.1', '203.0.113.9', server_key='s3cret'))
+    assert trusted.trusted
+    for _ in range(5):
+        assert server._rate_limited({'lead': 1}, trusted, {'c': 1}) is None
+    assert not server._track_caller(make_request('127.0.0.1', '203.0.113.9', server_key='guess')).trusted
+    monkeypatch.setattr(server, 'TRACK_SERVER_KEY', '')
+    assert not server._track_caller(make_request('127.0.0.1', '203.0.113.9', server_key='')).trusted
+
+
+def test_contact_rejection_spends_no_ip_tokens(monkeypatch):
+    fresh_buckets(monkeypatch, ip_burst=3, contact_burst=1)
+    caller = server._Caller('203.0.113.9', False)
+    assert server._rate_limited({'pageview': 1}, caller, {'noisy': 1}) is None
+    for _ in range(10):
+        limited = server._rate_limited({'pageview': 1}, caller, {'noisy': 1})
+        assert limited is not None and limited.status_code == 429
+    assert dict(server._shed_counts['rate_contact'])['pageview'] >= 10
+    # The other two IP tokens are still there for other visitors behind the same address
+    assert server._rate_limited({'pageview': 1}, caller, {'other-1': 1}) is None
+    assert server._rate_limited({'pageview': 1}, caller, {'other-2': 1}) is None
+    assert server._rate_limited({'pageview': 1}, caller, {'other-3': 1}).status_code == 429
+
+
+def test_batch_is_checked_against_every_contact_before_spending(monkeypatch):
+    fresh_buckets(monkeypatch, ip_burst=10, contact_burst=2)
+    caller = server._Caller('203.0.113.9', False)
+    assert server._rate_limited({'pageview': 3}, caller, {'a': 1, 'b': 2}) is None
+    assert server._rate_limited({'pageview': 2}, caller, {'a': 1, 'b': 1}).status_code == 429
+    assert server._ip_buckets.wait('203.0.113.9', 7) == 0      # 3 of 10 spent, not 5
+    assert server._contact_buckets.wait('a', 1) == 0           # a's second token untouched
@@ -0,0 +1,149 @@
+"""
+Tracker RUM telemetry: the timings the tracker measures, the per-minute histograms
+written by /track/rum, and the report that merges them in Mongo.  Run with:  python -m pytest tests/
+"""
+import asyncio
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'test_database')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+import server  # noqa: E402
+
+BACKEND_URL = 'https://tether-workflows.preview.emergentagent.com'
+
+
+def expected_report(reports):
+    """The report computed straight from the beacons, with the same bucket interpolation."""
+    merged = defaultdict(lambda: defaultdict(lambda: {"count": 0, "sum": 0.0, "buckets": defaultdict(int)}))
+    for r in reports:
+        domain = r.d[4:] if r.d.startswith('www.') else r.d
+        for metric, value in {**r.m, **r.c}.items():
+            agg = merged[domain][metric]
+            agg["count"] += 1
+            agg["sum"] += value
+            if metric in server.RUM_TIMING_METRICS:
+                agg["buckets"][str(server._rum_bucket(value))] += 1
+    out = {}
+    for domain, metrics in merged.items():
+        out[domain] = {}
+        for metric, agg in metrics.items():
+            if metric in server.RUM_COUNTERS:
+                out[domain][metric] = {"reports": agg["count"], "total": agg["sum"],
+                                       "per_report": round(agg["sum"] / agg["count"], 3)}
+            else:
+                out[domain][metric] = {
+                    "count": agg["count"], "mean": round(agg["sum"] / agg["count"], 1),
+                    **{f"p{int(q * 100)}": server._rum_percentile(agg["buckets"], agg["count"], q)
+                       for q in (0.50, 0.95, 0.99)},
+                }
+    return out
+
+
+def test_report_is_merged_in_mongo(monkeypatch):
+    monkeypatch.setattr(server, 'db', AsyncMongoMockClient()['tracker_rum_test'])
+    rng = random.Random(11)
+    now = datetime.now(timezone.utc)
+    reports = []
+    for n in range(300):
+        reports.append(server.TrackerRumReport(
+            d=rng.choice(['lp.example.com', 'www.lp.example.com', 'join.example.org']),
+            v=rng.choice(['2.1.0', '2.2.0']),
+            m={"eval_ms": rng.uniform(0.5, 12), "ack_ms": rng.lognormvariate(5, 1)}
+              | ({"rtt_ms": rng.uniform(20, 900)} if n % 3 else {}),
+            c={"send_fail": rng.randint(0, 2)} if n % 4 else {},
+        ))
+
+    async def run():
+        for n, report in enumerate(reports):
+            ops = server._rum_updates(report, now - timedelta(minutes=n % 30))
+            await server.db.tracker_rum.bulk_write(ops)
+        result = await server.get_tracker_rum(minutes=60, domain=None, version=None)
+        assert result["domains"] == expected_report(reports)
+
+        only = await server.get_tracker_rum(minutes=60, domain='join.example.org', version='2.2.0')
+        assert list(only["domains"]) == ['join.example.org']
+        empty = await server.get_tracker_rum(minutes=60, domain='nobody.example.com', version=None)
+        assert empty["domains"] == {}
+    asyncio.run(run())
+
+
+# Runs the tracker in node with a fake clock: the page loads at t=0, the pageview waits
+# in the queue for the flush delay, the batch is answered RESPONSE_MS after it is sent.
+RUM_HARNESS = r"""
+const vm = require('vm'), fs = require('fs');
+const RESPONSE_MS = +process.argv[3];
+let clock = 0;
+const timers = [], sent = [], beacons = [], listeners = {};
+const on = (t, f) => { (listeners[t] = listeners[t] || []).push(f); };
+function setTimeout_(fn, ms) { timers.push({at: clock + (ms || 0), fn}); return timers.length; }
+function advance(ms) {
+  const end = clock + ms;
+  for (;;) {
+    const due = timers.filter(t => !t.done && t.at <= end).sort((a, b) => a.at - b.at)[0];
+    if (!due) break;
+    due.done = true; clock = due.at; due.fn();
+  }
+  clock = end;
+}
+function fetch_(url, opts) {
+  const body = JSON.parse(opts.body);
+  sent.push({url, at: clock});
+  const results = (body.events || []).map(e => ({type: e.type, status: 'ok'}));
+  return new Promise(resolve => setTimeout_(() => resolve(
+    {ok: true, status: 200, json: () => Promise.resolve({status: 'ok', results})}), RESPONSE_MS));
+}
+const storage = () => { const m = {}; return {getItem: k => (k in m ? m[k] : null),
+  setItem: (k, v) => { m[k] = String(v); }, removeItem: k => { delete m[k]; }}; };
+const el = () => ({querySelectorAll: () => [], getElementsByTagName: () => [], addEventListener() {},
+  appendChild() {}, setAttribute() {}, style: {}});
+const document = Object.assign(el(), {readyState: 'complete', cookie: '', referrer: '', title: 'Register',
+  body: el(), documentElement: el(), addEventListener: on, visibilityState: 'visible', createElement: el});
+const window = {document, performance: {now: () => clock}, addEventListener: on,
+  location: {href: 'https://lp.example.com/register', hostname: 'lp.example.com', search: '', pathname: '/register'},
+  navigator: {userAgent: 'Mozilla/5.0', languages: ['en'],
+              sendBeacon: (u, b) => { beacons.push({u, b: JSON.parse(b)}); return true; }},
+  localStorage: storage(), sessionStorage: storage(), history: {pushState() {}, replaceState() {}},
+  setTimeout: setTimeout_, clearTimeout: id => { if (timers[id - 1]) timers[id - 1].done = true; },
+  setInterval: () => 0, fetch: fetch_, MutationObserver: function () { this.observe = () => {}; },
+  postMessage() {}, crypto: require('crypto').webcrypto};
+window.window = window.self = window.parent = window.top = window;
+vm.runInContext(fs.readFileSync(process.argv[2], 'utf8'), vm.createContext(window));
+(async () => {
+  for (let i = 0; i < 500; i++) { advance(10); await new Promise(r => setImmediate(r)); }
+  document.visibilityState = 'hidden';
+  (listeners.visibilitychange || []).forEach(f => f());
+  const rum = beacons.find(b => b.u.endsWith('/track/rum'));
+  console.log(JSON.stringify({sent: sent.map(s => s.at), rum: rum && rum.b}));
+})();
+"""
+
+
+@pytest.mark.skipif(shutil.which('node') is None, reason='node is not installed')
+def test_ack_is_timed_from_init_including_the_flush_delay(tmp_path):
+    tracker = tmp_path / 'shumard.js'
+    tracker.write_text(server.build_tracker_js(BACKEND_URL, rum_sample_rate=1.0))
+    harness = tmp_path / 'harness.js'
+    harness.write_text(RUM_HARNESS)
+    response_ms = 80
+    out = subprocess.run(['node', str(harness), str(tracker), str(response_ms)],
+                         capture_output=True, text=True, timeout=60, check=True)
+    run = json.loads(out.stdout)
+    flush_delay = int(re.search(r'var FLUSH_DELAY_MS = (\d+);', tracker.read_text()).group(1))
+    assert run["sent"] == [flush_delay]                    # the pageview's batch, after the flush delay
+    timings = run["rum"]["m"]
+    assert timings["rtt_ms"] == response_ms               # the send alone
+    assert timings["ack_ms"] == flush_delay + response_ms  # init → acknowledged, queueing included
@@ -0,0 +1,63 @@
+"""
+Size budget for the production tracker (shumard.js).
+
+The script ships to every visitor of every funnel page, so the minified + gzipped
+core must stay under TRACKER_GZIP_BUDGET_BYTES.  Form capture ships separately
+(shumard-forms.js, loaded on demand) under TRACKER_FORMS_GZIP_BUDGET_BYTES.  Run with:  python -m pytest tests/
+"""
+import gzip
+import os
+import sys
+from pathlib import Path
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'test_database')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+import server  # noqa: E402
+
+BACKEND_URL = 'https://tether-workflows.preview.emergentagent.com'
+
+
+def test_minified_tracker_within_gzip_budget():
+    minified = server.minify_js(server.build_tracker_js(BACKEND_URL))
+    size = len(gzip.compress(minified.encode('utf-8'), compresslevel=9))
+    assert size <= server.TRACKER_GZIP_BUDGET_BYTES, (
+        f"shumard.js is {size} bytes gzipped, budget is {server.TRACKER_GZIP_BUDGET_BYTES}"
+    )
+
+
+def test_forms_module_within_gzip_budget_and_out_of_core():
+    forms = server.minify_js(server.build_tracker_forms_js())
+    size = len(gzip.compress(forms.encode('utf-8'), compresslevel=9))
+    assert size <= server.TRACKER_FORMS_GZIP_BUDGET_BYTES, (
+        f"shumard-forms.js is {size} bytes gzipped, budget is {server.TRACKER_FORMS_GZIP_BUDGET_BYTES}"
+    )
+    core = server.build_tracker_js(BACKEND_URL, forms_url=f'{BACKEND_URL}/api/shumard-forms.abc.js')
+    assert 'function classifyInput' in forms
+    assert 'function classifyInput' not in core
+    assert f"var FORMS_URL   = '{BACKEND_URL}/api/shumard-forms.abc.js'" in core
+
+
+def test_minified_tracker_is_smaller_than_readable():
+    readable = server.build_tracker_js(BACKEND_URL)
+    assert len(server.minify_js(readable)) < len(readable) * 0.8
+
+
+def test_minified_tracker_keeps_injection_points_and_public_api():
+    minified = server.minify_js(server.build_tracker_js(BACKEND_URL, auto_tag='thank-you'))
+    assert f"var BACKEND_URL='{BACKEND_URL}'" in minified
+    assert "var AUTO_TAG='thank-you'" in minified
+    assert 'window.Shumard=' in minified
+    for method in ('getContactId', 'getSessionId', 'identify', 'stitch', 'trackEvent'):
+        assert f'{method}:' in minified
+    assert '/*' not in minified
+
+
+def test_minify_preserves_strings_and_regex_literals():
+    src = "var a = '/* not a comment */'; // trailing\nvar r = /[/]x\\/y/g;\nreturn /a b/.test(a)"
+    out = server.minify_js(src)
+    assert "'/* not a comment */'" in out
+    assert '/[/]x\\/y/g' in out
+    assert 'return/a b/.test(a)' in out
+    assert 'trailing' not in out
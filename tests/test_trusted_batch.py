@@ -0,0 +1,85 @@
+"""
+/track/batch from a trusted server-side caller (form backends replaying events): the
+caller's own address must not become the visitors' client_ip or IP-stitch them together.
+Run with:  python -m pytest tests/
+"""
+import asyncio
+import json
+import os
+import sys
+from pathlib import Path
+
+from mongomock_motor import AsyncMongoMockClient
+from starlette.requests import Request
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'test_database')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+import server  # noqa: E402
+
+BACKEND_IP = '10.0.0.5'
+HEADER_UA = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+             '(KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36')
+
+
+def batch_request(events, server_key=None):
+    body = json.dumps({"events": events}).encode()
+    headers = [(b'content-type', b'application/json'), (b'user-agent', HEADER_UA.encode())]
+    if server_key:
+        headers.append((b'x-track-server-key', server_key.encode()))
+    sent = []
+
+    async def receive():
+        if sent:
+            return {'type': 'http.disconnect'}
+        sent.append(1)
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+    return Request({'type': 'http', 'method': 'POST', 'path': '/api/track/batch', 'query_string': b'',
+                    'headers': headers, 'client': (BACKEND_IP, 50000)}, receive)
+
+
+def replayed_visitors(second_ip=None):
+    attributed = {"type": "pageview", "data": {
+        "contact_id": "visitor-a", "current_url": "https://lp.example.com/register?utm_source=fb",
+        "attribution": {"utm_source": "fb", "fbclid": "abc"}}}
+    identified = {"type": "lead", "data": {"contact_id": "visitor-b", "email": "b@example.com"}}
+    if second_ip:
+        identified["client_ip"], identified["user_agent"] = second_ip, 'Mozilla/5.0 (Visitor B)'
+    return [attributed, identified]
+
+
+def run_batch(monkeypatch, events, server_key):
+    monkeypatch.setattr(server, 'db', AsyncMongoMockClient()['trusted_batch_test'])
+    monkeypatch.setattr(server, 'TRACK_SERVER_KEY', 's3cret')
+    async def run():
+        await server.start_stitch_scheduler()
+        response = await server.track_batch(batch_request(events, server_key))
+        assert response.status_code == 200
+        await server.drain_stitch_queue()           # every pending stitch pass runs now
+        contacts = await server.db.contacts.find({}, {"_id": 0}).to_list(None)
+        visits = await server.db.page_visits.find({}, {"_id": 0}).to_list(None)
+        return {c["contact_id"]: c for c in contacts}, visits
+    return asyncio.run(run())
+
+
+def test_trusted_batch_does_not_stitch_visitors_on_the_callers_ip(monkeypatch):
+    contacts, visits = run_batch(monkeypatch, replayed_visitors(), 's3cret')
+    assert set(contacts) == {"visitor-a", "visitor-b"}
+    assert all(not c.get("merged_into") for c in contacts.values())
+    assert all(c.get("client_ip") is None and c.get("user_agent") is None for c in contacts.values())
+    assert [v.get("client_ip") for v in visits] == [None]
+
+
+def test_trusted_batch_records_the_per_event_visitor_address(monkeypatch):
+    contacts, _ = run_batch(monkeypatch, replayed_visitors(second_ip='203.0.113.7'), 's3cret')
+    assert contacts["visitor-b"]["client_ip"] == '203.0.113.7'
+    assert contacts["visitor-b"]["user_agent"] == 'Mozilla/5.0 (Visitor B)'
+    assert not contacts["visitor-b"].get("merged_into")
+
+
+def test_untrusted_batch_ignores_the_per_event_address(monkeypatch):
+    contacts, _ = run_batch(monkeypatch, replayed_visitors(second_ip='203.0.113.7'), None)
+    assert contacts["visitor-b"]["client_ip"] == BACKEND_IP
+    # ...and, sharing the request's address, the two are IP-stitched (what trust prevents)
+    assert contacts["visitor-b"].get("merged_into") == "visitor-a"
@@ -0,0 +1,92 @@
+"""
+Anonymous visit rollup: which contacts keep their raw page_visits past VISIT_ROLLUP_DAYS,
+which are folded into visit_rollups, and which wait for a possible stitch.
+Run with:  python -m pytest tests/
+"""
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from mongomock_motor import AsyncMongoMockClient
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'test_database')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+import server  # noqa: E402
+
+NOW = datetime.now(timezone.utc)
+LONG_AGO = server.dt_to_str(NOW - timedelta(days=60))
+OLD = NOW - timedelta(days=10)
+
+
+def contact(contact_id, **fields):
+    return {"contact_id": contact_id, "merged_into": None, "created_at": LONG_AGO, **fields}
+
+
+async def setup(contacts):
+    await server.db.contacts.insert_many(contacts)
+    await server.db.visit_rollup_state.insert_one({"_id": server.VISIT_ROLLUP_STATE_ID, "lease_until": ""})
+    await server.db.page_visits.insert_many([
+        server._visit_doc(c["contact_id"], None, 'https://lp.example.com/register?x=1', None, None, None, OLD)
+        for c in contacts
+    ] + [server._visit_doc('no-contact-doc', None, 'https://lp.example.com/register', None, None, None, OLD),
+         server._visit_doc('anonymous', None, 'https://lp.example.com/register', None, None, None, NOW)])
+
+
+async def raw_visits():
+    return {v["contact_id"]: v.get("rollup_recheck", False)
+            for v in await server.db.page_visits.find({"timestamp": {"$lt": server.dt_to_str(NOW)}}).to_list(None)}
+
+
+async def rolled_up():
+    rows = await server.db.visit_rollups.find({}, {"_id": 0, "visits": 1}).to_list(None)
+    return sum(r["visits"] for r in rows)
+
+
+def test_kept_rolled_up_and_waiting_visits(monkeypatch):
+    monkeypatch.setattr(server, 'db', AsyncMongoMockClient()['visit_rollup_test'])
+    monkeypatch.setattr(server, 'VISIT_ROLLUP_DAYS', 7)
+    async def run():
+        await setup([
+            contact('identified', email='a@example.com'),
+            contact('parent', merged_children=['child']),
+            contact('child', merged_into='parent'),
+            contact('attributed', attribution={"utm_source": "fb"}),
+            contact('recent', created_at=server.dt_to_str(NOW - timedelta(minutes=5))),
+            contact('same-session-1', session_id='s1'),
+            contact('same-session-2', session_id='s1'),
+            contact('own-session', session_id='s2'),
+            contact('anonymous'),
+        ])
+        assert await server._rollup_anonymous_visits(NOW) == 4
+        assert await raw_visits() == {"identified": False, "parent": False, "child": False, "recent": True,
+                                      "same-session-1": True, "same-session-2": True}
+        assert await rolled_up() == 4          # attributed, own-session, anonymous, no-contact-doc
+        assert await server.db.page_visits.count_documents({"contact_id": "anonymous"}) == 1   # the recent one
+    asyncio.run(run())
+
+
+def test_waiting_visits_are_rechecked_on_later_passes(monkeypatch):
+    monkeypatch.setattr(server, 'db', AsyncMongoMockClient()['visit_rollup_recheck_test'])
+    monkeypatch.setattr(server, 'VISIT_ROLLUP_DAYS', 7)
+    async def run():
+        await setup([
+            contact('recent', created_at=server.dt_to_str(NOW - timedelta(minutes=5))),
+            contact('same-session-1', session_id='s1'),
+            contact('same-session-2', session_id='s1'),
+        ])
+        assert await server._rollup_anonymous_visits(NOW) == 1          # no-contact-doc
+        assert set(await raw_visits()) == {"recent", "same-session-1", "same-session-2"}
+
+        # The session pair is stitched to an identified contact; "recent" leaves the IP window
+        await server.db.contacts.update_one({"contact_id": "same-session-1"}, {"$set": {"email": "s@example.com"}})
+        await server.db.contacts.update_one({"contact_id": "same-session-2"},
+                                            {"$set": {"merged_into": "same-session-1"}})
+        later = NOW + timedelta(hours=1)
+        assert await server._rollup_anonymous_visits(later) == 1          # recent
+        assert await raw_visits() == {"same-session-1": False, "same-session-2": False}
+        assert await server._rollup_anonymous_visits(later + timedelta(hours=1)) == 0
+    asyncio.run(run())
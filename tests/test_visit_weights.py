@@ -0,0 +1,58 @@
+"""
+Sampled pageviews (see Pageview sampling) are stored with their rule's sample_rate and
+must count as 1/sample_rate visits in every visit count.  Run with:  python -m pytest tests/
+"""
+import asyncio
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+from mongomock_motor import AsyncMongoMockClient
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'test_database')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+import server  # noqa: E402
+
+NOW = datetime.now(timezone.utc)
+
+
+async def seed():
+    await server.db.contacts.insert_many([
+        {"id": "1", "contact_id": "sampled", "merged_into": None,
+         "created_at": server.dt_to_str(NOW), "updated_at": server.dt_to_str(NOW)},
+        {"id": "2", "contact_id": "known", "merged_into": None, "email": "a@example.com",
+         "created_at": server.dt_to_str(NOW), "updated_at": server.dt_to_str(NOW)},
+    ])
+    for n in range(3):
+        await server._log_visit('sampled', None, f'https://lp.example.com/p{n}', None, None, None, NOW,
+                                sample_rate=0.25)
+    await server._log_visit('known', None, 'https://lp.example.com/p0', None, None, None, NOW)
+    await server._log_visit('known', None, 'https://lp.example.com/p1', None, None, None, NOW)
+
+
+def test_contact_visit_counts_are_weighted(monkeypatch):
+    monkeypatch.setattr(server, 'db', AsyncMongoMockClient()['visit_weights_test'])
+    async def run():
+        await seed()
+        counts = {c.contact_id: c.visit_count for c in await server.get_contacts()}
+        assert counts == {"sampled": 12, "known": 2}
+    asyncio.run(run())
+
+
+def test_stats_visit_totals_are_weighted(monkeypatch):
+    monkeypatch.setattr(server, 'db', AsyncMongoMockClient()['visit_weights_stats_test'])
+    async def run():
+        await seed()
+        stats = await server.get_stats()
+        assert stats["total_visits"] == 14 and stats["today_visits"] == 14
+        assert await server._weighted_visit_count({"contact_id": "nobody"}) == 0
+    asyncio.run(run())
+
+
+def test_python_weight_matches_the_pipeline_weight():
+    assert server._visit_weight({"sample_rate": 0.1}) == 10
+    assert server._visit_weight({"sample_rate": None}) == 1
+    assert server._visit_weight({}) == 1
@@ -0,0 +1,106 @@
+"""
+Batch ingestion benchmark — events/second through the single-event endpoints vs /track/batch.
+
+Replays the same synthetic event stream (per contact: pageview, tag, lead, a second
+pageview and a registration) two ways against a running backend:
+
+  single   one POST /api/track/{type} per event — each pays for _resolve_contact_id,
+           find_one + update/insert on contacts and insert_one on page_visits.
+  batch    ordered chunks POSTed to /api/track/batch — contacts resolved per chunk,
+           persisted with one contacts bulk_write and one page_visits insert_many.
+
+Run it against a local backend backed by a local mongod (throwaway DB_NAME), e.g.
+    MONGO_URL=mongodb://localhost:27017 DB_NAME=bench uvicorn server:app --port 8010
+    python track_batch_benchmark.py http://localhost:8010 500 200
+
+Usage:  python track_batch_benchmark.py [base_url] [contacts] [batch_size]
+"""
+import requests
+import json
+import sys
+import time
+import uuid
+
+TARGET_SPEEDUP = 10
+
+
+class TrackBatchBenchmark:
+    def __init__(self, base_url="http://localhost:8010"):
+        self.base_url = base_url.rstrip('/')
+        self.api_url = f"{self.base_url}/api"
+        self.session = requests.Session()
+        self.session.headers.update({"Content-Type": "text/plain;charset=UTF-8"})
+
+    def event_stream(self, contacts):
+        """Five events per contact, in the order a registration funnel produces them."""
+        run = uuid.uuid4().hex[:8]
+        events = []
+        for n in range(contacts):
+            cid = str(uuid.uuid4())
+            sid = str(uuid.uuid4())
+            attribution = {"utm_source": "bench", "utm_campaign": f"batch-{run}", "fbclid": f"fb{n}"}
+            page = {
+                "contact_id":   cid,
+                "session_id":   sid,
+                "current_url":  f"https://landing.example.com/register?utm_source=bench&n={n}",
+                "referrer_url": "https://www.facebook.com/",
+                "page_title":   "Benchmark Registration",
+                "attribution":  attribution,
+            }
+            email = f"bench-{run}-{n}@example.com"
+            events += [
+                ("pageview",     page),
+                ("tag",          {"contact_id": cid, "session_id": sid, "tag": "bench"}),
+                ("lead",         {**page, "email": email, "event_id": str(uuid.uuid4())}),
+                ("pageview",     {**page, "current_url": "https://landing.example.com/thank-you"}),
+                ("registration", {**page, "email": email, "name": f"Bench Mark{n}",
+                                  "event_id": str(uuid.uuid4())}),
+            ]
+        return events
+
+    def run_single(self, events, batch_size):
+        for kind, data in events:
+            resp = self.session.post(f"{self.api_url}/track/{kind}", data=json.dumps(data), timeout=30)
+            resp.raise_for_status()
+
+    def run_batch(self, events, batch_size):
+        for start in range(0, len(events), batch_size):
+            chunk = events[start:start + batch_size]
+            body = json.dumps({"events": [{"type": kind, "data": data} for kind, data in chunk]})
+            resp = self.session.post(f"{self.api_url}/track/batch", data=body, timeout=120)
+            resp.raise_for_status()
+            failed = [r for r in resp.json()["results"] if r.get("status") != "ok"]
+            if failed:
+                raise RuntimeError(f"batch rejected events: {failed[:3]}")
+
+    def measure(self, name, runner, contacts, batch_size):
+        events = self.event_stream(contacts)
+        start = time.perf_counter()
+        runner(events, batch_size)
+        elapsed = time.perf_counter() - start
+        rate = len(events) / elapsed
+        print(f"   {name:<7} {len(events):6d} events in {elapsed:7.2f}s   {rate:9.1f} events/s")
+        return rate
+
+
+def main():
+    base_url = sys.argv[1] if len(sys.argv) > 1 else "http://localhost:8010"
+    contacts = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    bench = TrackBatchBenchmark(base_url)
+
+    print(f"🚀 Batch ingestion benchmark against {bench.api_url}  "
+          f"({contacts} contacts × 5 events, batch size {batch_size})")
+    print("=" * 70)
+    single = bench.measure("single", bench.run_single, contacts, batch_size)
+    batch = bench.measure("batch", bench.run_batch, contacts, batch_size)
+    print("=" * 70)
+    speedup = batch / single
+    verdict = "✅" if speedup >= TARGET_SPEEDUP else "❌"
+    print(f"📊 {verdict} /track/batch throughput is {speedup:.1f}x the single-event endpoints "
+          f"(target {TARGET_SPEEDUP}x)")
+    return 0 if speedup >= TARGET_SPEEDUP else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""
+Tracker transport benchmark — HTTP requests per pageview, before vs after.
+
+Replays the traffic one typical registration-page visit generates
+(pageview + auto-tag + email lead + phone lead + form registration) two ways:
+
+  legacy   one application/json POST per event.  Cross-origin, every POST is
+           preceded by an OPTIONS preflight (the old tracker sent no cacheable
+           Access-Control-Max-Age, so each event paid for one).
+  current  text/plain JSON (a CORS "simple" request — no preflight), events
+           queued client-side and flushed as one /track/batch request.
+
+Usage:  python tracker_transport_benchmark.py [base_url] [visits]
+"""
+import requests
+import json
+import sys
+import time
+import uuid
+
+ORIGIN = "https://landing.example.com"
+
+
+class TrackerTransportBenchmark:
+    def __init__(self, base_url="https://tether-workflows.preview.emergentagent.com"):
+        self.base_url = base_url.rstrip('/')
+        self.api_url = f"{self.base_url}/api"
+        self.session = requests.Session()
+
+    def visit_events(self):
+        """Events the tracker emits for one registration-page visit, in order."""
+        cid = str(uuid.uuid4())
+        sid = str(uuid.uuid4())
+        page = {
+            "contact_id":   cid,
+            "session_id":   sid,
+            "current_url":  "https://landing.example.com/register?utm_source=bench",
+            "referrer_url": "https://www.facebook.com/",
+            "page_title":   "Benchmark Registration",
+            "attribution":  {"utm_source": "bench", "utm_campaign": "transport"},
+            "user_agent":   "TrackerTransportBenchmark/1.0",
+        }
+        email = f"bench-{cid[:8]}@example.com"
+        return [
+            ("pageview",     page),
+            ("tag",          {"contact_id": cid, "session_id": sid, "tag": "bench"}),
+            ("lead",         {**page, "email": email}),
+            ("lead",         {**page, "email": email, "phone": "+15555550100"}),
+            ("registration", {**page, "email": email, "phone": "+15555550100", "name": "Bench Mark"}),
+        ]
+
+    def preflight(self, endpoint):
+        return self.session.options(f"{self.api_url}{endpoint}", headers={
+            "Origin":                         ORIGIN,
+            "Access-Control-Request-Method":  "POST",
+            "Access-Control-Request-Headers": "content-type",
+        }, timeout=10)
+
+    def run_legacy(self, events):
+        """Returns number of HTTP requests made for one visit."""
+        requests_made = 0
+        for kind, data in events:
+            endpoint = f"/track/{kind}"
+            self.preflight(endpoint)
+            self.session.post(f"{self.api_url}{endpoint}", json=data,
+                              headers={"Origin": ORIGIN}, timeout=10)
+            requests_made += 2
+        return requests_made
+
+    def run_current(self, events):
+        body = json.dumps({"events": [{"type": kind, "data": data} for kind, data in events]})
+        self.session.post(f"{self.api_url}/track/batch", data=body, timeout=10, headers={
+            "Origin":       ORIGIN,
+            "Content-Type": "text/plain;charset=UTF-8",
+        })
+        return 1
+
+    def measure(self, name, runner, visits):
+        total_requests = 0
+        start = time.perf_counter()
+        for _ in range(visits):
+            total_requests += runner(self.visit_events())
+        elapsed = time.perf_counter() - start
+        per_visit = total_requests / visits
+        print(f"   {name:<8} {per_visit:5.1f} requests/pageview   "
+              f"{elapsed / visits * 1000:7.1f} ms/pageview   ({visits} visits)")
+        return per_visit
+
+    def check_preflight_max_age(self):
+        resp = self.preflight("/track/pageview")
+        max_age = resp.headers.get("access-control-max-age")
+        print(f"   OPTIONS /track/pageview → Access-Control-Max-Age: {max_age}")
+        return max_age
+
+
+def main():
+    base_url = sys.argv[1] if len(sys.argv) > 1 else "https://tether-workflows.preview.emergentagent.com"
+    visits = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    bench = TrackerTransportBenchmark(base_url)
+
+    print(f"🚀 Tracker transport benchmark against {bench.api_url}")
+    print("=" * 60)
+    bench.check_preflight_max_age()
+    legacy = bench.measure("legacy", bench.run_legacy, visits)
+    current = bench.measure("current", bench.run_current, visits)
+    print("=" * 60)
+    print(f"📊 Requests per pageview: {legacy:.1f} → {current:.1f} "
+          f"({(1 - current / legacy) * 100:.0f}% fewer)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())